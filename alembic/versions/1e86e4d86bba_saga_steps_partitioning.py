@@ -0,0 +1,101 @@
+"""Saga steps partitioning
+
+Revision ID: 1e86e4d86bba
+Revises: 6fb52652be92
+Create Date: 2026-10-19 11:03:48.917254
+
+"""
+from datetime import date, datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e86e4d86bba'
+down_revision = '6fb52652be92'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+COLUMNS = """
+    id integer NOT NULL DEFAULT nextval('saga_steps_id_seq'),
+    order_id integer NOT NULL REFERENCES orders (id),
+    step_name varchar(50) NOT NULL,
+    status varchar(20) NOT NULL,
+    error text,
+    started_at timestamptz NOT NULL DEFAULT now(),
+    finished_at timestamptz,
+    PRIMARY KEY (id, started_at)
+"""
+
+
+def _month(offset: int) -> date:
+    today = datetime.now(timezone.utc).date()
+    index = today.year * 12 + today.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        op.create_index('ix_saga_steps_order_id', 'saga_steps', ['order_id'], unique=False)
+        op.create_table('saga_steps_archive',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('step_name', sa.String(length=50), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_saga_steps_archive_order_id', 'saga_steps_archive', ['order_id'], unique=False)
+        return
+
+    op.execute("ALTER TABLE saga_steps RENAME TO saga_steps_legacy")
+    op.execute(f"CREATE TABLE saga_steps ({COLUMNS}) PARTITION BY RANGE (started_at)")
+    op.execute("CREATE TABLE saga_steps_default PARTITION OF saga_steps DEFAULT")
+    for offset in range(MONTHS_AHEAD + 1):
+        start, end = _month(offset), _month(offset + 1)
+        op.execute(
+            f"CREATE TABLE saga_steps_p{start:%Y%m} PARTITION OF saga_steps "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    op.execute("CREATE INDEX ix_saga_steps_order_id ON saga_steps (order_id)")
+    op.execute(
+        "INSERT INTO saga_steps (id, order_id, step_name, status, error, started_at, finished_at) "
+        "SELECT id, order_id, step_name, status, error, COALESCE(started_at, now()), finished_at "
+        "FROM saga_steps_legacy"
+    )
+    op.execute("ALTER SEQUENCE saga_steps_id_seq OWNED BY saga_steps.id")
+    op.execute("DROP TABLE saga_steps_legacy")
+
+    op.execute(f"CREATE TABLE saga_steps_archive ({COLUMNS}) PARTITION BY RANGE (started_at)")
+    op.execute("CREATE INDEX ix_saga_steps_archive_order_id ON saga_steps_archive (order_id)")
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        op.drop_index('ix_saga_steps_archive_order_id', table_name='saga_steps_archive')
+        op.drop_table('saga_steps_archive')
+        op.drop_index('ix_saga_steps_order_id', table_name='saga_steps')
+        return
+
+    op.execute("ALTER TABLE saga_steps RENAME TO saga_steps_partitioned")
+    op.execute(
+        "CREATE TABLE saga_steps ("
+        "id integer NOT NULL DEFAULT nextval('saga_steps_id_seq') PRIMARY KEY, "
+        "order_id integer NOT NULL REFERENCES orders (id), "
+        "step_name varchar(50) NOT NULL, status varchar(20) NOT NULL, error text, "
+        "started_at timestamptz, finished_at timestamptz)"
+    )
+    op.execute(
+        "INSERT INTO saga_steps SELECT id, order_id, step_name, status, error, started_at, finished_at "
+        "FROM saga_steps_archive UNION ALL "
+        "SELECT id, order_id, step_name, status, error, started_at, finished_at FROM saga_steps_partitioned"
+    )
+    op.execute("ALTER SEQUENCE saga_steps_id_seq OWNED BY saga_steps.id")
+    op.execute("DROP TABLE saga_steps_partitioned CASCADE")
+    op.execute("DROP TABLE saga_steps_archive CASCADE")
@@ -0,0 +1,62 @@
+"""Money minor units
+
+Revision ID: b81f5e2c9d07
+Revises: 4d9c0b7e2a51
+Create Date: 2026-10-19 19:26:13.540981
+
+Stores money columns as BIGINT kopecks when run with MONEY_MINOR_UNITS=1 and
+does nothing otherwise; see app/money.py. The application must run with the
+same setting as this migration did. Downgrade converts back to numeric.
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81f5e2c9d07'
+down_revision = '4d9c0b7e2a51'
+branch_labels = None
+depends_on = None
+
+MONEY_COLUMNS = [
+    ('users', 'balance'),
+    ('inventory_items', 'price'),
+    ('promo_codes', 'discount_amount'),
+    ('orders', 'base_amount'),
+    ('orders', 'discount_amount'),
+    ('orders', 'final_amount'),
+    ('payments', 'amount'),
+    ('balance_ledger', 'amount'),
+    ('balance_snapshots', 'balance'),
+]
+# Reconciliation totals are kept in the unit money is stored in
+MONEY_BASELINES = "kind IN ('money', 'ledger')"
+
+
+def _stored_as_bigint() -> bool:
+    columns = sa.inspect(op.get_bind()).get_columns('payments')
+    return isinstance(next(c['type'] for c in columns if c['name'] == 'amount'), sa.BigInteger)
+
+
+def upgrade() -> None:
+    if os.getenv("MONEY_MINOR_UNITS", "0") != "1" or _stored_as_bigint():
+        return
+    for table, column in MONEY_COLUMNS:
+        op.alter_column(
+            table, column, type_=sa.BigInteger(), existing_type=sa.Numeric(15, 2), existing_nullable=False,
+            postgresql_using=f'({column} * 100)::bigint',
+        )
+    op.execute(f"UPDATE reconciliation_baselines SET expected = expected * 100 WHERE {MONEY_BASELINES}")
+
+
+def downgrade() -> None:
+    if not _stored_as_bigint():
+        return
+    for table, column in MONEY_COLUMNS:
+        op.alter_column(
+            table, column, type_=sa.Numeric(15, 2), existing_type=sa.BigInteger(), existing_nullable=False,
+            postgresql_using=f'({column}::numeric / 100)::numeric(15, 2)',
+        )
+    op.execute(f"UPDATE reconciliation_baselines SET expected = expected / 100 WHERE {MONEY_BASELINES}")
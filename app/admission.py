@@ -0,0 +1,150 @@
+"""Admission control for the saga path.
+
+``AdmissionController`` caps how many sagas run at once so a slow database
+does not turn into a pile of requests waiting for pool connections. Requests
+over the limit wait in a bounded FIFO queue; when the queue is full, or a
+request waits longer than the queue timeout, it is rejected straight away.
+The limit adapts to observed saga latency (AIMD): it grows by about one slot
+per ``limit`` fast sagas and shrinks multiplicatively when sagas get slower
+than the target. A per-user cap keeps one client from taking every slot.
+
+The controller is bound to the event loop of the worker process and is not
+thread-safe; every worker admits its own share.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional, Tuple
+
+ADMISSION_INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", "10"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "2"))
+# Keep at or below the connection pool size (pool_size + max_overflow)
+ADMISSION_MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "15"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "50"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2.0"))
+ADMISSION_PER_USER_LIMIT = int(os.getenv("ADMISSION_PER_USER_LIMIT", "3"))
+ADMISSION_TARGET_LATENCY = float(os.getenv("ADMISSION_TARGET_LATENCY", "1.0"))
+ADMISSION_BACKOFF_RATIO = 0.9
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        initial_limit: int = ADMISSION_INITIAL_LIMIT,
+        min_limit: int = ADMISSION_MIN_LIMIT,
+        max_limit: int = ADMISSION_MAX_LIMIT,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+        per_user_limit: int = ADMISSION_PER_USER_LIMIT,
+        target_latency: float = ADMISSION_TARGET_LATENCY,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.per_user_limit = per_user_limit
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.rejected = 0
+        self._waiters: Deque[Tuple[asyncio.Future, int]] = deque()
+        self._per_user: Dict[int, int] = {}
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _retry_after(self) -> int:
+        # Roughly how long the current queue takes to drain at the target latency
+        return max(1, math.ceil((self.queued + 1) * self.target_latency / max(self.limit, 1)))
+
+    def _reject(self, message: str, status_code: int = 503) -> AdmissionRejected:
+        self.rejected += 1
+        return AdmissionRejected(message, status_code, self._retry_after())
+
+    async def acquire(self, user_id: int) -> None:
+        if self._per_user.get(user_id, 0) >= self.per_user_limit:
+            raise self._reject(f"Too many concurrent orders for user {user_id}", status_code=429)
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self._admit(user_id)
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise self._reject("Admission queue is full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (waiter, user_id)
+        self._waiters.append(entry)
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return  # admitted just as the timeout fired
+            self._waiters.remove(entry)
+            self._user_done(user_id)
+            raise self._reject("Timed out waiting for admission")
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release(user_id, latency=None)
+            else:
+                self._waiters.remove(entry)
+                self._user_done(user_id)
+            raise
+
+    def _admit(self, user_id: int) -> None:
+        self.in_flight += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+
+    def _user_done(self, user_id: int) -> None:
+        remaining = self._per_user.get(user_id, 0) - 1
+        if remaining > 0:
+            self._per_user[user_id] = remaining
+        else:
+            self._per_user.pop(user_id, None)
+
+    def release(self, user_id: int, latency: Optional[float]) -> None:
+        self.in_flight -= 1
+        self._user_done(user_id)
+        if latency is not None:
+            self._adjust_limit(latency)
+        self._wake_waiters()
+
+    def _adjust_limit(self, latency: float) -> None:
+        if latency > self.target_latency:
+            self.limit = max(self.min_limit, self.limit * ADMISSION_BACKOFF_RATIO)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter, _ = self._waiters.popleft()
+            # The waiter already counts against its user's limit
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def admit(self, user_id: int):
+        await self.acquire(user_id)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_id, time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
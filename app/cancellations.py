@@ -0,0 +1,165 @@
+"""Bulk cancellation of confirmed orders.
+
+``OrderSaga.cancel`` cancels one order by running its steps' compensations,
+one transaction each. Recalling a SKU or voiding a fraudulent promo code can
+mean thousands of orders, so a ``cancellation_jobs`` row selects orders by SKU,
+promo code and creation time, and ``BulkCancellationWorker`` cancels them in
+batches of ``CANCELLATION_BATCH_SIZE`` orders. A batch is one transaction that
+does what the compensations would, set-based:
+
+* one stock update per SKU and one ``promo_codes`` update per code;
+* one refund ledger entry per user, covering their orders in the batch;
+* the same ``Compensate_*`` step rows and events as a single cancellation.
+
+The job's ``last_order_id`` cursor and counters move in the same transaction,
+so a stopped worker resumes after the last committed batch, and a failed job
+resumes from there once ``POST /admin/cancellations/{id}/resume`` sets it
+running again. Orders whose saga is still running when a batch reaches them
+are not confirmed yet and are left alone.
+"""
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from app.events import order_topic, publish_after_commit, step_event
+from app.models import CancellationJob, Order, SagaStep as SagaStepModel
+from app.saga import SagaContext, SagaServices, cancellation_steps
+
+logger = logging.getLogger(__name__)
+
+CANCELLATION_BATCH_SIZE = int(os.getenv("CANCELLATION_BATCH_SIZE", "500"))
+CANCELLATION_POLL_INTERVAL = float(os.getenv("CANCELLATION_POLL_INTERVAL", "5.0"))
+
+
+def _selected(stmt: Select, job: CancellationJob) -> Select:
+    stmt = stmt.where(Order.status == "CONFIRMED", Order.id > job.last_order_id)
+    if job.sku is not None:
+        stmt = stmt.where(Order.sku == job.sku)
+    if job.promo_code is not None:
+        stmt = stmt.where(Order.promo_code == job.promo_code)
+    if job.created_from is not None:
+        stmt = stmt.where(Order.created_at >= job.created_from)
+    if job.created_to is not None:
+        stmt = stmt.where(Order.created_at < job.created_to)
+    return stmt
+
+
+def remaining_orders(db: Session, job: CancellationJob) -> int:
+    """Confirmed orders the job has yet to cancel."""
+    return db.execute(_selected(select(func.count()).select_from(Order), job)).scalar()
+
+
+class BulkCancellationWorker:
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = CANCELLATION_BATCH_SIZE,
+        poll_interval: float = CANCELLATION_POLL_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def process_batch(self, db: Session, job: CancellationJob, now: Optional[datetime] = None) -> int:
+        """Cancel the job's next batch of orders; returns how many were cancelled."""
+        now = now or datetime.now(timezone.utc)
+        # Locked so a single cancellation of one of them waits for the batch and then finds it cancelled
+        orders: List[Order] = list(db.execute(
+            _selected(select(Order), job).order_by(Order.id).limit(self.batch_size).with_for_update()
+        ).scalars())
+        job.updated_at = now
+        if not orders:
+            job.status = "DONE"
+            db.commit()
+            logger.info(f"Cancellation job {job.id} done: {job.cancelled} orders cancelled, {job.refunded} refunded")
+            return 0
+
+        order_ids = [order.id for order in orders]
+        services = SagaServices.for_session(db)
+        services.discounts.release_many(order_ids)
+        services.inventory.release_many(order_ids)
+        refunds = services.billing.refund_many(order_ids)
+        # Compensations first: their events go out before the CANCELLED ones, in the same commit
+        self._record_compensations(db, orders, services, now)
+        services.orders.cancel_many(order_ids)
+
+        job.last_order_id = order_ids[-1]
+        job.cancelled += len(orders)
+        for amount in refunds.values():
+            job.refunded += amount
+        db.commit()
+        logger.info(f"Cancellation job {job.id}: cancelled orders {order_ids[0]}..{order_ids[-1]}")
+        return len(orders)
+
+    @staticmethod
+    def _record_compensations(db: Session, orders: List[Order], services: SagaServices, now: datetime) -> None:
+        rows = []
+        for order in orders:
+            steps = cancellation_steps(SagaContext(db, order, services=services, faults=None))
+            for step in reversed(steps):
+                step_name = f"Compensate_{step.get_name()}"
+                rows.append({
+                    "order_id": order.id, "step_name": step_name, "status": "COMPLETED",
+                    "started_at": now, "finished_at": now,
+                })
+                publish_after_commit(
+                    db, order_topic(order.id), step_event(order.id, step_name, "COMPLETED", None, now, now)
+                )
+        db.execute(insert(SagaStepModel), rows)
+
+    def run_once(self, db: Session) -> int:
+        """Process a batch of the oldest running job; two workers never share a job."""
+        job = db.execute(
+            select(CancellationJob)
+            .where(CancellationJob.status == "RUNNING")
+            .order_by(CancellationJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).scalar()
+        if job is None:
+            return 0
+        job_id = job.id
+        try:
+            return self.process_batch(db, job)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Cancellation job {job_id} failed: {e}")
+            job = db.get(CancellationJob, job_id, populate_existing=True)
+            job.status = "FAILED"
+            job.last_error = str(e)
+            job.updated_at = datetime.now(timezone.utc)
+            db.commit()
+            return 0
+
+    def run_forever(self) -> None:
+        while not self._stop.is_set():
+            processed = 0
+            db = self.session_factory()
+            try:
+                processed = self.run_once(db)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Cancellation batch failed: {e}")
+            finally:
+                db.close()
+            if processed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="bulk-cancellation", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,174 @@
+"""Coalescing the balance charges of one user's concurrent orders.
+
+A user who submits several orders at once starts several sagas that all
+charge the same balance. Each takes the user's lock in turn, and the ones
+waiting behind it pay for the lock wait in their step timeouts. With
+``BALANCE_COALESCE_WINDOW_MS`` set, ``BalanceCoalescer`` queues those charges
+instead:
+
+* the first charge of a user opens a batch and becomes its leader; charges
+  arriving within the window join the batch in arrival order, up to
+  ``BALANCE_COALESCE_MAX_BATCH``;
+* the leader charges the whole batch with ``BillingService.charge_many`` - one
+  lock, one balance read and one flush - in its own step's transaction. Each
+  order still gets its own ledger entry and payment, so refunds and
+  reconciliation see nothing different;
+* when that transaction commits, every order of the batch learns its own
+  result: charged, or the same insufficient-balance error it would have got
+  alone. If it rolls back, for whatever reason of the leader's own, the other
+  orders charge themselves one by one as without coalescing.
+
+A follower that waits longer than ``BALANCE_COALESCE_WAIT_TIMEOUT`` takes its
+charge out of the batch and charges itself, unless the leader has already
+started charging the batch; then it waits for the leader's transaction to end.
+Either way a payment is written once per order: both ``charge_many`` and the
+single charge skip orders that already have one, checking under the user's
+lock, and ``payments.order_id`` is unique.
+
+Batches are per worker process; orders of one user spread over several
+workers coalesce within each worker only.
+"""
+import os
+import threading
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+BALANCE_COALESCE_WINDOW = float(os.getenv("BALANCE_COALESCE_WINDOW_MS", "0")) / 1000
+BALANCE_COALESCE_MAX_BATCH = int(os.getenv("BALANCE_COALESCE_MAX_BATCH", "20"))
+BALANCE_COALESCE_WAIT_TIMEOUT = float(os.getenv("BALANCE_COALESCE_WAIT_TIMEOUT", "10.0"))
+
+_PENDING_KEY = "balance_batches"
+
+# Outcomes of a batched charge
+CHARGED = "charged"
+DECLINED = "declined"
+RETRY = "retry"
+
+
+class _Charge:
+    def __init__(self, order_id: int, amount: Decimal):
+        self.order_id = order_id
+        self.amount = amount
+        self.outcome: Optional[str] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+class _Batch:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.charges: List[_Charge] = []
+        self.closed = False
+        # Set by the leader once it charges; no charge leaves the batch after that
+        self.charging = False
+        self.full = threading.Event()
+
+    def settle(self, committed: bool) -> None:
+        for charge in self.charges:
+            if not committed:
+                charge.outcome = RETRY
+            elif charge.error is None:
+                charge.outcome = CHARGED
+            else:
+                charge.outcome = DECLINED
+            charge.done.set()
+
+
+class BalanceCoalescer:
+    def __init__(
+        self,
+        window: float = BALANCE_COALESCE_WINDOW,
+        max_batch: int = BALANCE_COALESCE_MAX_BATCH,
+        wait_timeout: float = BALANCE_COALESCE_WAIT_TIMEOUT,
+    ):
+        self.window = window
+        self.max_batch = max_batch
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._open: Dict[int, _Batch] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def queued(self, user_id: int) -> int:
+        """Charges waiting in the user's open batch."""
+        with self._lock:
+            batch = self._open.get(user_id)
+            return len(batch.charges) if batch is not None else 0
+
+    def charge(self, billing, order_id: int, user_id: int, amount: Decimal) -> None:
+        """Charge the order as part of the user's current batch; raises ``ValueError`` like a single charge."""
+        charge = _Charge(order_id, amount)
+        with self._lock:
+            batch = self._open.get(user_id)
+            leader = batch is None
+            if leader:
+                batch = self._open[user_id] = _Batch(user_id)
+            batch.charges.append(charge)
+            if len(batch.charges) >= self.max_batch:
+                self._close(batch)
+        if leader:
+            self._lead(billing, batch)
+        elif (not charge.done.wait(self.wait_timeout) and self._withdraw(batch, charge)) or self._retry(charge):
+            billing.charge_unless_charged(order_id, user_id, amount)
+            return
+        if charge.error is not None:
+            raise ValueError(charge.error)
+
+    def _withdraw(self, batch: _Batch, charge: _Charge) -> bool:
+        """Take a charge the leader has not started on out of the batch."""
+        with self._lock:
+            if batch.charging:
+                return False
+            batch.charges.remove(charge)
+            return True
+
+    @staticmethod
+    def _retry(charge: _Charge) -> bool:
+        # Once charging started, the leader's transaction decides; it settles the batch when it ends
+        charge.done.wait()
+        return charge.outcome == RETRY
+
+    def _close(self, batch: _Batch) -> None:
+        batch.closed = True
+        if self._open.get(batch.user_id) is batch:
+            del self._open[batch.user_id]
+        batch.full.set()
+
+    def _lead(self, billing, batch: _Batch) -> None:
+        batch.full.wait(self.window)
+        with self._lock:
+            if not batch.closed:
+                self._close(batch)
+            batch.charging = True
+        try:
+            errors = billing.charge_many(batch.user_id, [(c.order_id, c.amount) for c in batch.charges])
+        except BaseException:
+            batch.settle(committed=False)
+            raise
+        for charge, error in zip(batch.charges, errors):
+            charge.error = error
+        # The others learn their results once the leader's step commits or rolls back
+        billing.db.info.setdefault(_PENDING_KEY, []).append(batch)
+
+
+balance_coalescer = BalanceCoalescer()
+
+
+@event.listens_for(Session, "after_commit")
+def _settle_committed(session: Session) -> None:
+    for batch in session.info.pop(_PENDING_KEY, ()):
+        batch.settle(committed=True)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _settle_rolled_back(session: Session, transaction) -> None:
+    # Whatever ends the transaction without a commit - a rollback, closing the session - undid the batch
+    if transaction.nested or transaction.parent is not None:
+        return  # a savepoint after the batch; its charges are still there
+    for batch in session.info.pop(_PENDING_KEY, ()):
+        batch.settle(committed=False)
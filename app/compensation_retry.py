@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+from datetime import datetime, timezone, timedelta
+from typing import Callable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.events import order_topic, publish_after_commit, step_event
+from app.models import CompensationRetry, SagaStep as SagaStepModel
+from app.saga import SagaContext, build_step
+
+logger = logging.getLogger(__name__)
+
+RETRY_BATCH_SIZE = int(os.getenv("COMPENSATION_RETRY_BATCH_SIZE", "100"))
+RETRY_BASE_DELAY = float(os.getenv("COMPENSATION_RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("COMPENSATION_RETRY_MAX_DELAY", "300.0"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("COMPENSATION_RETRY_MAX_ATTEMPTS", "10"))
+RETRY_POLL_INTERVAL = float(os.getenv("COMPENSATION_RETRY_POLL_INTERVAL", "5.0"))
+
+
+def backoff_delay(attempts: int, base: float = RETRY_BASE_DELAY, maximum: float = RETRY_MAX_DELAY) -> timedelta:
+    return timedelta(seconds=min(base * 2 ** max(attempts - 1, 0), maximum))
+
+
+class CompensationRetryWorker:
+    """Processes queued compensations with exponential backoff.
+
+    Due rows are claimed in batches with ``FOR UPDATE SKIP LOCKED`` so several
+    workers can drain a large backlog in parallel; each compensation runs in its
+    own savepoint and the whole batch is committed once.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = RETRY_BATCH_SIZE,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        poll_interval: float = RETRY_POLL_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def process_batch(self, db: Session, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now(timezone.utc)
+        retries: List[CompensationRetry] = (
+            db.query(CompensationRetry)
+            .filter(CompensationRetry.status == "PENDING", CompensationRetry.next_attempt_at <= now)
+            .order_by(CompensationRetry.next_attempt_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for retry in retries:
+            self._attempt(db, retry, now)
+        db.commit()
+        return len(retries)
+
+    def replay(self, db: Session, retry_id: int) -> Optional[CompensationRetry]:
+        retry = db.query(CompensationRetry).filter(CompensationRetry.id == retry_id).with_for_update().first()
+        if not retry:
+            return None
+        if retry.status != "SUCCEEDED":
+            retry.status = "PENDING"
+            retry.attempts = 0
+            self._attempt(db, retry, datetime.now(timezone.utc))
+        db.commit()
+        return retry
+
+    def _attempt(self, db: Session, retry: CompensationRetry, now: datetime) -> None:
+        retry.attempts += 1
+        retry.updated_at = now
+        savepoint = db.begin_nested()
+        try:
+            context = SagaContext.load(db, retry.order_id)
+            step = build_step(context, retry.step_name) if context else None
+            if step is None:
+                raise ValueError(f"Cannot rebuild step {retry.step_name} for order {retry.order_id}")
+            step.compensate()
+            finished_at = datetime.now(timezone.utc)
+            db.add(SagaStepModel(
+                order_id=retry.order_id, step_name=f"Compensate_{retry.step_name}",
+                status="COMPLETED", started_at=now, finished_at=finished_at,
+            ))
+            publish_after_commit(db, order_topic(retry.order_id), step_event(
+                retry.order_id, f"Compensate_{retry.step_name}", "COMPLETED", started_at=now, finished_at=finished_at,
+            ))
+            savepoint.commit()
+            retry.status = "SUCCEEDED"
+            retry.last_error = None
+            logger.info(f"Retried compensation {retry.step_name} for order {retry.order_id} succeeded")
+        except Exception as e:
+            savepoint.rollback()
+            retry.last_error = str(e)
+            if retry.attempts >= self.max_attempts:
+                retry.status = "DEAD"
+                logger.error(f"Compensation {retry.step_name} for order {retry.order_id} moved to dead letter: {e}")
+            else:
+                retry.next_attempt_at = now + backoff_delay(retry.attempts)
+                logger.warning(f"Retried compensation {retry.step_name} for order {retry.order_id} failed: {e}")
+
+    def run_forever(self) -> None:
+        while not self._stop.is_set():
+            processed = 0
+            db = self.session_factory()
+            try:
+                processed = self.process_batch(db)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Compensation retry batch failed: {e}")
+            finally:
+                db.close()
+            # drain backlogs without sleeping while there is work left
+            if processed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="compensation-retry", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,97 @@
+"""Per-table concurrency control for the rows the saga steps modify.
+
+Each hot table can run in one of these modes, chosen with an env variable:
+
+* ``lock`` (default) - ``SELECT ... FOR UPDATE`` the row, check it, update it.
+  For ``users`` this is the per-user advisory lock in ``BillingService``.
+* ``atomic`` - a single conditional ``UPDATE ... WHERE on_hand >= :qty``; no
+  read beforehand and no lock held beyond the statement itself.
+* ``optimistic`` - read without locking and let the ``version`` column
+  (``version_id_col``) detect concurrent writers at flush time; a
+  ``StaleDataError`` retries the operation in a fresh savepoint.
+* ``lease`` - ``promo_codes`` only: uses are taken off the row in blocks and
+  handed out from memory, see ``app/promo_leases.py``.
+
+``users`` has no ``atomic`` mode: the balance is a ledger sum, not a column a
+single ``UPDATE`` could guard. ``benchmarks/concurrency_modes.py`` compares the
+modes under low and high contention.
+"""
+import logging
+import os
+import threading
+from typing import Callable, Dict, TypeVar
+
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+LOCK = "lock"
+ATOMIC = "atomic"
+OPTIMISTIC = "optimistic"
+LEASE = "lease"
+
+SUPPORTED_MODES: Dict[str, tuple] = {
+    "inventory_items": (LOCK, ATOMIC, OPTIMISTIC),
+    "promo_codes": (LOCK, ATOMIC, OPTIMISTIC, LEASE),
+    "users": (LOCK, OPTIMISTIC),
+}
+
+CONCURRENCY_MODES: Dict[str, str] = {
+    "inventory_items": os.getenv("INVENTORY_CONCURRENCY", LOCK),
+    "promo_codes": os.getenv("PROMO_CONCURRENCY", LOCK),
+    "users": os.getenv("BALANCE_CONCURRENCY", LOCK),
+}
+
+OPTIMISTIC_MAX_ATTEMPTS = int(os.getenv("OPTIMISTIC_MAX_ATTEMPTS", "5"))
+
+_stale_retries = 0
+_stale_retries_lock = threading.Lock()
+
+
+def concurrency_mode(table: str) -> str:
+    mode = CONCURRENCY_MODES[table]
+    if mode not in SUPPORTED_MODES[table]:
+        raise ValueError(f"Unsupported concurrency mode {mode!r} for {table}")
+    return mode
+
+
+def retry_on_stale(db: Session, operation: Callable[[], T], attempts: int = OPTIMISTIC_MAX_ATTEMPTS) -> T:
+    """Run ``operation`` in a savepoint, re-running it when a version check fails."""
+    for attempt in range(1, attempts + 1):
+        try:
+            with db.begin_nested():
+                return operation()
+        except StaleDataError:
+            if attempt == attempts:
+                raise
+            _count_stale_retry()
+            logger.info(f"Concurrent update detected, retrying (attempt {attempt + 1}/{attempts})")
+    raise AssertionError("unreachable")
+
+
+def apply_returned(db: Session, model: type, key: str, returned: Row) -> None:
+    """Write the columns an ``UPDATE ... RETURNING`` gave back into the session's loaded copy of the row, if any.
+
+    The atomic mode's statements run with ``synchronize_session=False``: the
+    ORM cannot evaluate their bound quantities against loaded objects.
+    """
+    loaded = db.identity_map.get(db.identity_key(model, key))
+    if loaded is not None:
+        for name, value in returned._mapping.items():
+            set_committed_value(loaded, name, value)
+
+
+def _count_stale_retry() -> None:
+    global _stale_retries
+    with _stale_retries_lock:
+        _stale_retries += 1
+
+
+def stale_retry_count() -> int:
+    """Number of optimistic retries so far in this process, for benchmarks."""
+    return _stale_retries
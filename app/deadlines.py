@@ -0,0 +1,100 @@
+"""Deadlines and timeouts for saga execution.
+
+Every ``OrderSaga.execute`` runs under a ``Deadline`` (``SAGA_EXECUTION_TIMEOUT``
+seconds, ``0`` disables it). Time is enforced in two ways:
+
+* cooperatively - the deadline is checked before each step starts and before
+  each step commits, and ``cancel()`` makes the next check fail too. A step
+  that misses the deadline is rolled back and the saga compensates the steps
+  before it, exactly as if the step had failed;
+* in PostgreSQL - every step transaction sets ``statement_timeout`` (the
+  step's timeout, capped by the time left) and ``lock_timeout``. A statement
+  stuck on a lock is cancelled by the server, which frees the connection and
+  fails the step.
+
+Compensations get the step timeouts but are not bound by the deadline: they
+must run however late it is, and a timed-out one is queued for retry.
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+SAGA_EXECUTION_TIMEOUT = float(os.getenv("SAGA_EXECUTION_TIMEOUT", "30.0"))
+SAGA_STEP_TIMEOUT = float(os.getenv("SAGA_STEP_TIMEOUT", "5.0"))
+SAGA_LOCK_TIMEOUT = float(os.getenv("SAGA_LOCK_TIMEOUT", "2.0"))
+
+
+def _parse_step_timeouts(value: str) -> Dict[str, float]:
+    """``"ReserveInventory=2,ChargeUserBalance=3"`` -> per-step timeouts in seconds."""
+    timeouts = {}
+    for part in value.split(","):
+        if part.strip():
+            step_name, seconds = part.split("=")
+            timeouts[step_name.strip()] = float(seconds)
+    return timeouts
+
+
+STEP_TIMEOUTS = _parse_step_timeouts(os.getenv("SAGA_STEP_TIMEOUTS", ""))
+
+# One round trip; is_local=true scopes both settings to the current transaction
+_set_timeouts = text(
+    "SELECT set_config('statement_timeout', :statement_timeout, true), set_config('lock_timeout', :lock_timeout, true)"
+)
+
+
+class SagaDeadlineExceeded(Exception):
+    pass
+
+
+class SagaCancelled(SagaDeadlineExceeded):
+    pass
+
+
+def step_timeout(step_name: str) -> float:
+    return STEP_TIMEOUTS.get(step_name, SAGA_STEP_TIMEOUT)
+
+
+def apply_timeouts(db: Session, statement_timeout: float, lock_timeout: float = SAGA_LOCK_TIMEOUT) -> None:
+    """Limit the statements of the current transaction; a no-op outside PostgreSQL."""
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    statement_ms = max(int(statement_timeout * 1000), 1)
+    lock_ms = max(min(int(lock_timeout * 1000), statement_ms), 1)
+    db.execute(_set_timeouts, {"statement_timeout": str(statement_ms), "lock_timeout": str(lock_ms)})
+
+
+class Deadline:
+    """Time budget of one saga execution, shared by its steps and the request that started it."""
+
+    def __init__(self, timeout: float = SAGA_EXECUTION_TIMEOUT, clock: Callable[[], float] = time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        self.expires_at = clock() + timeout
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> float:
+        return self.expires_at - self.clock()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self, step_name: str) -> None:
+        if self._cancelled.is_set():
+            raise SagaCancelled(f"Saga cancelled at step {step_name}")
+        if self.remaining() <= 0:
+            raise SagaDeadlineExceeded(f"Saga deadline of {self.timeout:g}s exceeded at step {step_name}")
+
+    def apply(self, db: Session, step_name: str) -> None:
+        apply_timeouts(db, min(step_timeout(step_name), self.remaining()))
+
+
+def new_deadline() -> Optional[Deadline]:
+    return Deadline() if SAGA_EXECUTION_TIMEOUT > 0 else None
@@ -0,0 +1,225 @@
+"""In-process pub/sub for saga progress, with optional PostgreSQL fan-out.
+
+Code that changes saga state calls ``publish_after_commit``; the event is
+delivered to subscribers only once the surrounding transaction commits and is
+dropped if it rolls back. With ``SAGA_EVENTS_NOTIFY=1`` events are sent through
+``pg_notify`` instead and every worker's ``PgNotifyListener`` feeds them into its
+local bus, so all workers see all events.
+"""
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_ENABLED = os.getenv("SAGA_EVENTS_NOTIFY", "0") == "1"
+NOTIFY_CHANNEL = os.getenv("SAGA_EVENTS_CHANNEL", "saga_events")
+SUBSCRIPTION_QUEUE_SIZE = 100
+MAX_ERROR_LENGTH = 1000  # pg_notify payloads are limited to 8000 bytes
+ALL_TOPICS = "*"  # listeners registered under this topic receive every event
+
+_PENDING_KEY = "pending_events"
+_notify = text("SELECT pg_notify(:channel, :payload)")
+
+
+class Subscription:
+    def __init__(self, bus: "EventBus", topic: str, loop: asyncio.AbstractEventLoop):
+        self.bus = bus
+        self.topic = topic
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+
+    def _put(self, payload: dict) -> None:
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning(f"Dropping event for slow subscriber of {self.topic}")
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class EventBus:
+    """Fans every published event out to the subscribers of its topic.
+
+    Async subscribers get events through an ``asyncio.Queue`` on their own loop,
+    so ``publish`` is safe to call from worker threads. Sync listeners are called
+    in the publishing thread and must be fast.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+        self._listeners: Dict[str, List[Callable[[dict], None]]] = {}
+
+    def subscribe(self, topic: str) -> Subscription:
+        subscription = Subscription(self, topic, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.topic)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.topic]
+
+    def add_listener(self, topic: str, callback: Callable[[dict], None]) -> None:
+        with self._lock:
+            self._listeners.setdefault(topic, []).append(callback)
+
+    def remove_listener(self, topic: str, callback: Callable[[dict], None]) -> None:
+        with self._lock:
+            listeners = self._listeners.get(topic, [])
+            if callback in listeners:
+                listeners.remove(callback)
+
+    def publish(self, topic: str, payload: dict) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(topic, ()))
+            listeners = list(self._listeners.get(topic, ())) + list(self._listeners.get(ALL_TOPICS, ()))
+        for subscription in subscriptions:
+            if subscription.loop.is_closed():
+                continue
+            subscription.loop.call_soon_threadsafe(subscription._put, payload)
+        for callback in listeners:
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"Event listener for {topic} failed: {e}")
+
+
+bus = EventBus()
+
+
+def order_topic(order_id: int) -> str:
+    return f"order:{order_id}"
+
+
+def step_event(order_id: int, step_name: str, status: str, error: Optional[str] = None,
+               started_at: Optional[datetime] = None, finished_at: Optional[datetime] = None) -> dict:
+    return {
+        "type": "step",
+        "order_id": order_id,
+        "step_name": step_name,
+        "status": status,
+        "error": error[:MAX_ERROR_LENGTH] if error else None,
+        "started_at": _isoformat(started_at),
+        "finished_at": _isoformat(finished_at),
+    }
+
+
+def order_event(order_id: int, status: str) -> dict:
+    return {"type": "order", "order_id": order_id, "status": status}
+
+
+def promo_topic(code: str) -> str:
+    return f"promo:{code}"
+
+
+def promo_event(code: str) -> dict:
+    # A promo code was created or got uses back
+    return {"type": "promo", "code": code}
+
+
+def stock_topic(sku: str) -> str:
+    return f"stock:{sku}"
+
+
+def stock_event(sku: str, shard: int, on_hand: int, version: int) -> dict:
+    # The item's stock on a shard as of a committed change; version orders the changes of one row
+    return {"type": "stock", "sku": sku, "shard": shard, "on_hand": on_hand, "version": version}
+
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def publish_after_commit(db: Session, topic: str, payload: dict) -> None:
+    if NOTIFY_ENABLED and db.get_bind().dialect.name == "postgresql":
+        # Delivered by PostgreSQL on commit, to every listening worker including this one
+        db.execute(_notify, {"channel": NOTIFY_CHANNEL, "payload": json.dumps({"topic": topic, "payload": payload})})
+        return
+    pending: List[Tuple[str, dict]] = db.info.setdefault(_PENDING_KEY, [])
+    pending.append((topic, payload))
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver_pending(session: Session) -> None:
+    for topic, payload in session.info.pop(_PENDING_KEY, ()):
+        bus.publish(topic, payload)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+class PgNotifyListener:
+    """LISTENs on the events channel and republishes notifications on the local bus."""
+
+    def __init__(self, engine: Engine, event_bus: EventBus = bus, channel: str = NOTIFY_CHANNEL,
+                 poll_interval: float = 1.0):
+        self.engine = engine
+        self.bus = event_bus
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_forever(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error(f"Event listener connection failed: {e}")
+                self._stop.wait(self.poll_interval)
+
+    def _listen(self) -> None:
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel}")
+            while not self._stop.is_set():
+                if select.select([dbapi_connection], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    message = json.loads(notification.payload)
+                    self.bus.publish(message["topic"], message["payload"])
+        finally:
+            connection.invalidate()
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="saga-events-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,143 @@
+"""Fault injection for saga steps.
+
+A ``FaultRegistry`` holds rules keyed by step name and phase. ``SagaStepBase``
+consults it at fixed points of a step's life:
+
+* ``before_execute`` / ``after_execute`` - around the service call;
+* ``before_commit`` / ``after_commit`` - around the commit of a completed step,
+  so ``after_commit`` fails a step whose changes are already durable;
+* ``compensate`` - before the compensating action runs.
+
+A rule's kind is ``error`` (raise ``InjectedFault``), ``timeout`` (wait
+``delay_ms``, then raise ``TimeoutError``), ``delay`` (wait only) or ``crash``
+(raise ``InjectedCrash``, a ``BaseException`` that no saga handler catches,
+leaving the saga where a dying process would).
+
+Rules come from ``SAGA_FAULTS`` and, with ``SAGA_FAULT_HEADERS=1``, from the
+``X-Saga-Faults`` header of a single ``POST /orders``. Both use the same spec:
+comma-separated ``step:phase[:kind[:probability[:delay_ms]]]``, where step may
+be ``*``. Without rules the saga gets no registry at all, so production pays a
+single ``None`` check per injection point.
+"""
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+SAGA_FAULTS = os.getenv("SAGA_FAULTS", "")
+FAULT_HEADERS_ENABLED = os.getenv("SAGA_FAULT_HEADERS", "0") == "1"
+FAULT_HEADER = "X-Saga-Faults"
+
+BEFORE_EXECUTE = "before_execute"
+AFTER_EXECUTE = "after_execute"
+BEFORE_COMMIT = "before_commit"
+AFTER_COMMIT = "after_commit"
+COMPENSATE = "compensate"
+PHASES = (BEFORE_EXECUTE, AFTER_EXECUTE, BEFORE_COMMIT, AFTER_COMMIT, COMPENSATE)
+
+ERROR = "error"
+TIMEOUT = "timeout"
+DELAY = "delay"
+CRASH = "crash"
+KINDS = (ERROR, TIMEOUT, DELAY, CRASH)
+
+ANY_STEP = "*"
+
+
+class InjectedFault(Exception):
+    pass
+
+
+class InjectedCrash(BaseException):
+    """Stands for the process dying mid-saga; deliberately not an ``Exception``."""
+
+
+class FaultRule:
+    def __init__(self, step_name: str, phase: str, kind: str = ERROR,
+                 probability: float = 1.0, delay_ms: float = 0.0):
+        if phase not in PHASES:
+            raise ValueError(f"Unknown fault phase {phase!r}")
+        if kind not in KINDS:
+            raise ValueError(f"Unknown fault kind {kind!r}")
+        self.step_name = step_name
+        self.phase = phase
+        self.kind = kind
+        self.probability = probability
+        self.delay_ms = delay_ms
+
+    @classmethod
+    def parse(cls, spec: str) -> "FaultRule":
+        parts = spec.strip().split(":")
+        if len(parts) < 2 or len(parts) > 5:
+            raise ValueError(f"Invalid fault spec {spec!r}, expected step:phase[:kind[:probability[:delay_ms]]]")
+        step_name, phase = parts[0], parts[1]
+        kind = parts[2] if len(parts) > 2 else ERROR
+        probability = float(parts[3]) if len(parts) > 3 else 1.0
+        delay_ms = float(parts[4]) if len(parts) > 4 else 0.0
+        return cls(step_name, phase, kind, probability, delay_ms)
+
+
+class FaultRegistry:
+    """Fault rules by ``(step_name, phase)``.
+
+    ``sleep`` is called for ``timeout`` and ``delay`` faults with seconds;
+    ``app/simulation.py`` passes its simulated clock so nothing really waits.
+    """
+
+    def __init__(self, rules: Optional[List[FaultRule]] = None, seed: Optional[int] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self._rules: Dict[Tuple[str, str], List[FaultRule]] = {}
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.sleep = sleep
+        self.injected: Dict[Tuple[str, str, str], int] = {}
+        for rule in rules or ():
+            self.add(rule)
+
+    @classmethod
+    def from_spec(cls, spec: str, **kwargs) -> "FaultRegistry":
+        return cls([FaultRule.parse(part) for part in spec.split(",") if part.strip()], **kwargs)
+
+    def add(self, rule: FaultRule) -> None:
+        self._rules.setdefault((rule.step_name, rule.phase), []).append(rule)
+
+    def __bool__(self) -> bool:
+        return bool(self._rules)
+
+    def inject(self, step_name: str, phase: str) -> None:
+        for key in ((step_name, phase), (ANY_STEP, phase)):
+            for rule in self._rules.get(key, ()):
+                if rule.probability < 1.0:
+                    with self._rng_lock:
+                        if self._rng.random() >= rule.probability:
+                            continue
+                self._fire(rule, step_name, phase)
+
+    def _fire(self, rule: FaultRule, step_name: str, phase: str) -> None:
+        counter = (step_name, phase, rule.kind)
+        self.injected[counter] = self.injected.get(counter, 0) + 1
+        if rule.kind in (TIMEOUT, DELAY) and rule.delay_ms:
+            self.sleep(rule.delay_ms / 1000.0)
+        message = f"Injected {rule.kind} in {step_name} at {phase}"
+        if rule.kind == ERROR:
+            raise InjectedFault(message)
+        if rule.kind == TIMEOUT:
+            raise TimeoutError(message)
+        if rule.kind == CRASH:
+            raise InjectedCrash(message)
+
+
+_configured: Optional[FaultRegistry] = FaultRegistry.from_spec(SAGA_FAULTS) if SAGA_FAULTS else None
+
+
+def configured_faults() -> Optional[FaultRegistry]:
+    """The registry from ``SAGA_FAULTS``, or ``None`` when fault injection is off."""
+    return _configured
+
+
+def faults_from_header(value: Optional[str]) -> Optional[FaultRegistry]:
+    """Per-request registry from the ``X-Saga-Faults`` header, if headers are enabled."""
+    if not FAULT_HEADERS_ENABLED or not value:
+        return None
+    return FaultRegistry.from_spec(value)
@@ -0,0 +1,113 @@
+"""Cache of pre-rendered HTML fragments.
+
+Finished orders are rendered once and kept under ``order_key(order_id)``; the
+``<option>`` lists of the order form are kept under ``USER_OPTIONS`` and
+``ITEM_OPTIONS``. Entries are dropped from EventBus notifications: a step event
+invalidates its order (compensation retries still append steps to FAILED
+orders) and any completed step or compensation invalidates the option lists,
+since they show balances and stock. With ``SAGA_EVENTS_NOTIFY=1`` this also
+covers changes made by other workers; otherwise ``FRAGMENT_CACHE_TTL`` bounds
+how stale another worker's copy can get.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from markupsafe import Markup
+
+from app.events import ALL_TOPICS, EventBus
+
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", "1000"))
+FRAGMENT_CACHE_TTL = float(os.getenv("FRAGMENT_CACHE_TTL", "60.0"))
+
+USER_OPTIONS = "options:users"
+ITEM_OPTIONS = "options:items"
+
+
+def order_key(order_id: int) -> str:
+    return f"order:{order_id}"
+
+
+class FragmentCache:
+    """Thread-safe LRU of rendered fragments with per-key invalidation.
+
+    ``get_or_render`` only stores a fragment if its key was not invalidated
+    while it was being rendered, so a render racing with a change never
+    overwrites the invalidation with stale HTML.
+    """
+
+    def __init__(self, max_entries: int = FRAGMENT_CACHE_SIZE, ttl: float = FRAGMENT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Markup]]" = OrderedDict()
+        # One [stale] flag per render in progress, flipped by invalidate()
+        self._renders: Dict[str, List[List[bool]]] = {}
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def get_or_render(self, key: str, render: Callable[[], str]) -> Markup:
+        fragment = self.get(key)
+        if fragment is not None:
+            return fragment
+        token = [False]
+        with self._lock:
+            self._renders.setdefault(key, []).append(token)
+        try:
+            fragment = Markup(render())
+        except Exception:
+            with self._lock:
+                self._forget_render(key, token)
+            raise
+        with self._lock:
+            self._forget_render(key, token)
+            if not token[0]:
+                self._entries[key] = (time.monotonic() + self.ttl, fragment)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return fragment
+
+    def _forget_render(self, key: str, token: List[bool]) -> None:
+        renders = self._renders[key]
+        renders.remove(token)
+        if not renders:
+            del self._renders[key]
+
+    def invalidate(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                for token in self._renders.get(key, ()):
+                    token[0] = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            for renders in self._renders.values():
+                for token in renders:
+                    token[0] = True
+
+    def on_event(self, payload: dict) -> None:
+        if payload.get("type") != "step":
+            return
+        self.invalidate(order_key(payload["order_id"]))
+        if payload["status"] == "COMPLETED":
+            self.invalidate(USER_OPTIONS, ITEM_OPTIONS)
+
+    def install(self, event_bus: EventBus) -> None:
+        event_bus.add_listener(ALL_TOPICS, self.on_event)
+
+
+fragments = FragmentCache()
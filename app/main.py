@@ -1,29 +1,205 @@
+import asyncio
+import json
 import logging
+import os
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 from pathlib import Path
 
 from fastapi import FastAPI, Depends, Form, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from markupsafe import Markup
 from starlette.requests import Request
 from sqlalchemy.orm import Session
 
-from app.db import get_db
-from app.models import Order, SagaStep, User, InventoryItem, PromoCode
-from app.saga import OrderSaga
-from app.services.discounts import DiscountsService
+from app.admission import AdmissionController, AdmissionRejected
+from app.cancellations import BulkCancellationWorker, remaining_orders
+from app.compensation_retry import CompensationRetryWorker
+from app.concurrency import LEASE, concurrency_mode
+from app.db import dispose_engines, get_db, prewarm_pool
+from app.deadlines import new_deadline
+from app.events import NOTIFY_ENABLED, PgNotifyListener, bus, order_event, order_topic, step_event
+from app.faults import FAULT_HEADER, faults_from_header
+from app.fragments import ITEM_OPTIONS, USER_OPTIONS, fragments, order_key
+from app.money import ZERO
+from app.models import Order, User, InventoryItem, CompensationRetry, SagaInstance, CancellationJob
+from app.partitioning import get_saga_steps
+from app.profiling import current_profile, profiler
+from app.promo_filter import EXHAUSTED, PromoFilterRebuildJob, promo_filter
+from app.promo_leases import lease_pool
+from app.rollups import SagaStepRollupJob, get_stats
+from app.saga import OrderSaga, SagaContext
+from app.saga_instances import COMPENSATING, find_stuck
+from app.saga_recovery import SagaRecoveryJob
+from app.services.billing import BillingService
+from app.services.discounts import DiscountsService, PromoCodeUnavailable
+from app.sharding import CatalogRebalanceJob, list_orders, shards
+from app.stock_view import stock_view
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# One of each per shard, indexed by shard
+compensation_retry_workers = [CompensationRetryWorker(shards.session_factory(i)) for i in range(shards.count)]
+rollup_jobs = [SagaStepRollupJob(shards.session_factory(i)) for i in range(shards.count)]
+saga_recovery_jobs = [SagaRecoveryJob(shards.session_factory(i)) for i in range(shards.count)]
+cancellation_workers = [BulkCancellationWorker(shards.session_factory(i)) for i in range(shards.count)]
+# Every shard has the whole catalog
+promo_filter_job = PromoFilterRebuildJob(shards.session_factory(0))
+catalog_rebalance_job = CatalogRebalanceJob(shards)
+admission = AdmissionController()
+fragments.install(bus)
+promo_filter.install(bus)
+stock_view.install(bus)
 
-app = FastAPI(title="Saga Order Management")
-templates = Jinja2Templates(directory=str(Path(__file__).parent.parent / "templates"))
+SSE_KEEPALIVE_INTERVAL = 15.0
+# How often a running saga checks whether its client went away
+DISCONNECT_POLL_INTERVAL = float(os.getenv("SAGA_DISCONNECT_POLL_INTERVAL", "0.5"))
+FINAL_ORDER_STATUSES = ("CONFIRMED", "FAILED", "CANCELLED")
+PAGE_TEMPLATES = ("index.html", "order_success.html", "_order_details.html", "_user_options.html", "_item_options.html")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Everything expensive happens here rather than at import time
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    templates = get_templates()
+    for name in PAGE_TEMPLATES:
+        templates.get_template(name)
+    for shard in range(shards.count):
+        warmed = await run_in_threadpool(prewarm_pool, engine=shards.engine(shard))
+        logging.info(f"Connection pool of shard {shard} prewarmed with {warmed} connections")
+    await run_in_threadpool(shards.prepare)
+    # Every shard has the whole catalog
+    await run_in_threadpool(shards.on_shard, 0, promo_filter.rebuild)
+    await run_in_threadpool(shards.scatter, stock_view.load)
+    events_listeners = [PgNotifyListener(shards.engine(i)) for i in range(shards.count)]
+    run_worker = os.getenv("COMPENSATION_RETRY_WORKER", "1") == "1"
+    run_rollups = os.getenv("STATS_ROLLUP_WORKER", "1") == "1"
+    run_recovery = os.getenv("SAGA_RECOVERY_WORKER", "1") == "1"
+    run_cancellations = os.getenv("CANCELLATION_WORKER", "1") == "1"
+    run_promo_filter = os.getenv("PROMO_BLOOM_REBUILD_WORKER", "1") == "1"
+    # With one shard there is nothing to move
+    run_rebalance = shards.count > 1 and os.getenv("CATALOG_REBALANCE_WORKER", "1") == "1"
+    workers = (
+        (compensation_retry_workers if run_worker else [])
+        + (events_listeners if NOTIFY_ENABLED else [])
+        + (rollup_jobs if run_rollups else [])
+        + (saga_recovery_jobs if run_recovery else [])
+        + (cancellation_workers if run_cancellations else [])
+        + ([promo_filter_job] if run_promo_filter else [])
+        + ([catalog_rebalance_job] if run_rebalance else [])
+    )
+    for worker in workers:
+        worker.start()
+    yield
+    for worker in reversed(workers):
+        worker.stop(timeout=5)
+    if concurrency_mode("promo_codes") == LEASE:
+        returned = sum(await run_in_threadpool(shards.scatter, _release_promo_leases))
+        logging.info(f"Returned {returned} leased promo uses")
+    dispose_engines()
+
+
+def _release_promo_leases(db: Session) -> int:
+    return lease_pool(db).release(db)
+
+
+app = FastAPI(title="Saga Order Management", lifespan=lifespan)
+
+
+def _bytecode_cache() -> FileSystemBytecodeCache:
+    # Compiled templates survive restarts, so new workers skip parsing them
+    directory = os.getenv("JINJA_BYTECODE_CACHE_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return FileSystemBytecodeCache(directory or None)
+
+
+@lru_cache(maxsize=None)
+def get_templates() -> Jinja2Templates:
+    return Jinja2Templates(env=Environment(
+        loader=FileSystemLoader(str(Path(__file__).parent.parent / "templates")),
+        autoescape=True,
+        bytecode_cache=_bytecode_cache(),
+    ))
+
+
+def _render_fragment(template_name: str, **context) -> str:
+    return get_templates().get_template(template_name).render(**context)
+
+
+def _users_and_balances(db: Session) -> tuple:
+    return db.query(User).all(), BillingService(db).get_balances()
+
+
+def _render_user_options(db: Session) -> str:
+    users, balances = [], {}
+    for shard_users, shard_balances in shards.scatter(_users_and_balances, {0: db}):
+        users.extend(shard_users)
+        balances.update(shard_balances)
+    return _render_fragment("_user_options.html", users=users, balances=balances)
+
+
+def _render_item_options(db: Session) -> str:
+    for shard in stock_view.stale_shards(shards.count):
+        shards.on_shard(shard, stock_view.load, {0: db})
+    # Each shard holds a share of the stock; the view shows the total
+    return _render_fragment("_item_options.html", items=stock_view.items())
+
+
+def _render_index(request: Request, db: Session, error: Optional[str] = None, status_code: int = 200):
+    user_options = fragments.get_or_render(USER_OPTIONS, lambda: _render_user_options(db))
+    item_options = fragments.get_or_render(ITEM_OPTIONS, lambda: _render_item_options(db))
+    return get_templates().TemplateResponse("index.html", {
+        "request": request, "user_options": user_options, "item_options": item_options, "error": error
+    }, status_code=status_code)
+
+
+def _order_details(db: Session, order: Order) -> Markup:
+    def render() -> str:
+        return _render_fragment(
+            "_order_details.html", order=order, saga=db.get(SagaInstance, order.id), saga_steps=get_saga_steps(db, order)
+        )
+
+    # Finished orders only change through compensation retries, which invalidate the fragment
+    if order.status in FINAL_ORDER_STATUSES:
+        return fragments.get_or_render(order_key(order.id), render)
+    return Markup(render())
+
+
+def _shard_db(shard: int, db: Session):
+    # Shard 0 is the default database the request's session is on
+    if shard == 0:
+        yield db
+        return
+    routed = shards.session(shard)
+    try:
+        yield routed
+    finally:
+        routed.close()
+
+
+def get_user_db(user_id: int = Form(...), db: Session = Depends(get_db)):
+    yield from _shard_db(shards.shard_for_user(user_id), db)
+
+
+def get_order_db(order_id: int, db: Session = Depends(get_db)):
+    yield from _shard_db(shards.shard_for_order(order_id), db)
+
+
+def get_shard_db(shard: int = 0, db: Session = Depends(get_db)):
+    """Admin endpoints work on one shard, chosen with ``?shard=``."""
+    if not 0 <= shard < shards.count:
+        raise HTTPException(status_code=404, detail=f"Shard {shard} not found")
+    yield from _shard_db(shard, db)
 
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request, db: Session = Depends(get_db)):
-    users = db.query(User).all()
-    items = db.query(InventoryItem).all()
-    return templates.TemplateResponse("index.html", {"request": request, "users": users, "items": items})
+    return _render_index(request, db)
 
 
 @app.post("/orders", response_class=HTMLResponse)
@@ -34,32 +210,69 @@ async def create_order(
     qty: int = Form(...),
     promo_code: Optional[str] = Form(None),
     fail_at_step: Optional[str] = Form(None),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_user_db)
 ):
+    if profiler.wanted(request.headers):
+        with profiler.capture(f"POST /orders user {user_id} {sku} x{qty}"):
+            return await _admit_order(request, db, user_id, sku, qty, promo_code, fail_at_step)
+    return await _admit_order(request, db, user_id, sku, qty, promo_code, fail_at_step)
+
+
+async def _admit_order(request: Request, db: Session, user_id: int, sku: str, qty: int,
+                       promo_code: Optional[str], fail_at_step: Optional[str]):
+    # Admitted before touching the database so overload never queues on the pool
+    try:
+        async with admission.admit(user_id):
+            return await _place_order(request, db, user_id, sku, qty, promo_code, fail_at_step)
+    except AdmissionRejected as e:
+        logging.warning(f"Order from user {user_id} rejected by admission control: {e}")
+        return HTMLResponse(
+            "Сервис перегружен, повторите попытку позже" if e.status_code == 503
+            else "Слишком много одновременных заказов, повторите попытку позже",
+            status_code=e.status_code, headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+async def _place_order(request: Request, db: Session, user_id: int, sku: str, qty: int,
+                       promo_code: Optional[str], fail_at_step: Optional[str]):
     try:
         promo_code = promo_code or None
         fail_at_step = fail_at_step or None
 
         if qty <= 0:
             raise HTTPException(status_code=400, detail="Количество товара должно быть больше 0")
-        
-        user = db.query(User).filter(User.id == user_id).first()
+
+        try:
+            faults = faults_from_header(request.headers.get(FAULT_HEADER))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Некорректный заголовок {FAULT_HEADER}: {e}")
+
+        user = db.get(User, user_id)
         if not user:
             raise HTTPException(status_code=404, detail=f"Пользователь {user_id} не найден")
 
-        item = db.query(InventoryItem).filter(InventoryItem.sku == sku).first()
+        # From the stock view; the saga makes the check that counts
+        stock = stock_view.item(db, sku)
+        if not stock:
+            raise HTTPException(status_code=404, detail=f"Товар {sku} не найден")
+        if stock.on_hand < qty:
+            raise HTTPException(status_code=400, detail=f"Недостаточно товара {sku}: в наличии {stock.on_hand}")
+        # Priced from the row: nothing tells the view's catalog about a changed price until it reloads
+        item = db.get(InventoryItem, sku)
         if not item:
             raise HTTPException(status_code=404, detail=f"Товар {sku} не найден")
         
+        promo = None
         if promo_code:
-            promo = db.query(PromoCode).filter(PromoCode.code == promo_code).first()
-            if not promo:
+            try:
+                promo = DiscountsService(db).check_promo(promo_code)
+            except PromoCodeUnavailable as e:
+                if e.reason == EXHAUSTED:
+                    raise HTTPException(status_code=400, detail=f"Промокод '{promo_code}' исчерпан")
                 raise HTTPException(status_code=400, detail=f"Промокод '{promo_code}' не найден")
-            if promo.remaining_uses <= 0:
-                raise HTTPException(status_code=400, detail=f"Промокод '{promo_code}' исчерпан")
 
         base_amount = item.price * qty
-        discount_amount = DiscountsService(db).calculate_discount(promo_code, base_amount)
+        discount_amount = promo.discount_amount if promo is not None else ZERO  # checked usable above
         final_amount = base_amount - discount_amount
 
         order = Order(
@@ -70,43 +283,282 @@ async def create_order(
         db.add(order)
         db.commit()
 
-        saga = OrderSaga(db)
-        saga.execute(order.id, fail_at_step)
+        # Run the blocking saga off the event loop so progress streams keep flowing
+        context = SagaContext(db, order, faults=faults, deadline=new_deadline())
+        await _run_saga(request, OrderSaga(db), order.id, fail_at_step, context)
+        profile = current_profile()
+        if profile is not None:
+            profile.order_id = order.id
+            profile.record_steps(get_saga_steps(db, order))
 
-        saga_steps = db.query(SagaStep).filter(SagaStep.order_id == order.id).order_by(SagaStep.started_at).all()
-        return templates.TemplateResponse("order_success.html", {
-            "request": request, "order": order, "saga_steps": saga_steps
+        return get_templates().TemplateResponse("order_success.html", {
+            "request": request, "order_id": order.id, "order_details": _order_details(db, order)
         })
 
     except HTTPException as e:
         db.rollback()
-        users = db.query(User).all()
-        items = db.query(InventoryItem).all()
-        return templates.TemplateResponse("index.html", {
-            "request": request, "users": users, "items": items, "error": e.detail
-        }, status_code=e.status_code)
+        return _render_index(request, db, error=e.detail, status_code=e.status_code)
     
     except Exception as e:
         db.rollback()
         logging.error(f"Error creating order: {e}", exc_info=True)
-        users = db.query(User).all()
-        items = db.query(InventoryItem).all()
-        return templates.TemplateResponse("index.html", {
-            "request": request, "users": users, "items": items, "error": f"Ошибка сервера: {str(e)}"
-        }, status_code=500)
+        return _render_index(request, db, error=f"Ошибка сервера: {str(e)}", status_code=500)
+
+
+async def _run_saga(request: Request, saga: OrderSaga, order_id: int, fail_at_step: Optional[str],
+                    context: SagaContext) -> bool:
+    """Run the saga in the threadpool and cancel it if the client leaves or the request is cancelled.
+
+    Cancellation is cooperative: the saga stops at its next step boundary and
+    compensates. The request waits for that either way, since the saga is
+    still using the request's session.
+    """
+    future = asyncio.ensure_future(run_in_threadpool(profiler.profiled(saga.execute), order_id, fail_at_step, context))
+    try:
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return future.result()
+            if context.deadline is not None and not context.deadline.cancelled and await request.is_disconnected():
+                logging.warning(f"Client left while the saga for order {order_id} was running, cancelling it")
+                context.deadline.cancel()
+    except asyncio.CancelledError:
+        if context.deadline is not None:
+            context.deadline.cancel()
+        await asyncio.wait({future})
+        raise
+
+
+@app.get("/stock")
+async def get_stock(db: Session = Depends(get_db)):
+    """Available stock per SKU over all shards, from this worker's stock view."""
+    for shard in stock_view.stale_shards(shards.count):
+        await run_in_threadpool(shards.on_shard, shard, stock_view.load, {0: db})
+    return [{"sku": item.sku, "name": item.name, "on_hand": item.on_hand} for item in stock_view.items()]
 
 
 @app.get("/orders/{order_id}", response_class=HTMLResponse)
-async def get_order(request: Request, order_id: int, db: Session = Depends(get_db)):
-    order = db.query(Order).filter(Order.id == order_id).first()
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
-    saga_steps = db.query(SagaStep).filter(SagaStep.order_id == order_id).order_by(SagaStep.started_at).all()
-    return templates.TemplateResponse("order_success.html", {
-        "request": request, "order": order, "saga_steps": saga_steps
+async def get_order(request: Request, order_id: int, db: Session = Depends(get_order_db)):
+    order_details = fragments.get(order_key(order_id))
+    if order_details is None:
+        order = db.get(Order, order_id)
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        order_details = _order_details(db, order)
+    return get_templates().TemplateResponse("order_success.html", {
+        "request": request, "order_id": order_id, "order_details": order_details
     })
 
 
+def _sse(payload: dict) -> str:
+    return f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n"
+
+
+@app.get("/orders/{order_id}/events")
+async def order_events(order_id: int, db: Session = Depends(get_order_db)):
+    """Server-sent events with the order's saga steps, live until the order is final and compensated."""
+    # Subscribe before reading the current state so no transition is missed in between
+    subscription = bus.subscribe(order_topic(order_id))
+    try:
+        order = db.get(Order, order_id)
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        snapshot = [
+            step_event(s.order_id, s.step_name, s.status, s.error, s.started_at, s.finished_at)
+            for s in get_saga_steps(db, order)
+        ]
+        instance = db.get(SagaInstance, order_id)
+        finished = order.status in FINAL_ORDER_STATUSES
+        if finished and instance is not None and instance.phase == COMPENSATING:
+            # The final status is published again once the compensations are done
+            finished = False
+        else:
+            snapshot.append(order_event(order.id, order.status))
+    except Exception:
+        subscription.close()
+        raise
+
+    async def stream():
+        with subscription:
+            for payload in snapshot:
+                yield _sse(payload)
+            if finished:
+                return
+            while True:
+                try:
+                    payload = await asyncio.wait_for(subscription.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(payload)
+                if payload["type"] == "order" and payload["status"] in FINAL_ORDER_STATUSES:
+                    return
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def _compensation_retry_to_dict(retry: CompensationRetry) -> dict:
+    return {
+        "id": retry.id,
+        "order_id": retry.order_id,
+        "step_name": retry.step_name,
+        "status": retry.status,
+        "attempts": retry.attempts,
+        "last_error": retry.last_error,
+        "next_attempt_at": retry.next_attempt_at.isoformat() if retry.next_attempt_at else None,
+    }
+
+
+@app.get("/admin/compensations")
+async def list_compensations(status: Optional[str] = None, limit: int = 100, db: Session = Depends(get_shard_db)):
+    query = db.query(CompensationRetry)
+    if status:
+        query = query.filter(CompensationRetry.status == status)
+    retries = query.order_by(CompensationRetry.next_attempt_at).limit(limit).all()
+    return [_compensation_retry_to_dict(r) for r in retries]
+
+
+@app.post("/admin/compensations/{retry_id}/replay")
+async def replay_compensation(retry_id: int, shard: int = 0, db: Session = Depends(get_shard_db)):
+    retry = compensation_retry_workers[shard].replay(db, retry_id)
+    if not retry:
+        raise HTTPException(status_code=404, detail="Compensation retry not found")
+    return _compensation_retry_to_dict(retry)
+
+
+def _saga_instance_to_dict(instance: SagaInstance) -> dict:
+    return {
+        "order_id": instance.order_id,
+        "phase": instance.phase,
+        "step_index": instance.step_index,
+        "step_name": instance.step_name,
+        "attempts": instance.attempts,
+        "deadline": instance.deadline.isoformat() if instance.deadline else None,
+        "updated_at": instance.updated_at.isoformat() if instance.updated_at else None,
+    }
+
+
+@app.get("/admin/orders")
+async def list_recent_orders(limit: int = 100, user_id: Optional[int] = None, status: Optional[str] = None,
+                             db: Session = Depends(get_db)):
+    """The newest orders across every shard."""
+    orders = await run_in_threadpool(list_orders, shards, limit, user_id, status, {0: db})
+    return [
+        {
+            "id": o.id, "user_id": o.user_id, "sku": o.sku, "qty": o.qty, "promo_code": o.promo_code,
+            "final_amount": str(o.final_amount), "status": o.status,
+            "created_at": o.created_at.isoformat() if o.created_at else None,
+        }
+        for o in orders
+    ]
+
+
+@app.get("/admin/sagas/stuck")
+async def list_stuck_sagas(limit: int = 100, db: Session = Depends(get_shard_db)):
+    return [_saga_instance_to_dict(i) for i in find_stuck(db, limit=limit)]
+
+
+@app.post("/admin/orders/{order_id}/cancel")
+async def cancel_order(order_id: int, db: Session = Depends(get_order_db)):
+    if not db.get(Order, order_id):
+        raise HTTPException(status_code=404, detail="Order not found")
+    if not await run_in_threadpool(OrderSaga(db).cancel, order_id):
+        raise HTTPException(status_code=409, detail="Only confirmed orders can be cancelled")
+    return {"order_id": order_id, "status": "CANCELLED"}
+
+
+def _cancellation_job_to_dict(db: Session, job: CancellationJob) -> dict:
+    return {
+        "id": job.id,
+        "sku": job.sku,
+        "promo_code": job.promo_code,
+        "created_from": job.created_from.isoformat() if job.created_from else None,
+        "created_to": job.created_to.isoformat() if job.created_to else None,
+        "status": job.status,
+        "last_order_id": job.last_order_id,
+        "cancelled": job.cancelled,
+        "refunded": str(job.refunded),
+        "remaining": remaining_orders(db, job) if job.status != "DONE" else 0,
+        "last_error": job.last_error,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+
+@app.post("/admin/cancellations")
+async def create_cancellation(
+    sku: Optional[str] = None,
+    promo_code: Optional[str] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    db: Session = Depends(get_shard_db),
+):
+    """Start cancelling the confirmed orders matching every given filter; progress is at ``GET``."""
+    if sku is None and promo_code is None and created_from is None and created_to is None:
+        raise HTTPException(status_code=400, detail="At least one of sku, promo_code, created_from, created_to is required")
+    job = CancellationJob(
+        sku=sku, promo_code=promo_code, created_from=created_from, created_to=created_to, status="RUNNING",
+        last_order_id=0, cancelled=0, refunded=0,
+    )
+    db.add(job)
+    db.commit()
+    return _cancellation_job_to_dict(db, job)
+
+
+@app.get("/admin/cancellations/{job_id}")
+async def get_cancellation(job_id: int, db: Session = Depends(get_shard_db)):
+    job = db.get(CancellationJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Cancellation job not found")
+    return _cancellation_job_to_dict(db, job)
+
+
+@app.post("/admin/cancellations/{job_id}/resume")
+async def resume_cancellation(job_id: int, db: Session = Depends(get_shard_db)):
+    job = db.get(CancellationJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Cancellation job not found")
+    if job.status == "FAILED":
+        # Picks up after the last committed batch
+        job.status = "RUNNING"
+        job.last_error = None
+        job.updated_at = datetime.now(timezone.utc)
+        db.commit()
+    return _cancellation_job_to_dict(db, job)
+
+
+@app.get("/admin/profiles")
+async def list_profiles():
+    return [profile.summary() for profile in profiler.list()]
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: int):
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.to_dict()
+
+
+@app.get("/stats")
+async def saga_stats(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    group_by: str = "step_name",
+    step_name: Optional[str] = None,
+    sku: Optional[str] = None,
+    promo_code: Optional[str] = None,
+    db: Session = Depends(get_shard_db),
+):
+    """Failure rates, compensation rates and duration percentiles from the per-minute rollups."""
+    until = until or datetime.now(timezone.utc)
+    since = since or until - timedelta(hours=1)
+    try:
+        stats = get_stats(db, since, until, group_by, step_name=step_name, sku=sku, promo_code=promo_code)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"since": since.isoformat(), "until": until.isoformat(), "group_by": group_by, "stats": stats}
+
+
 @app.get("/health")
 async def health_check():
-    return {"status": "ok"}
+    return {"status": "ok", "admission": admission.stats()}
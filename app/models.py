@@ -1,7 +1,9 @@
 from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, Numeric, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Numeric, DateTime, ForeignKey, Text, Index, JSON
 from sqlalchemy.orm import declarative_base, relationship
 
+from app.money import money_type
+
 Base = declarative_base()
 
 
@@ -10,10 +12,15 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
-    balance = Column(Numeric(15, 2), nullable=False, default=0)
+    # Balance as of ledger entry balance_ledger_id; see BillingService.get_balance
+    balance = Column(money_type(), nullable=False, default=0)
+    balance_ledger_id = Column(Integer, nullable=False, default=0)
+    version = Column(Integer, nullable=False, default=1)  # see app/concurrency.py
 
     payments = relationship("Payment", back_populates="user")
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return f"<User(id={self.id}, name={self.name}, balance={self.balance})>"
 
@@ -23,11 +30,14 @@ class InventoryItem(Base):
 
     sku = Column(String(50), primary_key=True)
     name = Column(String(200), nullable=False)
-    price = Column(Numeric(15, 2), nullable=False)
+    price = Column(money_type(), nullable=False)
     on_hand = Column(Integer, nullable=False, default=0)
+    version = Column(Integer, nullable=False, default=1)
 
     reservations = relationship("InventoryReservation", back_populates="item")
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return f"<InventoryItem(sku={self.sku}, name={self.name}, price={self.price}, on_hand={self.on_hand})>"
 
@@ -37,10 +47,13 @@ class PromoCode(Base):
 
     code = Column(String(50), primary_key=True)
     remaining_uses = Column(Integer, nullable=False, default=0)
-    discount_amount = Column(Numeric(15, 2), nullable=False)
+    discount_amount = Column(money_type(), nullable=False)
+    version = Column(Integer, nullable=False, default=1)
 
     applications = relationship("PromoApplication", back_populates="promo")
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return f"<PromoCode(code={self.code}, remaining_uses={self.remaining_uses}, discount={self.discount_amount})>"
 
@@ -53,10 +66,10 @@ class Order(Base):
     promo_code = Column(String(50), ForeignKey("promo_codes.code"), nullable=True)
     sku = Column(String(50), ForeignKey("inventory_items.sku"), nullable=False)
     qty = Column(Integer, nullable=False)
-    base_amount = Column(Numeric(15, 2), nullable=False)
-    discount_amount = Column(Numeric(15, 2), nullable=False, default=0)
-    final_amount = Column(Numeric(15, 2), nullable=False)
-    status = Column(String(20), nullable=False, default="PENDING")  # PENDING, CONFIRMED, FAILED
+    base_amount = Column(money_type(), nullable=False)
+    discount_amount = Column(money_type(), nullable=False, default=0)
+    final_amount = Column(money_type(), nullable=False)
+    status = Column(String(20), nullable=False, default="PENDING")  # PENDING, CONFIRMED, FAILED, CANCELLED
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
     user = relationship("User")
@@ -69,14 +82,15 @@ class Order(Base):
 
 
 class SagaStep(Base):
+    # Range-partitioned by started_at in PostgreSQL, see app/partitioning.py
     __tablename__ = "saga_steps"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, index=True)
     step_name = Column(String(50), nullable=False)
     status = Column(String(20), nullable=False)  # STARTED, COMPLETED, FAILED, COMPENSATED
     error = Column(Text, nullable=True)
-    started_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    started_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
     finished_at = Column(DateTime(timezone=True), nullable=True)
 
     order = relationship("Order", back_populates="saga_steps")
@@ -85,13 +99,75 @@ class SagaStep(Base):
         return f"<SagaStep(order_id={self.order_id}, step={self.step_name}, status={self.status})>"
 
 
+class SagaInstance(Base):
+    # Current position of an order's saga, kept in step by app/saga_instances.py
+    __tablename__ = "saga_instances"
+    __table_args__ = (
+        Index("ix_saga_instances_deadline", "deadline"),
+    )
+
+    order_id = Column(Integer, ForeignKey("orders.id"), primary_key=True)
+    step_index = Column(Integer, nullable=False, default=0)  # step running or compensating next
+    step_name = Column(String(50), nullable=True)  # NULL once DONE
+    phase = Column(String(20), nullable=False, default="FORWARD")  # FORWARD, COMPENSATING, DONE
+    attempts = Column(Integer, nullable=False, default=1)
+    deadline = Column(DateTime(timezone=True), nullable=True)  # NULL once DONE
+    started_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+    version = Column(Integer, nullable=False, default=1)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    def __repr__(self):
+        return f"<SagaInstance(order_id={self.order_id}, phase={self.phase}, step={self.step_name})>"
+
+
+class SagaStepArchive(Base):
+    # Detached saga_steps partitions are attached here by app/partitioning.py
+    __tablename__ = "saga_steps_archive"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, index=True)
+    step_name = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False)
+    error = Column(Text, nullable=True)
+    started_at = Column(DateTime(timezone=True), nullable=False)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<SagaStepArchive(order_id={self.order_id}, step={self.step_name}, status={self.status})>"
+
+
+class PromoLease(Base):
+    # Block of promo uses taken by one worker, see app/promo_leases.py
+    __tablename__ = "promo_leases"
+    __table_args__ = (
+        Index("ix_promo_leases_code_expires_at", "code", "expires_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    code = Column(String(50), ForeignKey("promo_codes.code"), nullable=False)
+    owner = Column(String(100), nullable=False)
+    granted = Column(Integer, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<PromoLease(id={self.id}, code={self.code}, granted={self.granted}, owner={self.owner})>"
+
+
 class PromoApplication(Base):
     __tablename__ = "promo_applications"
+    __table_args__ = (
+        Index("ix_promo_applications_code_status", "code", "status"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
     code = Column(String(50), ForeignKey("promo_codes.code"), nullable=False)
     status = Column(String(20), nullable=False)  # APPLIED, CANCELLED
+    # Lease the use came from while the lease is outstanding; NULL once it is settled
+    lease_id = Column(Integer, ForeignKey("promo_leases.id", ondelete="SET NULL"), nullable=True, index=True)
 
     order = relationship("Order")
     promo = relationship("PromoCode", back_populates="applications")
@@ -102,6 +178,9 @@ class PromoApplication(Base):
 
 class InventoryReservation(Base):
     __tablename__ = "inventory_reservations"
+    __table_args__ = (
+        Index("ix_inventory_reservations_sku_status", "sku", "status"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
@@ -118,11 +197,16 @@ class InventoryReservation(Base):
 
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (
+        Index("ix_payments_user_id_status", "user_id", "status"),
+        # One payment per order; a refund updates it rather than adding another
+        Index("ix_payments_order_id", "order_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    amount = Column(Numeric(15, 2), nullable=False)
+    amount = Column(money_type(), nullable=False)
     status = Column(String(20), nullable=False)  # CHARGED, REFUNDED
 
     order = relationship("Order")
@@ -130,3 +214,127 @@ class Payment(Base):
 
     def __repr__(self):
         return f"<Payment(order_id={self.order_id}, user_id={self.user_id}, amount={self.amount}, status={self.status})>"
+
+
+class CompensationRetry(Base):
+    __tablename__ = "compensation_retries"
+    __table_args__ = (
+        Index("ix_compensation_retries_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    step_name = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default="PENDING")  # PENDING, SUCCEEDED, DEAD
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+
+    order = relationship("Order")
+
+    def __repr__(self):
+        return f"<CompensationRetry(order_id={self.order_id}, step={self.step_name}, status={self.status}, attempts={self.attempts})>"
+
+
+class BalanceLedgerEntry(Base):
+    __tablename__ = "balance_ledger"
+    __table_args__ = (
+        Index("ix_balance_ledger_user_id_id", "user_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=True)
+    amount = Column(money_type(), nullable=False)  # signed: negative for charges
+    kind = Column(String(20), nullable=False)  # CHARGE, REFUND
+    created_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<BalanceLedgerEntry(user_id={self.user_id}, order_id={self.order_id}, amount={self.amount}, kind={self.kind})>"
+
+
+class BalanceSnapshot(Base):
+    __tablename__ = "balance_snapshots"
+    __table_args__ = (
+        Index("ix_balance_snapshots_user_id_created_at", "user_id", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    balance = Column(money_type(), nullable=False)
+    ledger_id = Column(Integer, nullable=False)  # last ledger entry folded into balance
+    created_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<BalanceSnapshot(user_id={self.user_id}, balance={self.balance}, ledger_id={self.ledger_id})>"
+
+
+class SagaStepRollup(Base):
+    # Per-minute aggregates of finished saga_steps rows, see app/rollups.py
+    __tablename__ = "saga_step_rollups"
+
+    bucket = Column(DateTime(timezone=True), primary_key=True)  # minute of started_at
+    step_name = Column(String(50), primary_key=True)  # without the Compensate_ prefix
+    sku = Column(String(50), primary_key=True)
+    promo_code = Column(String(50), primary_key=True)  # "" for orders without promo
+    completed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    compensated = Column(Integer, nullable=False, default=0)
+    compensation_failed = Column(Integer, nullable=False, default=0)
+    duration_count = Column(Integer, nullable=False, default=0)
+    duration_sum_ms = Column(BigInteger, nullable=False, default=0)
+    duration_max_ms = Column(Integer, nullable=False, default=0)
+    duration_histogram = Column(JSON, nullable=False)  # counts per DURATION_BUCKETS_MS bound, plus overflow
+
+    def __repr__(self):
+        return f"<SagaStepRollup(bucket={self.bucket}, step={self.step_name}, sku={self.sku}, promo={self.promo_code})>"
+
+
+class RollupCursor(Base):
+    __tablename__ = "rollup_cursors"
+
+    name = Column(String(50), primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<RollupCursor(name={self.name}, last_id={self.last_id})>"
+
+
+class CancellationJob(Base):
+    # A bulk cancellation of confirmed orders, processed in batches by app/cancellations.py
+    __tablename__ = "cancellation_jobs"
+    __table_args__ = (
+        Index("ix_cancellation_jobs_status_id", "status", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    sku = Column(String(50), nullable=True)
+    promo_code = Column(String(50), nullable=True)
+    created_from = Column(DateTime(timezone=True), nullable=True)
+    created_to = Column(DateTime(timezone=True), nullable=True)
+    status = Column(String(20), nullable=False, default="RUNNING")  # RUNNING, DONE, FAILED
+    last_order_id = Column(Integer, nullable=False, default=0)  # orders up to this id are processed
+    cancelled = Column(Integer, nullable=False, default=0)
+    refunded = Column(money_type(), nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<CancellationJob(id={self.id}, status={self.status}, last_order_id={self.last_order_id})>"
+
+
+class ReconciliationBaseline(Base):
+    # Conserved totals recorded by app/reconciliation.py
+    __tablename__ = "reconciliation_baselines"
+
+    kind = Column(String(20), primary_key=True)  # stock, money, promo
+    entity = Column(String(50), primary_key=True)  # SKU, user id or promo code
+    expected = Column(Numeric(15, 2), nullable=False)
+    recorded_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<ReconciliationBaseline(kind={self.kind}, entity={self.entity}, expected={self.expected})>"
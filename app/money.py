@@ -0,0 +1,135 @@
+"""Money amounts as integer minor units (kopecks).
+
+By default amounts are ``Numeric(15, 2)`` columns read as ``Decimal``. With
+``MONEY_MINOR_UNITS=1`` every money column is a ``BIGINT`` of kopecks (run
+the ``money_minor_units`` migration with the same setting) and is read as
+``Money``, a small integer wrapper: the saga adds, subtracts and compares
+plain ints instead of allocating ``Decimal`` objects, and the driver encodes
+and decodes integers instead of numerics.
+
+``Money`` supports the operations the code applies to amounts, so the same
+code runs on either representation; ``ZERO`` is the zero amount of the
+configured one. Conversion happens only at the edges: ``str()`` renders
+the same text as the ``Decimal`` would in templates and messages, and
+amounts given as ``Decimal`` (seed data, forms) are converted when bound.
+"""
+import os
+from decimal import Decimal
+from typing import Union
+
+from sqlalchemy import BigInteger, Numeric
+from sqlalchemy.types import TypeDecorator
+
+MONEY_MINOR_UNITS = os.getenv("MONEY_MINOR_UNITS", "0") == "1"
+
+MINOR_PER_MAJOR = 100
+
+
+class Money:
+    """An amount in minor units; immutable."""
+
+    __slots__ = ("minor",)
+
+    def __init__(self, minor: int):
+        self.minor = minor
+
+    @classmethod
+    def from_decimal(cls, value: Union[Decimal, int, str]) -> "Money":
+        minor = Decimal(value).scaleb(2)
+        if minor != minor.to_integral_value():
+            raise ValueError(f"{value} is not a whole number of minor units")
+        return cls(int(minor))
+
+    def to_decimal(self) -> Decimal:
+        return Decimal(self.minor).scaleb(-2)
+
+    def __str__(self) -> str:
+        # Same text as a Numeric(15, 2) Decimal, without building one
+        units, cents = divmod(abs(self.minor), MINOR_PER_MAJOR)
+        return f"{'-' if self.minor < 0 else ''}{units}.{cents:02d}"
+
+    def __repr__(self) -> str:
+        return f"Money('{self}')"
+
+    def __add__(self, other) -> "Money":
+        return Money(self.minor + self._minor_of(other))
+
+    def __radd__(self, other) -> "Money":
+        return Money(self._minor_of(other) + self.minor)
+
+    def __sub__(self, other) -> "Money":
+        return Money(self.minor - self._minor_of(other))
+
+    def __rsub__(self, other) -> "Money":
+        return Money(self._minor_of(other) - self.minor)
+
+    def __neg__(self) -> "Money":
+        return Money(-self.minor)
+
+    def __mul__(self, quantity: int) -> "Money":
+        if isinstance(quantity, int):
+            return Money(self.minor * quantity)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __bool__(self) -> bool:
+        return self.minor != 0
+
+    def __hash__(self) -> int:
+        # Equal to the Decimal and int amounts it compares equal to, so it hashes as they do
+        return hash(self.to_decimal())
+
+    @staticmethod
+    def _minor_of(other) -> int:
+        # Plain numbers are major units, as for Decimal amounts: an amount assigned
+        # as a Decimal and not reloaded yet, sum()'s initial 0, or `amount > 0`
+        if isinstance(other, Money):
+            return other.minor
+        if isinstance(other, (int, Decimal)):
+            return Money.from_decimal(other).minor
+        raise TypeError(f"Unsupported operand for Money: {type(other).__name__}")
+
+    def __eq__(self, other) -> bool:
+        try:
+            return self.minor == self._minor_of(other)
+        except (TypeError, ValueError):
+            return NotImplemented
+
+    def __lt__(self, other) -> bool:
+        return self.minor < self._minor_of(other)
+
+    def __le__(self, other) -> bool:
+        return self.minor <= self._minor_of(other)
+
+    def __gt__(self, other) -> bool:
+        return self.minor > self._minor_of(other)
+
+    def __ge__(self, other) -> bool:
+        return self.minor >= self._minor_of(other)
+
+
+class MinorUnits(TypeDecorator):
+    """A ``BIGINT`` of minor units, read as ``Money``; also accepts ``Decimal`` and ints in major units."""
+
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, Money):
+            return None if value is None else value.minor
+        return Money.from_decimal(value).minor
+
+    def process_result_value(self, value, dialect):
+        # SUM over BIGINT is numeric in PostgreSQL
+        return None if value is None else Money(int(value))
+
+    def coerce_compared_value(self, op, value):
+        return self
+
+
+def money_type():
+    return MinorUnits() if MONEY_MINOR_UNITS else Numeric(15, 2)
+
+
+ZERO = Money(0) if MONEY_MINOR_UNITS else Decimal("0")
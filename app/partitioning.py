@@ -0,0 +1,126 @@
+"""Monthly range partitions of ``saga_steps`` and their archival.
+
+``saga_steps`` is partitioned by ``started_at`` in PostgreSQL (see the
+``saga_steps_partitioning`` migration). This module creates partitions ahead of
+time and moves old ones into ``saga_steps_archive`` by detaching them and
+attaching them to the archive table, so no rows are copied.
+
+Run ``python -m app.partitioning`` from cron to do both.
+"""
+import logging
+import os
+from datetime import date, datetime, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from app.models import Order, SagaStep, SagaStepArchive
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("SAGA_STEPS_PARTITION_MONTHS_AHEAD", "3"))
+RETENTION_MONTHS = int(os.getenv("SAGA_STEPS_RETENTION_MONTHS", "6"))
+ARCHIVE_TABLESPACE = os.getenv("SAGA_STEPS_ARCHIVE_TABLESPACE")
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"saga_steps_p{month:%Y%m}"
+
+
+def partition_bounds(month: date) -> Tuple[date, date]:
+    return month, _add_months(month, 1)
+
+
+def _partitions_of(conn: Connection, table: str) -> List[str]:
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table ORDER BY c.relname"
+    ), {"table": table})
+    return [r[0] for r in rows]
+
+
+def _month_of(name: str) -> Optional[date]:
+    suffix = name.rsplit("_p", 1)[-1]
+    if len(suffix) != 6 or not suffix.isdigit():
+        return None  # e.g. the DEFAULT partition
+    return date(int(suffix[:4]), int(suffix[4:]), 1)
+
+
+def ensure_future_partitions(conn: Connection, months_ahead: int = PARTITION_MONTHS_AHEAD,
+                             today: Optional[date] = None) -> List[str]:
+    today = today or datetime.now(timezone.utc).date()
+    current = today.replace(day=1)
+    existing = set(_partitions_of(conn, "saga_steps")) | set(_partitions_of(conn, "saga_steps_archive"))
+    created = []
+    for offset in range(months_ahead + 1):
+        month = _add_months(current, offset)
+        name = partition_name(month)
+        if name in existing:
+            continue
+        start, end = partition_bounds(month)
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF saga_steps "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        created.append(name)
+        logger.info(f"Created partition {name}")
+    return created
+
+
+def archive_partitions(conn: Connection, retention_months: int = RETENTION_MONTHS,
+                       tablespace: Optional[str] = ARCHIVE_TABLESPACE,
+                       today: Optional[date] = None) -> List[str]:
+    today = today or datetime.now(timezone.utc).date()
+    cutoff = _add_months(today.replace(day=1), -retention_months)
+    archived = []
+    for name in _partitions_of(conn, "saga_steps"):
+        month = _month_of(name)
+        if month is None or month >= cutoff:
+            continue
+        start, end = partition_bounds(month)
+        conn.execute(text(f"ALTER TABLE saga_steps DETACH PARTITION {name}"))
+        if tablespace:
+            conn.execute(text(f"ALTER TABLE {name} SET TABLESPACE {tablespace}"))
+        conn.execute(text(
+            f"ALTER TABLE saga_steps_archive ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        archived.append(name)
+        logger.info(f"Archived partition {name}")
+    return archived
+
+
+def archive_horizon(retention_months: int = RETENTION_MONTHS, today: Optional[date] = None) -> datetime:
+    today = today or datetime.now(timezone.utc).date()
+    cutoff = _add_months(today.replace(day=1), -retention_months)
+    return datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc)
+
+
+def get_saga_steps(db: Session, order: Order) -> list:
+    steps = db.query(SagaStep).filter(SagaStep.order_id == order.id).order_by(SagaStep.started_at).all()
+    created_at = order.created_at
+    if created_at is not None and not created_at.tzinfo:
+        created_at = created_at.replace(tzinfo=timezone.utc)  # SQLite drops the offset
+    # Only orders older than the retention window can have archived steps
+    if created_at is not None and created_at >= archive_horizon():
+        return steps
+    archived = db.query(SagaStepArchive).filter(SagaStepArchive.order_id == order.id).all()
+    return sorted(archived + steps, key=lambda s: s.started_at)
+
+
+if __name__ == "__main__":
+    from app.db import get_engine
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    with get_engine().begin() as conn:
+        ensure_future_partitions(conn)
+        archive_partitions(conn)
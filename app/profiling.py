@@ -0,0 +1,193 @@
+"""On-demand profiling of single order requests.
+
+A profiled ``POST /orders`` records where its time went:
+
+* a ``cProfile`` profile of the saga, taken in the threadpool thread that runs it;
+* every SQL statement the request executed, with its duration;
+* the saga's steps with their durations, as stored in ``saga_steps``.
+
+A request is profiled when it carries the ``X-Saga-Profile`` header (honoured
+only with ``SAGA_PROFILE_HEADERS=1``) or is picked by ``SAGA_PROFILE_SAMPLE_RATE``.
+The last ``SAGA_PROFILE_BUFFER_SIZE`` profiles stay in memory for
+``GET /admin/profiles``; each worker process keeps its own.
+
+Unprofiled requests pay nothing beyond the trigger check: the SQL listeners
+are attached to engines only while some profile is being captured, and the
+current profile travels in a context variable, which the threadpool carries
+over into the saga's thread.
+"""
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, Deque, Iterator, List, Optional, Tuple, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+T = TypeVar("T")
+
+PROFILE_HEADERS_ENABLED = os.getenv("SAGA_PROFILE_HEADERS", "0") == "1"
+PROFILE_HEADER = "X-Saga-Profile"
+PROFILE_SAMPLE_RATE = float(os.getenv("SAGA_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_BUFFER_SIZE = int(os.getenv("SAGA_PROFILE_BUFFER_SIZE", "50"))
+# Functions listed in a profile's report, by cumulative time
+PROFILE_TOP_FUNCTIONS = 40
+
+_current: ContextVar[Optional["RequestProfile"]] = ContextVar("saga_profile", default=None)
+
+
+class RequestProfile:
+    def __init__(self, profile_id: int, label: str):
+        self.id = profile_id
+        self.label = label
+        self.started_at = datetime.now(timezone.utc)
+        self.duration: Optional[float] = None
+        self.order_id: Optional[int] = None
+        self.statements: List[Tuple[str, float]] = []
+        self.steps: List[Tuple[str, str, Optional[float]]] = []
+        self.report: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def add_statement(self, statement: str, seconds: float) -> None:
+        with self._lock:
+            self.statements.append((statement, seconds))
+
+    def record_steps(self, steps) -> None:
+        """Take the step breakdown from the saga's ``saga_steps`` rows."""
+        self.steps = [
+            (
+                step.step_name, step.status,
+                (step.finished_at - step.started_at).total_seconds() if step.finished_at and step.started_at else None,
+            )
+            for step in steps
+        ]
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "label": self.label,
+            "order_id": self.order_id,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "sql_count": len(self.statements),
+            "sql_ms": round(sum(seconds for _, seconds in self.statements) * 1000, 3),
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            **self.summary(),
+            "steps": [
+                {"step": name, "status": status, "duration_ms": round(seconds * 1000, 3) if seconds is not None else None}
+                for name, status, seconds in self.steps
+            ],
+            "sql": [{"statement": statement, "duration_ms": round(seconds * 1000, 3)} for statement, seconds in self.statements],
+            "profile": self.report,
+        }
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current.get()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        context._profile_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    started = getattr(context, "_profile_started", None)
+    if profile is not None and started is not None:
+        profile.add_statement(statement, time.perf_counter() - started)
+
+
+class Profiler:
+    def __init__(self, buffer_size: int = PROFILE_BUFFER_SIZE, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 headers_enabled: bool = PROFILE_HEADERS_ENABLED):
+        self.sample_rate = sample_rate
+        self.headers_enabled = headers_enabled
+        self._profiles: Deque[RequestProfile] = deque(maxlen=buffer_size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._capturing = 0
+
+    def wanted(self, headers) -> bool:
+        if self.headers_enabled and headers.get(PROFILE_HEADER) is not None:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextmanager
+    def capture(self, label: str) -> Iterator[RequestProfile]:
+        """Profile everything run inside the block, and in threads it hands its context to."""
+        profile = RequestProfile(next(self._ids), label)
+        self._attach()
+        token = _current.set(profile)
+        started = time.perf_counter()
+        try:
+            yield profile
+        finally:
+            profile.duration = time.perf_counter() - started
+            _current.reset(token)
+            self._detach()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def _attach(self) -> None:
+        # Class-level listeners reach every engine, shards included
+        with self._lock:
+            self._capturing += 1
+            if self._capturing == 1:
+                event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+                event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    def _detach(self) -> None:
+        with self._lock:
+            self._capturing -= 1
+            if self._capturing == 0:
+                event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+                event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    @staticmethod
+    def profiled(fn: Callable[..., T]) -> Callable[..., T]:
+        """``fn`` itself, or, while a profile is captured, ``fn`` wrapped in cProfile for that profile."""
+        profile = _current.get()
+        if profile is None:
+            return fn
+
+        def run(*args, **kwargs) -> T:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+                profile.report = report.getvalue()
+
+        return run
+
+    def list(self) -> List[RequestProfile]:
+        """Captured profiles, newest first."""
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def get(self, profile_id: int) -> Optional[RequestProfile]:
+        with self._lock:
+            return next((profile for profile in self._profiles if profile.id == profile_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._profiles.clear()
+
+
+profiler = Profiler()
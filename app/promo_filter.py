@@ -0,0 +1,225 @@
+"""Rejecting unknown and exhausted promo codes without a database lookup.
+
+``PromoCodeFilter`` is consulted before ``promo_codes`` is read:
+
+* a Bloom filter of every code, built from the table at startup and rebuilt
+  by ``PromoFilterRebuildJob`` every ``PROMO_BLOOM_REBUILD_INTERVAL`` seconds,
+  never on a request. It has no false negatives, so a code it has not seen
+  does not exist and bots typing random codes never reach the database. Until
+  the first build every code goes to the database;
+* a bounded LRU of codes found missing (the filter's false positives) or
+  exhausted, each kept for ``PROMO_NEGATIVE_CACHE_TTL`` seconds.
+
+A code is marked exhausted when it is read with no uses left, when a
+reservation takes its last use, or when a reservation finds none. Whatever
+creates a code or gives uses back - an insert, a top-up, a compensation, a
+settled lease - publishes a ``promo`` event on commit, which adds the code to
+the Bloom filter and drops its mark. With ``SAGA_EVENTS_NOTIFY=1`` every
+worker sees these events. Otherwise the TTL bounds how long another worker's
+top-ups go unseen, and a code another worker creates is rejected until the
+next rebuild.
+
+With several shards (see ``app/sharding.py``) each shard holds its own share
+of a code's uses, so codes are not marked exhausted: one shard running out
+says nothing about the others.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from app.db import SHARD_COUNT
+from app.events import ALL_TOPICS, EventBus, promo_event, promo_topic, publish_after_commit
+from app.models import PromoCode
+
+logger = logging.getLogger(__name__)
+
+PROMO_NEGATIVE_CACHE_SIZE = int(os.getenv("PROMO_NEGATIVE_CACHE_SIZE", "10000"))
+PROMO_NEGATIVE_CACHE_TTL = float(os.getenv("PROMO_NEGATIVE_CACHE_TTL", "60.0"))
+PROMO_BLOOM_REBUILD_INTERVAL = float(os.getenv("PROMO_BLOOM_REBUILD_INTERVAL", "60.0"))
+PROMO_BLOOM_ERROR_RATE = float(os.getenv("PROMO_BLOOM_ERROR_RATE", "0.01"))
+
+UNKNOWN = "unknown"
+EXHAUSTED = "exhausted"
+
+_PENDING_KEY = "promo_marks"
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = PROMO_BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class PromoCodeFilter:
+    def __init__(
+        self,
+        max_entries: int = PROMO_NEGATIVE_CACHE_SIZE,
+        ttl: float = PROMO_NEGATIVE_CACHE_TTL,
+        clock: Callable[[], float] = time.monotonic,
+        mark_exhausted: bool = SHARD_COUNT == 1,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.mark_exhausted = mark_exhausted
+        self._lock = threading.Lock()
+        self._marks: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._bloom: Optional[BloomFilter] = None
+        # Codes added while a rebuild reads the table, replayed onto the new filter
+        self._added_during_rebuild: Optional[List[str]] = None
+
+    def rejection(self, db: Session, code: str) -> Optional[str]:
+        """``UNKNOWN`` or ``EXHAUSTED`` when the code is known to be unusable, else ``None``."""
+        with self._lock:
+            mark = self._marks.get(code)
+            if mark is not None:
+                if mark[0] > self.clock():
+                    self._marks.move_to_end(code)
+                    return mark[1]
+                del self._marks[code]
+            if self._bloom is not None and code not in self._bloom:
+                return UNKNOWN
+        return None
+
+    def rebuild(self, db: Session) -> None:
+        with self._lock:
+            if self._added_during_rebuild is not None:
+                return  # another thread is on it; keep using the current filter
+            self._added_during_rebuild = []
+        bloom = None
+        try:
+            codes = db.execute(select(PromoCode.code)).scalars().all()
+            # Headroom for the codes added until the next rebuild
+            bloom = BloomFilter(2 * len(codes))
+            for code in codes:
+                bloom.add(code)
+        finally:
+            with self._lock:
+                if bloom is not None:
+                    for code in self._added_during_rebuild:
+                        bloom.add(code)
+                    self._bloom = bloom
+                self._added_during_rebuild = None
+
+    def mark(self, code: str, reason: str) -> None:
+        if reason == EXHAUSTED and not self.mark_exhausted:
+            return
+        with self._lock:
+            self._marks[code] = (self.clock() + self.ttl, reason)
+            self._marks.move_to_end(code)
+            while len(self._marks) > self.max_entries:
+                self._marks.popitem(last=False)
+
+    def mark_after_commit(self, db: Session, code: str, reason: str) -> None:
+        db.info.setdefault(_PENDING_KEY, []).append((self, code, reason))
+
+    def forget(self, code: str) -> None:
+        with self._lock:
+            self._marks.pop(code, None)
+            if self._bloom is not None:
+                self._bloom.add(code)
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.append(code)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._marks.clear()
+            self._bloom = None
+
+    def on_event(self, payload: dict) -> None:
+        if payload.get("type") == "promo":
+            self.forget(payload["code"])
+
+    def install(self, event_bus: EventBus) -> None:
+        event_bus.add_listener(ALL_TOPICS, self.on_event)
+
+
+promo_filter = PromoCodeFilter()
+
+
+class PromoFilterRebuildJob:
+    """Rebuilds the Bloom filter in the background, so no request waits for the scan of ``promo_codes``."""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        code_filter: PromoCodeFilter = promo_filter,
+        interval: float = PROMO_BLOOM_REBUILD_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.code_filter = code_filter
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_forever(self) -> None:
+        # Built at startup; the first rebuild is due one interval later
+        while not self._stop.wait(self.interval):
+            db = self.session_factory()
+            try:
+                self.code_filter.rebuild(db)
+            except Exception as e:
+                logger.error(f"Promo filter rebuild failed: {e}")
+            finally:
+                db.close()
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="promo-filter-rebuild", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def publish_promo_uses(db: Session, code: str) -> None:
+    publish_after_commit(db, promo_topic(code), promo_event(code))
+
+
+@event.listens_for(Session, "before_flush")
+def _publish_new_uses(session: Session, flush_context, instances) -> None:
+    for promo in session.new:
+        if isinstance(promo, PromoCode):
+            publish_promo_uses(session, promo.code)
+    for promo in session.dirty:
+        if isinstance(promo, PromoCode):
+            history = inspect(promo).attrs.remaining_uses.history
+            if history.added and history.deleted and history.added[0] > history.deleted[0]:
+                publish_promo_uses(session, promo.code)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_marks(session: Session) -> None:
+    for code_filter, code, reason in session.info.pop(_PENDING_KEY, ()):
+        code_filter.mark(code, reason)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_marks(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
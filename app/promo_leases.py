@@ -0,0 +1,150 @@
+"""Promo use leasing, the ``lease`` mode of ``promo_codes``.
+
+A popular code makes every order update the same ``promo_codes`` row. In
+``lease`` mode a worker takes a block of ``PROMO_LEASE_SIZE`` uses off
+``remaining_uses`` at once, records it as a ``promo_leases`` row and hands
+the uses out from memory, so the hot row is updated once per block. Every
+use is still a ``PromoApplication``, pointing at the lease it came from.
+
+A lease is settled - its unissued uses returned to ``remaining_uses`` and
+its row deleted - when its worker shuts down, or by whichever worker next
+takes a lease of the same code once it has expired. Unissued uses are
+``granted`` minus the applications of the lease, counted in the database,
+so uses lost to rolled back steps and leases of crashed workers come back
+too. The lease row is locked while it is settled: in PostgreSQL an
+application still being inserted under it is waited for, and one inserted
+afterwards fails its foreign key.
+
+Compensations return uses straight to ``remaining_uses``. Uses held by other
+workers are unavailable until their leases expire, so a code with few uses
+left can run out early; keep blocks small for such codes.
+
+Leases belong to the shard whose row they were taken from, so with several
+shards (see ``app/sharding.py``) each has a pool of its own, ``lease_pool``.
+"""
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import Session
+
+from app.models import PromoApplication, PromoCode, PromoLease
+from app.sharding import shard_of
+
+logger = logging.getLogger(__name__)
+
+PROMO_LEASE_SIZE = int(os.getenv("PROMO_LEASE_SIZE", "20"))
+PROMO_LEASE_TTL = float(os.getenv("PROMO_LEASE_TTL", "60.0"))
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+_PENDING_KEY = "promo_leases"
+
+
+class _Lease:
+    def __init__(self, lease_id: int, code: str, available: int, expires_at: datetime):
+        self.id = lease_id
+        self.code = code
+        self.available = available
+        self.expires_at = expires_at
+
+
+class PromoLeasePool:
+    """The leases of one worker; shared by its threads."""
+
+    def __init__(self, size: int = PROMO_LEASE_SIZE, ttl: float = PROMO_LEASE_TTL, owner: str = LEASE_OWNER):
+        self.size = size
+        self.ttl = ttl
+        self.owner = owner
+        self._leases: Dict[str, List[_Lease]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, db: Session, promo_code: str, now: Optional[datetime] = None) -> int:
+        """Hand out one use of ``promo_code``; returns the id of the lease it came from."""
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            leases = [lease for lease in self._leases.get(promo_code, ()) if lease.expires_at > now and lease.available]
+            self._leases[promo_code] = leases
+            if leases:
+                leases[0].available -= 1
+                return leases[0].id
+        return self._acquire(db, promo_code, now)
+
+    def available(self, promo_code: str) -> int:
+        with self._lock:
+            return sum(lease.available for lease in self._leases.get(promo_code, ()))
+
+    def _acquire(self, db: Session, promo_code: str, now: datetime) -> int:
+        promo = db.get(PromoCode, promo_code, populate_existing=True, with_for_update=True)
+        if not promo:
+            raise ValueError(f"Promo code {promo_code} not found")
+        expired = select(PromoLease).where(PromoLease.code == promo_code, PromoLease.expires_at <= now)
+        self._settle(db, promo, db.execute(expired.with_for_update()).scalars().all())
+        granted = min(self.size, promo.remaining_uses)
+        if granted <= 0:
+            raise ValueError(f"Promo code {promo_code} has no remaining uses")
+        promo.remaining_uses -= granted
+        lease = PromoLease(
+            code=promo_code, owner=self.owner, granted=granted, expires_at=now + timedelta(seconds=self.ttl)
+        )
+        db.add(lease)
+        db.flush()
+        # The rest of the block is handed out only once the lease is committed
+        db.info.setdefault(_PENDING_KEY, []).append((self, _Lease(lease.id, promo_code, granted - 1, lease.expires_at)))
+        logger.info(f"Leased {granted} uses of promo code {promo_code} (lease {lease.id})")
+        return lease.id
+
+    @staticmethod
+    def _settle(db: Session, promo: PromoCode, leases) -> int:
+        returned = 0
+        for lease in leases:
+            issued = db.scalar(select(func.count()).where(PromoApplication.lease_id == lease.id))
+            returned += lease.granted - issued
+            db.execute(update(PromoApplication).where(PromoApplication.lease_id == lease.id).values(lease_id=None))
+            db.delete(lease)
+        promo.remaining_uses += returned
+        db.flush()
+        return returned
+
+    def release(self, db: Session) -> int:
+        """Settle every lease of this worker, e.g. on shutdown; returns the number of uses given back."""
+        with self._lock:
+            self._leases.clear()
+        owned = db.execute(select(PromoLease.code).where(PromoLease.owner == self.owner).distinct()).scalars().all()
+        returned = 0
+        for code in sorted(owned):
+            # Promo row first, then its leases: the same order as _acquire
+            promo = db.get(PromoCode, code, populate_existing=True, with_for_update=True)
+            leases = select(PromoLease).where(PromoLease.code == code, PromoLease.owner == self.owner)
+            returned += self._settle(db, promo, db.execute(leases.with_for_update()).scalars().all())
+        db.commit()
+        return returned
+
+    def _add(self, lease: _Lease) -> None:
+        with self._lock:
+            self._leases.setdefault(lease.code, []).append(lease)
+
+
+promo_leases = PromoLeasePool()
+_shard_pools: Dict[int, PromoLeasePool] = {0: promo_leases}
+_shard_pools_lock = threading.Lock()
+
+
+def lease_pool(db: Session) -> PromoLeasePool:
+    """This worker's pool for the session's shard."""
+    with _shard_pools_lock:
+        return _shard_pools.setdefault(shard_of(db), PromoLeasePool())
+
+
+@event.listens_for(Session, "after_commit")
+def _add_committed(session: Session) -> None:
+    for pool, lease in session.info.pop(_PENDING_KEY, ()):
+        pool._add(lease)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
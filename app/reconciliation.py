@@ -0,0 +1,326 @@
+"""Reconciliation of the quantities sagas move around.
+
+Every saga step moves a quantity between two places in one transaction, so
+these per-entity totals never change:
+
+* ``stock`` - ``on_hand`` plus the quantity of ``RESERVED`` reservations, per SKU;
+* ``money`` - the ledger balance plus ``CHARGED`` payments, per user;
+* ``promo`` - ``remaining_uses`` plus ``APPLIED`` applications plus the uses
+  leases hold and have not issued yet, per promo code;
+* ``ledger`` - the sum of a user's ledger entries plus their ``CHARGED``
+  payments, which must be zero: every charge is a payment, every refund
+  cancels one.
+
+The first check of an entity records its total in ``reconciliation_baselines``;
+later checks report any entity whose total moved away from it. After a
+legitimate change such as a restock, ``reset_baselines`` records the new
+total; ``shift_baseline`` moves it along with stock or uses moved between
+shards. Money totals are in the unit money is stored in: kopecks with
+``MONEY_MINOR_UNITS=1`` (see ``app/money.py``), whose migration converts the
+recorded baselines too.
+
+Each invariant is one grouped aggregate per table, evaluated in SQL. An
+incremental check only covers entities of orders with saga steps written since
+the previous check. It reads ``saga_steps`` from a high-water mark in
+``rollup_cursors``, which stops at the first step still running, the same way
+``app/rollups.py`` does. A full check covers every entity.
+
+Run ``python -m app.reconciliation [--full]``; the exit status is 1 when
+discrepancies are found.
+"""
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import Numeric, String, and_, cast, delete, func, or_, select, type_coerce, update
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select, Subquery
+
+from app.models import (
+    BalanceLedgerEntry, InventoryItem, InventoryReservation, Order, Payment, PromoApplication, PromoCode, PromoLease,
+    ReconciliationBaseline, RollupCursor, SagaStep, User,
+)
+
+logger = logging.getLogger(__name__)
+
+# Same meaning as the STATS_ROLLUP_* settings in app/rollups.py
+RECONCILE_SETTLE_DELAY = float(os.getenv("RECONCILE_SETTLE_DELAY", "5.0"))
+RECONCILE_ABANDON_AFTER = float(os.getenv("RECONCILE_ABANDON_AFTER", "600.0"))
+
+CURSOR_NAME = "reconciliation"
+
+
+def _reserved_stock(touched: Optional[Subquery]) -> Select:
+    reserved = (
+        select(InventoryReservation.sku, func.sum(InventoryReservation.qty).label("qty"))
+        .where(InventoryReservation.status == "RESERVED")
+        .group_by(InventoryReservation.sku)
+    )
+    if touched is not None:
+        reserved = reserved.where(InventoryReservation.sku.in_(select(touched.c.sku)))
+    reserved = reserved.subquery()
+    stmt = select(
+        InventoryItem.sku.label("entity"), (InventoryItem.on_hand + func.coalesce(reserved.c.qty, 0)).label("value")
+    ).outerjoin(reserved, reserved.c.sku == InventoryItem.sku)
+    return stmt if touched is None else stmt.where(InventoryItem.sku.in_(select(touched.c.sku)))
+
+
+def _charged_by_user(touched: Optional[Subquery]) -> Subquery:
+    charged = (
+        select(Payment.user_id, func.sum(Payment.amount).label("amount"))
+        .where(Payment.status == "CHARGED")
+        .group_by(Payment.user_id)
+    )
+    if touched is not None:
+        charged = charged.where(Payment.user_id.in_(select(touched.c.user_id)))
+    return charged.subquery()
+
+
+def _held_money(touched: Optional[Subquery]) -> Select:
+    pending = (
+        select(BalanceLedgerEntry.user_id, func.sum(BalanceLedgerEntry.amount).label("amount"))
+        .join(User, User.id == BalanceLedgerEntry.user_id)
+        .where(BalanceLedgerEntry.id > User.balance_ledger_id)
+        .group_by(BalanceLedgerEntry.user_id)
+    )
+    if touched is not None:
+        pending = pending.where(BalanceLedgerEntry.user_id.in_(select(touched.c.user_id)))
+    pending = pending.subquery()
+    charged = _charged_by_user(touched)
+    stmt = (
+        select(
+            cast(User.id, String).label("entity"),
+            type_coerce(
+                User.balance + func.coalesce(pending.c.amount, 0) + func.coalesce(charged.c.amount, 0), Numeric()
+            ).label("value"),
+        )
+        .outerjoin(pending, pending.c.user_id == User.id)
+        .outerjoin(charged, charged.c.user_id == User.id)
+    )
+    return stmt if touched is None else stmt.where(User.id.in_(select(touched.c.user_id)))
+
+
+def _unmatched_ledger(touched: Optional[Subquery]) -> Select:
+    ledger = select(BalanceLedgerEntry.user_id, func.sum(BalanceLedgerEntry.amount).label("amount")).group_by(
+        BalanceLedgerEntry.user_id
+    )
+    if touched is not None:
+        ledger = ledger.where(BalanceLedgerEntry.user_id.in_(select(touched.c.user_id)))
+    ledger = ledger.subquery()
+    charged = _charged_by_user(touched)
+    stmt = (
+        select(
+            cast(User.id, String).label("entity"),
+            type_coerce(func.coalesce(ledger.c.amount, 0) + func.coalesce(charged.c.amount, 0), Numeric()).label("value"),
+        )
+        .outerjoin(ledger, ledger.c.user_id == User.id)
+        .outerjoin(charged, charged.c.user_id == User.id)
+    )
+    return stmt if touched is None else stmt.where(User.id.in_(select(touched.c.user_id)))
+
+
+def _reserved_promo_uses(touched: Optional[Subquery]) -> Select:
+    applied = (
+        select(PromoApplication.code, func.count().label("uses"))
+        .where(PromoApplication.status == "APPLIED")
+        .group_by(PromoApplication.code)
+    )
+    leased = select(PromoLease.code, func.sum(PromoLease.granted).label("uses")).group_by(PromoLease.code)
+    # Applications of outstanding leases, whatever their status: cancelled ones went back to the row
+    issued = (
+        select(PromoApplication.code, func.count().label("uses"))
+        .where(PromoApplication.lease_id.is_not(None))
+        .group_by(PromoApplication.code)
+    )
+    if touched is not None:
+        applied = applied.where(PromoApplication.code.in_(select(touched.c.promo_code)))
+        leased = leased.where(PromoLease.code.in_(select(touched.c.promo_code)))
+        issued = issued.where(PromoApplication.code.in_(select(touched.c.promo_code)))
+    applied, leased, issued = applied.subquery(), leased.subquery(), issued.subquery()
+    stmt = (
+        select(
+            PromoCode.code.label("entity"),
+            (
+                PromoCode.remaining_uses + func.coalesce(applied.c.uses, 0)
+                + func.coalesce(leased.c.uses, 0) - func.coalesce(issued.c.uses, 0)
+            ).label("value"),
+        )
+        .outerjoin(applied, applied.c.code == PromoCode.code)
+        .outerjoin(leased, leased.c.code == PromoCode.code)
+        .outerjoin(issued, issued.c.code == PromoCode.code)
+    )
+    return stmt if touched is None else stmt.where(PromoCode.code.in_(select(touched.c.promo_code)))
+
+
+class Invariant:
+    """A per-entity total; ``expected`` is fixed, or ``None`` to compare against the recorded baseline."""
+
+    def __init__(self, kind: str, totals: Callable[[Optional[Subquery]], Select], expected: Optional[Decimal] = None):
+        self.kind = kind
+        self.totals = totals
+        self.expected = expected
+
+
+INVARIANTS = (
+    Invariant("stock", _reserved_stock),
+    Invariant("money", _held_money),
+    Invariant("promo", _reserved_promo_uses),
+    Invariant("ledger", _unmatched_ledger, expected=Decimal("0")),
+)
+
+
+class Discrepancy:
+    def __init__(self, kind: str, entity: str, expected: Decimal, actual: Decimal):
+        self.kind = kind
+        self.entity = entity
+        self.expected = expected
+        self.actual = actual
+
+    @property
+    def difference(self) -> Decimal:
+        return self.actual - self.expected
+
+    def __repr__(self):
+        return f"<Discrepancy(kind={self.kind}, entity={self.entity}, expected={self.expected}, actual={self.actual})>"
+
+
+class ReconciliationReport:
+    def __init__(self, full: bool, last_id: int):
+        self.full = full
+        self.last_id = last_id
+        self.checked: Dict[str, int] = {}
+        self.baselined: Dict[str, int] = {}
+        self.discrepancies: List[Discrepancy] = []
+        self.elapsed = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.discrepancies
+
+    def format(self) -> str:
+        lines = [
+            f"{'full' if self.full else 'incremental'} check up to saga step {self.last_id} in {self.elapsed:.2f}s",
+        ]
+        for kind in self.checked:
+            lines.append(f"{kind:<8} {self.checked[kind]:>9} checked, {self.baselined.get(kind, 0)} new baselines")
+        for d in self.discrepancies:
+            lines.append(f"MISMATCH {d.kind} {d.entity}: expected {d.expected}, actual {d.actual} ({d.difference:+})")
+        return "\n".join(lines)
+
+
+class InvariantChecker:
+    def __init__(self, settle_delay: float = RECONCILE_SETTLE_DELAY, abandon_after: float = RECONCILE_ABANDON_AFTER):
+        self.settle_delay = timedelta(seconds=settle_delay)
+        self.abandon_after = timedelta(seconds=abandon_after)
+
+    def _lock_cursor(self, db: Session) -> RollupCursor:
+        # Concurrent checks would race to insert the same baselines
+        cursor = db.get(RollupCursor, CURSOR_NAME, with_for_update=True, populate_existing=True)
+        if cursor is None:
+            cursor = RollupCursor(name=CURSOR_NAME, last_id=0)
+            db.add(cursor)
+            db.flush()
+        return cursor
+
+    def _settled_id(self, db: Session, last_id: int, now: datetime) -> int:
+        """The highest step id below which every step has finished and committed."""
+        blocking = db.execute(
+            select(func.min(SagaStep.id)).where(
+                SagaStep.id > last_id,
+                or_(
+                    SagaStep.started_at > now - self.settle_delay,
+                    and_(SagaStep.status == "STARTED", SagaStep.started_at > now - self.abandon_after),
+                ),
+            )
+        ).scalar()
+        if blocking is not None:
+            return blocking - 1
+        return db.execute(select(func.max(SagaStep.id)).where(SagaStep.id > last_id)).scalar() or last_id
+
+    def check(self, db: Session, full: bool = False, now: Optional[datetime] = None) -> ReconciliationReport:
+        started = time.perf_counter()
+        now = now or datetime.now(timezone.utc)
+        cursor = self._lock_cursor(db)
+        full = full or cursor.updated_at is None
+        touched = None
+        if not full:
+            touched = (
+                select(Order.sku, Order.user_id, Order.promo_code)
+                .join(SagaStep, SagaStep.order_id == Order.id)
+                .where(SagaStep.id > cursor.last_id)
+                .subquery()
+            )
+        report = ReconciliationReport(full, self._settled_id(db, cursor.last_id, now))
+        if full or db.execute(select(touched.c.sku).limit(1)).first() is not None:
+            for invariant in INVARIANTS:
+                self._check(db, invariant, touched, report, now)
+        cursor.last_id = report.last_id
+        cursor.updated_at = now
+        db.commit()
+        report.elapsed = time.perf_counter() - started
+        for d in report.discrepancies:
+            logger.error(f"Reconciliation mismatch for {d.kind} {d.entity}: expected {d.expected}, actual {d.actual}")
+        return report
+
+    def _check(self, db: Session, invariant: Invariant, touched: Optional[Subquery],
+               report: ReconciliationReport, now: datetime) -> None:
+        totals = invariant.totals(touched).subquery()
+        report.checked[invariant.kind] = db.execute(select(func.count()).select_from(totals)).scalar()
+        if invariant.expected is not None:
+            rows = db.execute(select(totals.c.entity, totals.c.value).where(totals.c.value != invariant.expected))
+            report.discrepancies.extend(
+                Discrepancy(invariant.kind, entity, invariant.expected, Decimal(value)) for entity, value in rows
+            )
+            return
+
+        baseline = and_(ReconciliationBaseline.kind == invariant.kind, ReconciliationBaseline.entity == totals.c.entity)
+        rows = db.execute(
+            select(totals.c.entity, ReconciliationBaseline.expected, totals.c.value)
+            .outerjoin(ReconciliationBaseline, baseline)
+            .where(or_(ReconciliationBaseline.expected.is_(None), ReconciliationBaseline.expected != totals.c.value))
+        ).all()
+        new = []
+        for entity, expected, value in rows:
+            if expected is None:
+                new.append({"kind": invariant.kind, "entity": entity, "expected": value, "recorded_at": now})
+            else:
+                report.discrepancies.append(Discrepancy(invariant.kind, entity, expected, Decimal(value)))
+        if new:
+            db.bulk_insert_mappings(ReconciliationBaseline, new)
+        report.baselined[invariant.kind] = len(new)
+
+
+def reset_baselines(db: Session, kind: str, entities: Optional[List[str]] = None) -> int:
+    """Forget recorded totals so the next check records the current ones."""
+    stmt = delete(ReconciliationBaseline).where(ReconciliationBaseline.kind == kind)
+    if entities is not None:
+        stmt = stmt.where(ReconciliationBaseline.entity.in_(entities))
+    removed = db.execute(stmt).rowcount
+    db.commit()
+    return removed
+
+
+def shift_baseline(db: Session, kind: str, entity: str, delta: Decimal) -> None:
+    """Move a recorded total by a quantity deliberately moved in or out, in the caller's transaction."""
+    db.execute(
+        update(ReconciliationBaseline)
+        .where(ReconciliationBaseline.kind == kind, ReconciliationBaseline.entity == entity)
+        .values(expected=ReconciliationBaseline.expected + delta)
+    )
+
+
+if __name__ == "__main__":
+    from app.db import SessionLocal
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db = SessionLocal()
+    try:
+        report = InvariantChecker().check(db, full="--full" in sys.argv[1:])
+    finally:
+        db.close()
+    print(report.format())
+    sys.exit(0 if report.ok else 1)
@@ -0,0 +1,275 @@
+"""Per-minute rollups of saga step outcomes for the ``/stats`` API.
+
+``SagaStepRollupJob`` reads ``saga_steps`` in id order from a high-water mark
+kept in ``rollup_cursors`` and folds every finished row into
+``saga_step_rollups``, keyed by minute, step, SKU and promo code. The cursor
+stops at the first row that is still running, so each row is counted exactly
+once after it finishes. Compensation rows (``Compensate_<Step>``) are counted
+against the step they compensate.
+
+Run ``python -m app.rollups`` to catch up once, e.g. after a backfill.
+"""
+import bisect
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.models import Order, RollupCursor, SagaStep, SagaStepRollup
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_BATCH_SIZE = int(os.getenv("STATS_ROLLUP_BATCH_SIZE", "5000"))
+ROLLUP_POLL_INTERVAL = float(os.getenv("STATS_ROLLUP_POLL_INTERVAL", "10.0"))
+# Rows younger than this may still be hidden behind a concurrent transaction
+ROLLUP_SETTLE_DELAY = float(os.getenv("STATS_ROLLUP_SETTLE_DELAY", "5.0"))
+# Rows still STARTED after this long belong to crashed sagas and are skipped
+ROLLUP_ABANDON_AFTER = float(os.getenv("STATS_ROLLUP_ABANDON_AFTER", "600.0"))
+
+CURSOR_NAME = "saga_steps"
+COMPENSATION_PREFIX = "Compensate_"
+# Upper bounds of the duration histogram buckets; the last bucket is open-ended
+DURATION_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+STATS_GROUP_BY = ("step_name", "sku", "promo_code")
+
+RollupKey = Tuple[datetime, str, str, str]
+
+_steps_after = (
+    select(
+        SagaStep.id, SagaStep.step_name, SagaStep.status, SagaStep.started_at, SagaStep.finished_at,
+        Order.sku, Order.promo_code,
+    )
+    .join(Order, Order.id == SagaStep.order_id)
+    .order_by(SagaStep.id)
+)
+
+
+def minute_bucket(value: datetime) -> datetime:
+    return value.replace(second=0, microsecond=0)
+
+
+def _empty_histogram() -> List[int]:
+    return [0] * (len(DURATION_BUCKETS_MS) + 1)
+
+
+def _new_rollup(key: RollupKey) -> SagaStepRollup:
+    bucket, step_name, sku, promo_code = key
+    return SagaStepRollup(
+        bucket=bucket, step_name=step_name, sku=sku, promo_code=promo_code,
+        completed=0, failed=0, compensated=0, compensation_failed=0,
+        duration_count=0, duration_sum_ms=0, duration_max_ms=0, duration_histogram=_empty_histogram(),
+    )
+
+
+def _fold(rollup: SagaStepRollup, status: str, compensation: bool, duration_ms: Optional[int]) -> None:
+    if compensation:
+        if status == "COMPLETED":
+            rollup.compensated += 1
+        else:
+            rollup.compensation_failed += 1
+        return  # only forward steps feed the duration percentiles
+    if status == "COMPLETED":
+        rollup.completed += 1
+    else:
+        rollup.failed += 1
+    if duration_ms is not None:
+        histogram = list(rollup.duration_histogram)  # reassigned so the JSON change is flushed
+        histogram[bisect.bisect_left(DURATION_BUCKETS_MS, duration_ms)] += 1
+        rollup.duration_histogram = histogram
+        rollup.duration_count += 1
+        rollup.duration_sum_ms += duration_ms
+        rollup.duration_max_ms = max(rollup.duration_max_ms, duration_ms)
+
+
+class SagaStepRollupJob:
+    """Incrementally folds finished saga steps into per-minute rollups."""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = ROLLUP_BATCH_SIZE,
+        poll_interval: float = ROLLUP_POLL_INTERVAL,
+        settle_delay: float = ROLLUP_SETTLE_DELAY,
+        abandon_after: float = ROLLUP_ABANDON_AFTER,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.settle_delay = timedelta(seconds=settle_delay)
+        self.abandon_after = timedelta(seconds=abandon_after)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _lock_cursor(self, db: Session) -> RollupCursor:
+        # The row lock keeps concurrent jobs from folding the same steps twice
+        cursor = db.get(RollupCursor, CURSOR_NAME, with_for_update=True, populate_existing=True)
+        if cursor is None:
+            cursor = RollupCursor(name=CURSOR_NAME, last_id=0)
+            db.add(cursor)
+            db.flush()
+        return cursor
+
+    def process_batch(self, db: Session, now: Optional[datetime] = None) -> int:
+        """Fold the next batch of finished steps; returns the number of rows consumed."""
+        now = now or datetime.now(timezone.utc)
+        cursor = self._lock_cursor(db)
+        rows = db.execute(_steps_after.where(SagaStep.id > cursor.last_id).limit(self.batch_size)).all()
+
+        deltas: Dict[RollupKey, List[tuple]] = {}
+        last_id = cursor.last_id
+        consumed = 0
+        for row in rows:
+            started_at = row.started_at if row.started_at.tzinfo else row.started_at.replace(tzinfo=timezone.utc)
+            if started_at > now - self.settle_delay:
+                break
+            if row.finished_at is None or row.status == "STARTED":
+                if started_at > now - self.abandon_after:
+                    break  # still running: resume here next time
+                last_id = row.id
+                consumed += 1
+                continue
+            compensation = row.step_name.startswith(COMPENSATION_PREFIX)
+            step_name = row.step_name[len(COMPENSATION_PREFIX):] if compensation else row.step_name
+            duration_ms = max(int((row.finished_at - row.started_at).total_seconds() * 1000), 0)
+            key = (minute_bucket(row.started_at), step_name, row.sku, row.promo_code or "")
+            deltas.setdefault(key, []).append((row.status, compensation, duration_ms))
+            last_id = row.id
+            consumed += 1
+
+        if deltas:
+            self._apply(db, deltas)
+        cursor.last_id = last_id
+        cursor.updated_at = now
+        db.commit()
+        if consumed:
+            logger.info(f"Rolled up {consumed} saga steps up to id {last_id}")
+        return consumed
+
+    def _apply(self, db: Session, deltas: Dict[RollupKey, List[tuple]]) -> None:
+        buckets = [key[0] for key in deltas]
+        existing = db.execute(
+            select(SagaStepRollup).where(SagaStepRollup.bucket.between(min(buckets), max(buckets)))
+        ).scalars()
+        rollups = {(r.bucket, r.step_name, r.sku, r.promo_code): r for r in existing}
+        for key, outcomes in deltas.items():
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = _new_rollup(key)
+                db.add(rollup)
+            for status, compensation, duration_ms in outcomes:
+                _fold(rollup, status, compensation, duration_ms)
+
+    def run_forever(self) -> None:
+        while not self._stop.is_set():
+            processed = 0
+            db = self.session_factory()
+            try:
+                processed = self.process_batch(db)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Saga step rollup failed: {e}")
+            finally:
+                db.close()
+            if processed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="saga-step-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def _percentile(histogram: List[int], count: int, max_ms: int, quantile: float) -> Optional[int]:
+    """Upper bound of the histogram bucket holding the quantile."""
+    if not count:
+        return None
+    rank = quantile * count
+    seen = 0
+    for bound, bucket_count in zip(DURATION_BUCKETS_MS, histogram):
+        seen += bucket_count
+        if seen >= rank:
+            return min(bound, max_ms)
+    return max_ms
+
+
+def summarize(rollups: Iterable[SagaStepRollup], group_by: str = "step_name") -> List[dict]:
+    groups: Dict[str, SagaStepRollup] = {}
+    for rollup in rollups:
+        name = getattr(rollup, group_by)
+        total = groups.get(name)
+        if total is None:
+            total = groups[name] = _new_rollup((rollup.bucket, "", "", ""))
+        total.completed += rollup.completed
+        total.failed += rollup.failed
+        total.compensated += rollup.compensated
+        total.compensation_failed += rollup.compensation_failed
+        total.duration_count += rollup.duration_count
+        total.duration_sum_ms += rollup.duration_sum_ms
+        total.duration_max_ms = max(total.duration_max_ms, rollup.duration_max_ms)
+        total.duration_histogram = [a + b for a, b in zip(total.duration_histogram, rollup.duration_histogram)]
+
+    stats = []
+    for name, total in sorted(groups.items()):
+        runs = total.completed + total.failed
+        compensations = total.compensated + total.compensation_failed
+        stats.append({
+            group_by: name,
+            "runs": runs,
+            "failed": total.failed,
+            "failure_rate": round(total.failed / runs, 4) if runs else 0.0,
+            "compensations": compensations,
+            "compensation_failures": total.compensation_failed,
+            "compensation_rate": round(compensations / runs, 4) if runs else 0.0,
+            "avg_ms": round(total.duration_sum_ms / total.duration_count, 1) if total.duration_count else None,
+            "p50_ms": _percentile(total.duration_histogram, total.duration_count, total.duration_max_ms, 0.50),
+            "p95_ms": _percentile(total.duration_histogram, total.duration_count, total.duration_max_ms, 0.95),
+            "p99_ms": _percentile(total.duration_histogram, total.duration_count, total.duration_max_ms, 0.99),
+            "max_ms": total.duration_max_ms if total.duration_count else None,
+        })
+    return stats
+
+
+def get_stats(
+    db: Session,
+    since: datetime,
+    until: datetime,
+    group_by: str = "step_name",
+    step_name: Optional[str] = None,
+    sku: Optional[str] = None,
+    promo_code: Optional[str] = None,
+) -> List[dict]:
+    if group_by not in STATS_GROUP_BY:
+        raise ValueError(f"Unsupported group_by: {group_by}")
+    stmt = select(SagaStepRollup).where(
+        SagaStepRollup.bucket >= minute_bucket(since), SagaStepRollup.bucket < until
+    )
+    if step_name:
+        stmt = stmt.where(SagaStepRollup.step_name == step_name)
+    if sku:
+        stmt = stmt.where(SagaStepRollup.sku == sku)
+    if promo_code is not None:
+        stmt = stmt.where(SagaStepRollup.promo_code == promo_code)
+    return summarize(db.execute(stmt).scalars(), group_by)
+
+
+if __name__ == "__main__":
+    from app.db import SessionLocal
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    job = SagaStepRollupJob(SessionLocal)
+    db = SessionLocal()
+    try:
+        while job.process_batch(db) >= job.batch_size:
+            pass
+    finally:
+        db.close()
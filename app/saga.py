@@ -1,10 +1,20 @@
 import logging
+from datetime import datetime, timezone
 from typing import Optional, List
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 
-from app.models import Order
+from app.deadlines import Deadline, new_deadline
+from app.events import order_event, order_topic, publish_after_commit
+from app.faults import FaultRegistry, configured_faults
+from app.models import Order, SagaInstance, SagaStep as SagaStepModel
+from app.saga_instances import FORWARD, SagaTracker
 from app.saga_step import SagaStepBase
 from app.saga_steps import ReservePromoUseStep, ReserveInventoryStep, ChargeUserBalanceStep, FinalizeOrderStep
+from app.services.billing import BillingService
+from app.services.discounts import DiscountsService
+from app.services.inventory import InventoryService
+from app.services.orders import OrdersService
 
 logger = logging.getLogger(__name__)
 
@@ -13,44 +23,192 @@ class SagaException(Exception):
     pass
 
 
+class SagaServices:
+    """The services the saga steps call; swapped for in-memory ones by app/simulation.py."""
+
+    def __init__(self, discounts, inventory, billing, orders):
+        self.discounts = discounts
+        self.inventory = inventory
+        self.billing = billing
+        self.orders = orders
+
+    @classmethod
+    def for_session(cls, db: Session) -> "SagaServices":
+        return cls(DiscountsService(db), InventoryService(db), BillingService(db), OrdersService(db))
+
+
+class SagaContext:
+    """Entities already loaded for one saga, shared by its steps.
+
+    Sessions are created with ``expire_on_commit=False``, so these objects stay
+    loaded across the per-step commits. They are a snapshot: steps that change
+    shared rows (stock, promo uses) re-read them from the database before
+    checking, and ``refresh`` reloads the context explicitly. For that reason
+    the promo code is not carried: its step reserves a use by a locked,
+    conditional or versioned read of the row, which a loaded copy cannot spare.
+
+    ``faults`` defaults to the ``SAGA_FAULTS`` registry, which is ``None``
+    unless fault injection is configured. ``deadline`` defaults to a new
+    ``SAGA_EXECUTION_TIMEOUT`` deadline when the saga starts; the request
+    passes its own so it can cancel the saga.
+    """
+
+    def __init__(self, db: Session, order: Order, services: Optional[SagaServices] = None,
+                 faults: Optional[FaultRegistry] = None, deadline: Optional[Deadline] = None):
+        self.db = db
+        self.order = order
+        self.services = services or SagaServices.for_session(db)
+        self.faults = faults if faults is not None else configured_faults()
+        self.deadline = deadline
+
+    @classmethod
+    def load(cls, db: Session, order_id: int, services: Optional[SagaServices] = None) -> Optional["SagaContext"]:
+        order = db.get(Order, order_id)
+        if not order:
+            return None
+        return cls(db, order, services=services)
+
+    def refresh(self) -> None:
+        self.db.refresh(self.order)
+
+
+def build_steps(context: SagaContext) -> List[SagaStepBase]:
+    db, order, services = context.db, context.order, context.services
+    steps: List[SagaStepBase] = []
+    if order.promo_code:
+        steps.append(ReservePromoUseStep(db, order.id, order.promo_code, services.discounts))
+    steps.append(ReserveInventoryStep(db, order.id, order.sku, order.qty, services.inventory))
+    steps.append(ChargeUserBalanceStep(db, order.id, order.user_id, order.final_amount, services.billing))
+    steps.append(FinalizeOrderStep(db, order, services.orders))
+    if context.faults is not None:
+        for step in steps:
+            step.faults = context.faults
+    return steps
+
+
+def build_step(context: SagaContext, step_name: str) -> Optional[SagaStepBase]:
+    for step in build_steps(context):
+        if step.get_name() == step_name:
+            return step
+    return None
+
+
+def cancellation_steps(context: SagaContext) -> List[SagaStepBase]:
+    """The steps a confirmed order's cancellation compensates; FinalizeOrder has nothing to undo."""
+    return build_steps(context)[:-1]
+
+
 class OrderSaga:
     def __init__(self, db: Session):
         self.db = db
 
-    def execute(self, order_id: int, fail_at_step: Optional[str] = None) -> bool:
-        order = self.db.query(Order).filter(Order.id == order_id).first()
-        if not order:
+    def execute(self, order_id: int, fail_at_step: Optional[str] = None,
+                context: Optional[SagaContext] = None) -> bool:
+        context = context or SagaContext.load(self.db, order_id)
+        if not context:
             raise ValueError(f"Order {order_id} not found")
 
         logger.info(f"Starting saga for order {order_id}")
         
-        steps: List[SagaStepBase] = []
-        if order.promo_code:
-            steps.append(ReservePromoUseStep(self.db, order_id, order.promo_code))
-        steps.append(ReserveInventoryStep(self.db, order_id, order.sku, order.qty))
-        steps.append(ChargeUserBalanceStep(self.db, order_id, order.user_id, order.final_amount))
-        steps.append(FinalizeOrderStep(self.db, order_id))
-        
+        steps = build_steps(context)
+        tracker = SagaTracker.start(self.db, order_id, steps)
+        deadline = context.deadline if context.deadline is not None else new_deadline()
+        for step in steps:
+            step.tracker = tracker
+            step.deadline = deadline
+
         completed_steps: List[SagaStepBase] = []
         
         try:
             for step in steps:
+                if deadline is not None:
+                    deadline.check(step.get_name())
                 if fail_at_step == step.get_name():
                     raise SagaException(f"Artificial failure at step {step.get_name()}")
-                step.run()
+                try:
+                    step.run()
+                except Exception:
+                    if step.committed:
+                        completed_steps.append(step)
+                    raise
                 completed_steps.append(step)
             logger.info(f"Saga completed for order {order_id}")
             return True
         except Exception as e:
             logger.error(f"Saga failed for order {order_id}: {e}")
             self.db.rollback()
-            order = self.db.query(Order).filter(Order.id == order_id).first()
-            if order:
-                order.status = "FAILED"
+            context.order.status = "FAILED"
+            tracker.compensating(completed_steps)
             self.db.commit()
             self._compensate(completed_steps)
+            self._publish_final(order_id, "FAILED")
+            return False
+
+    def recover(self, instance: SagaInstance) -> None:
+        """Fail and compensate a saga whose worker stopped, using only its ``saga_instances`` row.
+
+        A step's effects are committed together with the row moving past it, so
+        the steps before ``step_index`` are exactly the ones to compensate in
+        ``FORWARD``; in ``COMPENSATING`` the step at ``step_index`` is still due.
+        """
+        context = SagaContext.load(self.db, instance.order_id)
+        if not context:
+            raise ValueError(f"Order {instance.order_id} not found")
+        steps = build_steps(context)
+        tracker = SagaTracker.resume(self.db, instance, steps)
+        for step in steps:
+            step.tracker = tracker
+        end = instance.step_index if instance.phase == FORWARD else instance.step_index + 1
+        completed_steps = steps[:end]
+
+        logger.warning(f"Recovering saga for order {instance.order_id} stuck in {instance.phase} at {instance.step_name}")
+        # Whatever the interrupted step did was rolled back with its transaction
+        self.db.execute(
+            update(SagaStepModel)
+            .where(SagaStepModel.order_id == instance.order_id, SagaStepModel.status == "STARTED")
+            .values(status="FAILED", error="Saga deadline exceeded", finished_at=datetime.now(timezone.utc))
+        )
+        if context.order.status != "CANCELLED":  # an interrupted cancellation stays one
+            context.order.status = "FAILED"
+        tracker.compensating(completed_steps)
+        self.db.commit()
+        self._compensate(completed_steps)
+        self._publish_final(instance.order_id, context.order.status)
+
+    def cancel(self, order_id: int, context: Optional[SagaContext] = None) -> bool:
+        """Cancel a ``CONFIRMED`` order by running its steps' compensations; False if it is not confirmed.
+
+        The order becomes ``CANCELLED`` together with the ``saga_instances`` row
+        moving to ``COMPENSATING``, so a worker stopping halfway leaves the rest
+        to recovery, and a failed compensation is queued for retry as usual.
+        Bulk cancellations do the same set-based, see ``app/cancellations.py``.
+        """
+        context = context or SagaContext.load(self.db, order_id)
+        if not context:
+            raise ValueError(f"Order {order_id} not found")
+        # Locked so that a concurrent cancellation of the same order waits and then sees it cancelled
+        self.db.refresh(context.order, with_for_update=True)
+        if context.order.status != "CONFIRMED":
+            self.db.rollback()
             return False
 
+        logger.info(f"Cancelling order {order_id}")
+        steps = cancellation_steps(context)
+        instance = self.db.get(SagaInstance, order_id)
+        if instance is not None:
+            tracker = SagaTracker.resume(self.db, instance, steps)
+        else:
+            tracker = SagaTracker.start(self.db, order_id, steps)
+        for step in steps:
+            step.tracker = tracker
+            step.deadline = context.deadline
+        context.services.orders.cancel_order(context.order)
+        tracker.compensating(steps)
+        self.db.commit()
+        self._compensate(steps)
+        self._publish_final(order_id, "CANCELLED")
+        return True
+
     def _compensate(self, completed_steps: List[SagaStepBase]) -> None:
         order_id = completed_steps[0].order_id if completed_steps else None
         if order_id:
@@ -59,3 +217,8 @@ class OrderSaga:
             step.run_compensation()
         if order_id:
             logger.info(f"Compensation completed for order {order_id}")
+
+    def _publish_final(self, order_id: int, status: str) -> None:
+        # Only once the compensations are done: a client following the order stops at its final status
+        publish_after_commit(self.db, order_topic(order_id), order_event(order_id, status))
+        self.db.commit()
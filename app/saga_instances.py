@@ -0,0 +1,100 @@
+"""Explicit saga state in ``saga_instances``.
+
+One row per order records where its saga is: the index and name of the step
+running (``FORWARD``) or to be compensated next (``COMPENSATING``), or
+``DONE``. ``SagaTracker`` changes the row right before the commit of the step
+or compensation it describes, so the row is always consistent with the step
+rows and the step's effects.
+
+Running sagas carry a ``deadline``; it is cleared once they are ``DONE``, so
+``find_stuck`` is a single range scan of ``ix_saga_instances_deadline``. A
+compensation that fails and is queued for retry does not hold the saga open:
+from then on ``compensation_retries`` tracks it.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.models import SagaInstance
+
+SAGA_DEADLINE = float(os.getenv("SAGA_DEADLINE_SECONDS", "300"))
+
+FORWARD = "FORWARD"
+COMPENSATING = "COMPENSATING"
+DONE = "DONE"
+
+
+class SagaTracker:
+    def __init__(self, db: Session, instance: SagaInstance, steps: list):
+        self.db = db
+        self.instance = instance
+        self.steps = steps
+        self._compensating: list = []
+
+    @classmethod
+    def start(cls, db: Session, order_id: int, steps: list, now: Optional[datetime] = None) -> "SagaTracker":
+        """Begin tracking; the row is written with the first step's commit."""
+        now = now or datetime.now(timezone.utc)
+        instance = SagaInstance(
+            order_id=order_id, step_index=0, step_name=steps[0].get_name(), phase=FORWARD, attempts=1,
+            deadline=now + timedelta(seconds=SAGA_DEADLINE), started_at=now,
+        )
+        db.add(instance)
+        return cls(db, instance, steps)
+
+    @classmethod
+    def resume(cls, db: Session, instance: SagaInstance, steps: list,
+               now: Optional[datetime] = None) -> "SagaTracker":
+        now = now or datetime.now(timezone.utc)
+        instance.attempts += 1
+        instance.deadline = now + timedelta(seconds=SAGA_DEADLINE)
+        instance.updated_at = now
+        return cls(db, instance, steps)
+
+    def _at(self, index: int, phase: str) -> None:
+        self.instance.step_index = index
+        self.instance.step_name = self.steps[index].get_name()
+        self.instance.phase = phase
+        self.instance.updated_at = datetime.now(timezone.utc)
+
+    def _done(self, index: int) -> None:
+        self.instance.step_index = index
+        self.instance.step_name = None
+        self.instance.phase = DONE
+        self.instance.deadline = None
+        self.instance.updated_at = datetime.now(timezone.utc)
+
+    def step_completed(self, step) -> None:
+        index = self.steps.index(step) + 1
+        if index == len(self.steps):
+            self._done(index)
+        else:
+            self._at(index, FORWARD)
+
+    def compensating(self, completed_steps: list) -> None:
+        # A rollback before the first commit discards the pending row; add it back
+        self.db.add(self.instance)
+        self._compensating = list(completed_steps)
+        if completed_steps:
+            self._at(self.steps.index(completed_steps[-1]), COMPENSATING)
+        else:
+            self._done(0)
+
+    def step_compensated(self, step) -> None:
+        position = self._compensating.index(step)
+        if position == 0:
+            self._done(0)
+        else:
+            self._at(self.steps.index(self._compensating[position - 1]), COMPENSATING)
+
+
+def find_stuck(db: Session, now: Optional[datetime] = None, limit: int = 100, lock: bool = False) -> List[SagaInstance]:
+    """Sagas past their deadline, oldest first."""
+    now = now or datetime.now(timezone.utc)
+    stmt = select(SagaInstance).where(SagaInstance.deadline < now).order_by(SagaInstance.deadline).limit(limit)
+    if lock:
+        stmt = stmt.with_for_update(skip_locked=True)
+    return list(db.execute(stmt).scalars())
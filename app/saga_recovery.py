@@ -0,0 +1,76 @@
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from app.saga import OrderSaga
+from app.saga_instances import find_stuck
+
+logger = logging.getLogger(__name__)
+
+RECOVERY_BATCH_SIZE = int(os.getenv("SAGA_RECOVERY_BATCH_SIZE", "100"))
+RECOVERY_POLL_INTERVAL = float(os.getenv("SAGA_RECOVERY_POLL_INTERVAL", "30.0"))
+
+
+class SagaRecoveryJob:
+    """Fails and compensates sagas that are past their deadline.
+
+    Stuck sagas are claimed with ``FOR UPDATE SKIP LOCKED``. Should a slow
+    worker still be running one of them, the ``saga_instances`` version check
+    fails whichever of the two commits last.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = RECOVERY_BATCH_SIZE,
+        poll_interval: float = RECOVERY_POLL_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def process_batch(self, db: Session, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now(timezone.utc)
+        stuck = find_stuck(db, now, self.batch_size, lock=True)
+        recovered = 0
+        for instance in stuck:
+            order_id = instance.order_id
+            try:
+                OrderSaga(db).recover(instance)
+                recovered += 1
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Recovery of saga for order {order_id} failed: {e}")
+        db.commit()
+        return recovered
+
+    def run_forever(self) -> None:
+        while not self._stop.is_set():
+            processed = 0
+            db = self.session_factory()
+            try:
+                processed = self.process_batch(db)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Saga recovery batch failed: {e}")
+            finally:
+                db.close()
+            if processed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="saga-recovery", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
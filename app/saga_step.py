@@ -1,13 +1,26 @@
 import logging
 from abc import ABC, abstractmethod
 from datetime import datetime, timezone
+from typing import Optional
 from sqlalchemy.orm import Session
-from app.models import SagaStep as SagaStepModel
+from app.deadlines import Deadline, apply_timeouts, step_timeout
+from app.events import order_topic, publish_after_commit, step_event
+from app.faults import AFTER_COMMIT, AFTER_EXECUTE, BEFORE_COMMIT, BEFORE_EXECUTE, COMPENSATE, FaultRegistry
+from app.models import SagaStep as SagaStepModel, CompensationRetry
 
 logger = logging.getLogger(__name__)
 
 
 class SagaStepBase(ABC):
+    # Set by build_steps when fault injection is on
+    faults: Optional[FaultRegistry] = None
+    # True once the step's changes are committed, even if the step then fails
+    committed = False
+    # Set by OrderSaga; moves the saga_instances row along with each commit
+    tracker = None
+    # Set by OrderSaga; bounds the step's transaction, see app/deadlines.py
+    deadline: Optional[Deadline] = None
+
     def __init__(self, db: Session, order_id: int):
         self.db = db
         self.order_id = order_id
@@ -26,46 +39,110 @@ class SagaStepBase(ABC):
 
     def run(self) -> None:
         step_name = self.get_name()
+        faults = self.faults
+        deadline = self.deadline
         logger.info(f"Executing step: {step_name}")
-        
+
+        started_at = datetime.now(timezone.utc)
         step = SagaStepModel(
             order_id=self.order_id,
             step_name=step_name,
             status="STARTED",
-            started_at=datetime.now(timezone.utc),
+            started_at=started_at,
         )
         self.db.add(step)
+        self._publish(step_name, "STARTED", started_at=started_at)
         self.db.commit()
 
         try:
+            if deadline is not None:
+                deadline.apply(self.db, step_name)
+            if faults is not None:
+                faults.inject(step_name, BEFORE_EXECUTE)
             self.execute()
+            if faults is not None:
+                faults.inject(step_name, AFTER_EXECUTE)
             step.status = "COMPLETED"
             step.finished_at = datetime.now(timezone.utc)
+            self._publish(step_name, "COMPLETED", started_at=started_at, finished_at=step.finished_at)
+            if self.tracker is not None:
+                self.tracker.step_completed(self)
+            if faults is not None:
+                faults.inject(step_name, BEFORE_COMMIT)
+            if deadline is not None:
+                # Past the deadline the step is rolled back and compensation starts
+                deadline.check(step_name)
             self.db.commit()
+            self.committed = True
+            if faults is not None:
+                faults.inject(step_name, AFTER_COMMIT)
             logger.info(f"Step {step_name} completed")
         except Exception as e:
+            if self.committed:
+                # Nothing to roll back: the saga has to compensate this step like a completed one
+                logger.error(f"Step {step_name} failed after commit: {e}")
+                raise
             self.db.rollback()
             step.status = "FAILED"
             step.error = str(e)
             step.finished_at = datetime.now(timezone.utc)
+            self._publish(step_name, "FAILED", str(e), started_at, step.finished_at)
             self.db.commit()
             logger.error(f"Step {step_name} failed: {e}")
             raise
 
+    def _publish(self, step_name: str, status: str, error: Optional[str] = None,
+                 started_at: Optional[datetime] = None, finished_at: Optional[datetime] = None) -> None:
+        publish_after_commit(
+            self.db, order_topic(self.order_id),
+            step_event(self.order_id, step_name, status, error, started_at, finished_at),
+        )
+
     def run_compensation(self) -> None:
         step_name = self.get_name()
         try:
             logger.info(f"Compensating step: {step_name}")
+            if self.deadline is not None:
+                apply_timeouts(self.db, step_timeout(step_name))
+            if self.faults is not None:
+                self.faults.inject(step_name, COMPENSATE)
             self.compensate()
+            now = datetime.now(timezone.utc)
             comp_step = SagaStepModel(
                 order_id=self.order_id, step_name=f"Compensate_{step_name}",
                 status="COMPLETED",
-                started_at=datetime.now(timezone.utc),
-                finished_at=datetime.now(timezone.utc),
+                started_at=now,
+                finished_at=now,
             )
             self.db.add(comp_step)
+            self._publish(f"Compensate_{step_name}", "COMPLETED", started_at=now, finished_at=now)
+            if self.tracker is not None:
+                self.tracker.step_compensated(self)
             self.db.commit()
             logger.info(f"Compensation for {step_name} completed")
         except Exception as e:
             self.db.rollback()
             logger.error(f"Compensation for {step_name} failed: {e}")
+            self._enqueue_compensation_retry(e)
+
+    def _enqueue_compensation_retry(self, error: Exception) -> None:
+        step_name = self.get_name()
+        now = datetime.now(timezone.utc)
+        try:
+            self.db.add(SagaStepModel(
+                order_id=self.order_id, step_name=f"Compensate_{step_name}",
+                status="FAILED", error=str(error),
+                started_at=now, finished_at=now,
+            ))
+            self.db.add(CompensationRetry(
+                order_id=self.order_id, step_name=step_name,
+                status="PENDING", last_error=str(error), next_attempt_at=now,
+            ))
+            self._publish(f"Compensate_{step_name}", "FAILED", str(error), now, now)
+            if self.tracker is not None:
+                self.tracker.step_compensated(self)
+            self.db.commit()
+            logger.info(f"Compensation for {step_name} queued for retry")
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Failed to queue compensation retry for {step_name}: {e}")
@@ -1,17 +1,19 @@
 from decimal import Decimal
+from typing import Optional
 from sqlalchemy.orm import Session
 from app.saga_step import SagaStepBase
 from app.services.discounts import DiscountsService
 from app.services.inventory import InventoryService
 from app.services.billing import BillingService
+from app.services.orders import OrdersService
 from app.models import Order
 
 
 class ReservePromoUseStep(SagaStepBase):
-    def __init__(self, db: Session, order_id: int, promo_code: str):
+    def __init__(self, db: Session, order_id: int, promo_code: str, service: Optional[DiscountsService] = None):
         super().__init__(db, order_id)
         self.promo_code = promo_code
-        self.service = DiscountsService(db)
+        self.service = service or DiscountsService(db)
 
     def execute(self) -> None:
         self.service.reserve_promo_use(self.order_id, self.promo_code)
@@ -24,11 +26,11 @@ class ReservePromoUseStep(SagaStepBase):
 
 
 class ReserveInventoryStep(SagaStepBase):
-    def __init__(self, db: Session, order_id: int, sku: str, qty: int):
+    def __init__(self, db: Session, order_id: int, sku: str, qty: int, service: Optional[InventoryService] = None):
         super().__init__(db, order_id)
         self.sku = sku
         self.qty = qty
-        self.service = InventoryService(db)
+        self.service = service or InventoryService(db)
 
     def execute(self) -> None:
         self.service.reserve_inventory(self.order_id, self.sku, self.qty)
@@ -41,11 +43,12 @@ class ReserveInventoryStep(SagaStepBase):
 
 
 class ChargeUserBalanceStep(SagaStepBase):
-    def __init__(self, db: Session, order_id: int, user_id: int, amount: Decimal):
+    def __init__(self, db: Session, order_id: int, user_id: int, amount: Decimal,
+                 service: Optional[BillingService] = None):
         super().__init__(db, order_id)
         self.user_id = user_id
         self.amount = amount
-        self.service = BillingService(db)
+        self.service = service or BillingService(db)
 
     def execute(self) -> None:
         self.service.charge_user_balance(self.order_id, self.user_id, self.amount)
@@ -58,14 +61,13 @@ class ChargeUserBalanceStep(SagaStepBase):
 
 
 class FinalizeOrderStep(SagaStepBase):
-    def __init__(self, db: Session, order_id: int):
-        super().__init__(db, order_id)
+    def __init__(self, db: Session, order: Order, service: Optional[OrdersService] = None):
+        super().__init__(db, order.id)
+        self.order = order
+        self.service = service or OrdersService(db)
 
     def execute(self) -> None:
-        order = self.db.query(Order).filter(Order.id == self.order_id).first()
-        if order:
-            order.status = "CONFIRMED"
-            self.db.flush()
+        self.service.confirm_order(self.order)
 
     def compensate(self) -> None:
         pass
@@ -1,31 +1,249 @@
 import logging
+from datetime import datetime, timezone
 from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import bindparam, func, select, text, type_coerce, update
 from sqlalchemy.orm import Session
-from app.models import User, Payment
+from sqlalchemy.orm.attributes import flag_modified
+from app.coalescing import BalanceCoalescer, balance_coalescer
+from app.concurrency import OPTIMISTIC, concurrency_mode, retry_on_stale
+from app.models import User, Payment, BalanceLedgerEntry, BalanceSnapshot
+from app.money import ZERO
 
 logger = logging.getLogger(__name__)
 
+# Namespace for pg_advisory_xact_lock(namespace, user_id)
+BALANCE_LOCK_NAMESPACE = 7001
+
+
+_pending_delta = (
+    select(func.coalesce(func.sum(BalanceLedgerEntry.amount), 0))
+    .where(BalanceLedgerEntry.user_id == User.id, BalanceLedgerEntry.id > User.balance_ledger_id)
+    .correlate(User)
+    .scalar_subquery()
+)
+
+# Arithmetic on money columns is typed by the column's plain SQL type; this keeps it read as money
+_current_balance = type_coerce(User.balance + _pending_delta, User.balance.type)
+
+# Built once at import; SQLAlchemy caches their compiled form
+_balance_by_user = select(_current_balance).where(User.id == bindparam("user_id"))
+_advisory_lock = text("SELECT pg_advisory_xact_lock(:namespace, :user_id)")
+_payment_by_order = select(Payment).where(
+    Payment.order_id == bindparam("order_id"), Payment.user_id == bindparam("user_id")
+)
+
 
 class BillingService:
-    def __init__(self, db: Session):
+    """User balances kept as an append-only ledger.
+
+    ``users.balance`` is a snapshot as of ``users.balance_ledger_id``; the current
+    balance is that snapshot plus the ledger entries written after it. Charges and
+    refunds only insert ledger entries, and ``compact_balances`` periodically folds
+    them into new snapshots.
+
+    Writers are serialized per user with an advisory lock, or in optimistic
+    mode by bumping ``users.version`` before reading the balance, so a
+    concurrent writer fails the version check and the operation is retried.
+    Concurrent charges of one user can be coalesced, see app/coalescing.py.
+    """
+
+    def __init__(self, db: Session, coalescer: Optional[BalanceCoalescer] = None):
         self.db = db
+        self.coalescer = coalescer or balance_coalescer
+
+    def _lock_user(self, user_id: int) -> None:
+        # Serializes balance checks per user without updating the users row
+        if self.db.get_bind().dialect.name == "postgresql":
+            self.db.execute(_advisory_lock, {"namespace": BALANCE_LOCK_NAMESPACE, "user_id": user_id})
+
+    def _guard_user(self, user_id: int) -> None:
+        if concurrency_mode("users") != OPTIMISTIC:
+            self._lock_user(user_id)
+            return
+        user = self.db.get(User, user_id, populate_existing=True)
+        if user:
+            # Flushed right away so the balance read below sees every write that passed this check
+            flag_modified(user, "balance_ledger_id")
+            self.db.flush()
+
+    def _guarded(self, operation) -> None:
+        if concurrency_mode("users") == OPTIMISTIC:
+            retry_on_stale(self.db, operation)
+        else:
+            operation()
+
+    def get_balance(self, user_id: int) -> Optional[Decimal]:
+        return self.db.execute(_balance_by_user, {"user_id": user_id}).scalar()
+
+    def get_balances(self, user_ids: Optional[Iterable[int]] = None) -> Dict[int, Decimal]:
+        stmt = select(User.id, _current_balance)
+        if user_ids is not None:
+            stmt = stmt.where(User.id.in_(list(user_ids)))
+        return {user_id: balance for user_id, balance in self.db.execute(stmt)}
+
+    def get_balance_at(self, user_id: int, at: datetime) -> Optional[Decimal]:
+        snapshot = self.db.execute(
+            select(BalanceSnapshot)
+            .where(BalanceSnapshot.user_id == user_id, BalanceSnapshot.created_at <= at)
+            .order_by(BalanceSnapshot.created_at.desc())
+            .limit(1)
+        ).scalar()
+        if snapshot:
+            delta = self.db.execute(
+                select(func.coalesce(func.sum(BalanceLedgerEntry.amount), 0)).where(
+                    BalanceLedgerEntry.user_id == user_id,
+                    BalanceLedgerEntry.id > snapshot.ledger_id,
+                    BalanceLedgerEntry.created_at <= at,
+                )
+            ).scalar()
+            return snapshot.balance + delta
+        # No snapshot that old: walk back from the current balance
+        current = self.get_balance(user_id)
+        if current is None:
+            return None
+        later = self.db.execute(
+            select(func.coalesce(func.sum(BalanceLedgerEntry.amount), 0)).where(
+                BalanceLedgerEntry.user_id == user_id, BalanceLedgerEntry.created_at > at
+            )
+        ).scalar()
+        return current - later
 
     def charge_user_balance(self, order_id: int, user_id: int, amount: Decimal) -> None:
-        user = self.db.query(User).filter(User.id == user_id).first()
-        if not user:
+        if self.coalescer.enabled:
+            self.coalescer.charge(self, order_id, user_id, amount)
+        else:
+            self._guarded(lambda: self._charge(order_id, user_id, amount))
+
+    def charge_unless_charged(self, order_id: int, user_id: int, amount: Decimal) -> None:
+        """Charge alone, unless the order already has a payment, e.g. from a batch that committed late."""
+        self._guarded(lambda: self._charge(order_id, user_id, amount, check_payment=True))
+
+    def _charge(self, order_id: int, user_id: int, amount: Decimal, check_payment: bool = False) -> None:
+        self._guard_user(user_id)
+        if check_payment and self.db.execute(_payment_by_order, {"order_id": order_id, "user_id": user_id}).scalar():
+            return
+        balance = self.get_balance(user_id)
+        if balance is None:
             raise ValueError(f"User {user_id} not found")
-        if user.balance < amount:
-            raise ValueError(f"Insufficient balance for user {user_id}. Balance: {user.balance}, Required: {amount}")
-        user.balance -= amount
+        if balance < amount:
+            raise ValueError(f"Insufficient balance for user {user_id}. Balance: {balance}, Required: {amount}")
+        self.db.add(BalanceLedgerEntry(user_id=user_id, order_id=order_id, amount=-amount, kind="CHARGE"))
         self.db.add(Payment(order_id=order_id, user_id=user_id, amount=amount, status="CHARGED"))
         self.db.flush()
 
+    def charge_many(self, user_id: int, charges: List[Tuple[int, Decimal]]) -> List[Optional[str]]:
+        """Charge several orders of one user, in order, after one balance check; returns each order's error or ``None``."""
+        errors: List[Optional[str]] = []
+
+        def charge() -> None:
+            errors[:] = self._charge_many(user_id, charges)
+
+        self._guarded(charge)
+        return errors
+
+    def _charge_many(self, user_id: int, charges: List[Tuple[int, Decimal]]) -> List[Optional[str]]:
+        self._guard_user(user_id)
+        # Orders that charged themselves meanwhile, e.g. after leaving the batch
+        paid = set(self.db.execute(
+            select(Payment.order_id).where(Payment.order_id.in_([order_id for order_id, _ in charges]))
+        ).scalars())
+        balance = self.get_balance(user_id)
+        errors = []
+        for order_id, amount in charges:
+            if order_id in paid:
+                errors.append(None)
+            elif balance is None:
+                errors.append(f"User {user_id} not found")
+            elif balance < amount:
+                errors.append(f"Insufficient balance for user {user_id}. Balance: {balance}, Required: {amount}")
+            else:
+                balance -= amount
+                self.db.add(BalanceLedgerEntry(user_id=user_id, order_id=order_id, amount=-amount, kind="CHARGE"))
+                self.db.add(Payment(order_id=order_id, user_id=user_id, amount=amount, status="CHARGED"))
+                errors.append(None)
+        self.db.flush()
+        return errors
+
     def refund_payment(self, order_id: int, user_id: int, amount: Decimal) -> None:
-        user = self.db.query(User).filter(User.id == user_id).first()
-        if not user:
+        payment = self.db.execute(_payment_by_order, {"order_id": order_id, "user_id": user_id}).scalar()
+        if not payment or payment.status == "REFUNDED":
+            return  # nothing charged, or already compensated by a retried compensation
+        self._guarded(lambda: self._refund(payment, user_id, amount))
+
+    def _refund(self, payment: Payment, user_id: int, amount: Decimal) -> None:
+        self._guard_user(user_id)
+        self.db.add(BalanceLedgerEntry(user_id=user_id, order_id=payment.order_id, amount=amount, kind="REFUND"))
+        payment.status = "REFUNDED"
+        self.db.flush()
+
+    def refund_many(self, order_ids: List[int]) -> Dict[int, Decimal]:
+        """Refund the payments of many orders with one ledger entry per user; returns the amount per user."""
+        payments = self.db.execute(
+            select(Payment.id, Payment.user_id, Payment.amount)
+            .where(Payment.order_id.in_(order_ids), Payment.status == "CHARGED")
+            .order_by(Payment.id)
+            .with_for_update()
+        ).all()
+        refunds: Dict[int, Decimal] = {}
+        for _, user_id, amount in payments:
+            refunds[user_id] = refunds.get(user_id, ZERO) + amount
+        # Sorted, so concurrent batches take the users' locks in the same order
+        for user_id in sorted(refunds):
+            self._guarded(lambda: self._refund_user(user_id, refunds[user_id]))
+        if payments:
+            self.db.execute(
+                update(Payment).where(Payment.id.in_([p.id for p in payments])).values(status="REFUNDED")
+            )
+        return refunds
+
+    def _refund_user(self, user_id: int, amount: Decimal) -> None:
+        self._guard_user(user_id)
+        # Covers several orders, so it names none; the payments it cancels are marked REFUNDED
+        self.db.add(BalanceLedgerEntry(user_id=user_id, order_id=None, amount=amount, kind="REFUND"))
+        self.db.flush()
+
+    def compact_balances(self, batch_size: int = 200) -> int:
+        """Fold ledger entries into new per-user snapshots; returns the number of users compacted."""
+        user_ids = self.db.execute(
+            select(BalanceLedgerEntry.user_id)
+            .join(User, User.id == BalanceLedgerEntry.user_id)
+            .where(BalanceLedgerEntry.id > User.balance_ledger_id)
+            .group_by(BalanceLedgerEntry.user_id)
+            .limit(batch_size)
+        ).scalars().all()
+        now = datetime.now(timezone.utc)
+        for user_id in user_ids:
+            # Optimistic writers do not take the lock; the version check catches them instead
+            retry_on_stale(self.db, lambda: self._compact_user(user_id, now))
+        self.db.commit()
+        if user_ids:
+            logger.info(f"Compacted balances of {len(user_ids)} users")
+        return len(user_ids)
+
+    def _compact_user(self, user_id: int, now: datetime) -> None:
+        # Holding the user's lock guarantees no locked writer's entry is still in flight
+        self._lock_user(user_id)
+        user = self.db.get(User, user_id, populate_existing=True)
+        delta, last_id = self.db.execute(
+            select(func.coalesce(func.sum(BalanceLedgerEntry.amount), 0), func.max(BalanceLedgerEntry.id))
+            .where(BalanceLedgerEntry.user_id == user_id, BalanceLedgerEntry.id > user.balance_ledger_id)
+        ).one()
+        if last_id is None:
             return
-        user.balance += amount
-        payment = self.db.query(Payment).filter(Payment.order_id == order_id, Payment.user_id == user_id).first()
-        if payment:
-            payment.status = "REFUNDED"
+        user.balance += delta
+        user.balance_ledger_id = last_id
+        self.db.add(BalanceSnapshot(user_id=user_id, balance=user.balance, ledger_id=last_id, created_at=now))
         self.db.flush()
+
+
+if __name__ == "__main__":
+    from app.db import SessionLocal
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db = SessionLocal()
+    try:
+        while BillingService(db).compact_balances():
+            pass
+    finally:
+        db.close()
@@ -1,41 +1,172 @@
 import logging
-from decimal import Decimal
+from typing import Dict, List, Optional
+from sqlalchemy import bindparam, select, update
 from sqlalchemy.orm import Session
-from app.models import PromoCode, PromoApplication
+from app.concurrency import ATOMIC, LEASE, LOCK, OPTIMISTIC, apply_returned, concurrency_mode, retry_on_stale
+from app.models import PromoCode, PromoApplication, PromoLease
+from app.promo_filter import EXHAUSTED, UNKNOWN, PromoCodeFilter, promo_filter, publish_promo_uses
+from app.promo_leases import PromoLeasePool, lease_pool
 
 logger = logging.getLogger(__name__)
 
+# Built once at import; SQLAlchemy caches their compiled form
+_application_by_order = select(PromoApplication).where(
+    PromoApplication.order_id == bindparam("order_id"), PromoApplication.code == bindparam("code")
+)
+_locked_application_by_order = _application_by_order.with_for_update()
+_any_lease = select(PromoLease.id).where(PromoLease.code == bindparam("code")).limit(1)
+# Atomic mode, see InventoryService
+_take_use = (
+    update(PromoCode)
+    .where(PromoCode.code == bindparam("promo_code"), PromoCode.remaining_uses > 0)
+    .values(remaining_uses=PromoCode.remaining_uses - 1, version=PromoCode.version + 1)
+    .returning(PromoCode.remaining_uses, PromoCode.version)
+    .execution_options(synchronize_session=False)
+)
+_return_use = (
+    update(PromoCode)
+    .where(PromoCode.code == bindparam("promo_code"))
+    .values(remaining_uses=PromoCode.remaining_uses + 1, version=PromoCode.version + 1)
+    .returning(PromoCode.remaining_uses, PromoCode.version)
+    .execution_options(synchronize_session=False)
+)
+_return_uses = (
+    update(PromoCode)
+    .where(PromoCode.code == bindparam("promo_code"))
+    .values(remaining_uses=PromoCode.remaining_uses + bindparam("uses"), version=PromoCode.version + 1)
+    .returning(PromoCode.remaining_uses, PromoCode.version)
+    .execution_options(synchronize_session=False)
+)
+
+
+class PromoCodeUnavailable(ValueError):
+    def __init__(self, promo_code: str, reason: str):
+        self.promo_code = promo_code
+        self.reason = reason  # UNKNOWN or EXHAUSTED
+        if reason == UNKNOWN:
+            super().__init__(f"Promo code {promo_code} not found")
+        else:
+            super().__init__(f"Promo code {promo_code} has no remaining uses")
+
 
 class DiscountsService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, leases: Optional[PromoLeasePool] = None,
+                 code_filter: Optional[PromoCodeFilter] = None):
         self.db = db
+        self.leases = leases or lease_pool(db)
+        self.code_filter = code_filter or promo_filter
 
-    def calculate_discount(self, promo_code: str | None, base_amount: Decimal) -> Decimal:
-        if not promo_code:
-            return Decimal("0")
-        promo = self.db.query(PromoCode).filter(PromoCode.code == promo_code).first()
-        if not promo or promo.remaining_uses <= 0:
-            return Decimal("0")
-        return promo.discount_amount
+    def check_promo(self, promo_code: str) -> PromoCode:
+        """The promo code if it can be used; unknown and exhausted codes are mostly rejected from memory."""
+        reason = self.code_filter.rejection(self.db, promo_code)
+        if reason is not None:
+            raise PromoCodeUnavailable(promo_code, reason)
+        promo = self.db.get(PromoCode, promo_code)
+        if not promo:
+            self.code_filter.mark(promo_code, UNKNOWN)
+            raise PromoCodeUnavailable(promo_code, UNKNOWN)
+        if promo.remaining_uses <= 0 and not self._leased(promo_code):
+            self.code_filter.mark(promo_code, EXHAUSTED)
+            raise PromoCodeUnavailable(promo_code, EXHAUSTED)
+        return promo
+
+    def _leased(self, promo_code: str) -> bool:
+        # Uses may be sitting in leases while the row shows none left
+        if concurrency_mode("promo_codes") != LEASE:
+            return False
+        if self.leases.available(promo_code):
+            return True
+        return self.db.execute(_any_lease, {"code": promo_code}).first() is not None
 
     def reserve_promo_use(self, order_id: int, promo_code: str) -> None:
-        promo = self.db.query(PromoCode).filter(PromoCode.code == promo_code).first()
-        if not promo:
-            raise ValueError(f"Promo code {promo_code} not found")
-        if promo.remaining_uses <= 0:
-            raise ValueError(f"Promo code {promo_code} has no remaining uses")
+        mode = concurrency_mode("promo_codes")
+        lease_id = None
+        if mode == LEASE:
+            lease_id = self.leases.take(self.db, promo_code)
+        elif mode == ATOMIC:
+            taken = self.db.execute(_take_use, {"promo_code": promo_code}).first()
+            if taken is None:
+                self._raise_unavailable(self.db.get(PromoCode, promo_code, populate_existing=True), promo_code)
+            apply_returned(self.db, PromoCode, promo_code, taken)
+            if taken.remaining_uses == 0:
+                self.code_filter.mark_after_commit(self.db, promo_code, EXHAUSTED)
+        elif mode == OPTIMISTIC:
+            retry_on_stale(self.db, lambda: self._take_loaded(promo_code, lock=False))
+        else:
+            self._take_loaded(promo_code, lock=True)
+        self.db.add(PromoApplication(order_id=order_id, code=promo_code, status="APPLIED", lease_id=lease_id))
+        self.db.flush()
+
+    def _take_loaded(self, promo_code: str, lock: bool) -> None:
+        promo = self.db.get(PromoCode, promo_code, populate_existing=True, with_for_update=lock)
+        if not promo or promo.remaining_uses <= 0:
+            self._raise_unavailable(promo, promo_code)
         promo.remaining_uses -= 1
-        self.db.add(PromoApplication(order_id=order_id, code=promo_code, status="APPLIED"))
         self.db.flush()
+        if promo.remaining_uses == 0:
+            self.code_filter.mark_after_commit(self.db, promo_code, EXHAUSTED)
+
+    def _raise_unavailable(self, promo: PromoCode | None, promo_code: str) -> None:
+        reason = EXHAUSTED if promo else UNKNOWN
+        self.code_filter.mark(promo_code, reason)
+        raise PromoCodeUnavailable(promo_code, reason)
 
     def release_promo_use(self, order_id: int, promo_code: str) -> None:
-        promo = self.db.query(PromoCode).filter(PromoCode.code == promo_code).first()
-        if not promo:
-            return
-        promo.remaining_uses += 1
-        application = self.db.query(PromoApplication).filter(
-            PromoApplication.order_id == order_id, PromoApplication.code == promo_code
-        ).first()
+        mode = concurrency_mode("promo_codes")
+        if mode == LEASE:
+            mode = ATOMIC  # the use goes back to the row, not to a lease
+        if mode == OPTIMISTIC:
+            retry_on_stale(self.db, lambda: self._release(order_id, promo_code, mode))
+        else:
+            self._release(order_id, promo_code, mode)
+
+    def _release(self, order_id: int, promo_code: str, mode: str) -> None:
+        promo = None
+        if mode != ATOMIC:
+            promo = self.db.get(PromoCode, promo_code, populate_existing=True, with_for_update=mode == LOCK)
+            if not promo:
+                return
+        application = self.db.execute(
+            _locked_application_by_order if mode == ATOMIC else _application_by_order,
+            {"order_id": order_id, "code": promo_code},
+        ).scalar()
+        if application and application.status == "CANCELLED":
+            return  # already compensated, e.g. by a retried compensation
+        if promo is not None:
+            promo.remaining_uses += 1
+        else:
+            returned = self.db.execute(_return_use, {"promo_code": promo_code}).first()
+            if returned is None:
+                return
+            apply_returned(self.db, PromoCode, promo_code, returned)
+            publish_promo_uses(self.db, promo_code)  # ORM changes publish from a flush hook
         if application:
             application.status = "CANCELLED"
         self.db.flush()
+
+    def release_many(self, order_ids: List[int]) -> Dict[str, int]:
+        """Give back the uses of many orders with one update per code; returns the uses per code.
+
+        Uses always go back to the row, as ``release_promo_use`` does in lease mode.
+        """
+        applications = self.db.execute(
+            select(PromoApplication.id, PromoApplication.code)
+            .where(PromoApplication.order_id.in_(order_ids), PromoApplication.status == "APPLIED")
+            .order_by(PromoApplication.id)
+            .with_for_update()
+        ).all()
+        released: Dict[str, int] = {}
+        for _, code in applications:
+            released[code] = released.get(code, 0) + 1
+        if applications:
+            self.db.execute(
+                update(PromoApplication)
+                .where(PromoApplication.id.in_([a.id for a in applications]))
+                .values(status="CANCELLED")
+            )
+        for code in sorted(released):
+            returned = self.db.execute(_return_uses, {"promo_code": code, "uses": released[code]}).first()
+            if returned is not None:
+                apply_returned(self.db, PromoCode, code, returned)
+                publish_promo_uses(self.db, code)
+        return released
@@ -1,32 +1,124 @@
 import logging
+from typing import Dict, List
+from sqlalchemy import bindparam, select, update
 from sqlalchemy.orm import Session
+from app.concurrency import ATOMIC, LOCK, OPTIMISTIC, apply_returned, concurrency_mode, retry_on_stale
 from app.models import InventoryItem, InventoryReservation
+from app.stock_view import publish_stock
 
 logger = logging.getLogger(__name__)
 
+# Built once at import; SQLAlchemy caches their compiled form
+_reservation_by_order = select(InventoryReservation).where(
+    InventoryReservation.order_id == bindparam("order_id"), InventoryReservation.sku == bindparam("sku")
+)
+_locked_reservation_by_order = _reservation_by_order.with_for_update()
+# Atomic mode: the WHERE clause is the availability check; the version bump
+# keeps optimistic readers of the same row honest. Both return the new
+# stock for the stock view (ORM changes publish from a flush hook) and for
+# the session's loaded copy of the item
+_take_stock = (
+    update(InventoryItem)
+    .where(InventoryItem.sku == bindparam("item_sku"), InventoryItem.on_hand >= bindparam("qty"))
+    .values(on_hand=InventoryItem.on_hand - bindparam("qty"), version=InventoryItem.version + 1)
+    .returning(InventoryItem.on_hand, InventoryItem.version)
+    .execution_options(synchronize_session=False)
+)
+_return_stock = (
+    update(InventoryItem)
+    .where(InventoryItem.sku == bindparam("item_sku"))
+    .values(on_hand=InventoryItem.on_hand + bindparam("qty"), version=InventoryItem.version + 1)
+    .returning(InventoryItem.on_hand, InventoryItem.version)
+    .execution_options(synchronize_session=False)
+)
+
 
 class InventoryService:
     def __init__(self, db: Session):
         self.db = db
 
     def reserve_inventory(self, order_id: int, sku: str, qty: int) -> None:
-        item = self.db.query(InventoryItem).filter(InventoryItem.sku == sku).first()
-        if not item:
-            raise ValueError(f"Item {sku} not found in inventory")
-        if item.on_hand < qty:
-            raise ValueError(f"Insufficient inventory for {sku}. Available: {item.on_hand}, Requested: {qty}")
-        item.on_hand -= qty
+        mode = concurrency_mode("inventory_items")
+        if mode == ATOMIC:
+            taken = self.db.execute(_take_stock, {"item_sku": sku, "qty": qty}).first()
+            if taken is None:
+                self._raise_unavailable(self.db.get(InventoryItem, sku, populate_existing=True), sku, qty)
+            apply_returned(self.db, InventoryItem, sku, taken)
+            publish_stock(self.db, sku, *taken)
+        elif mode == OPTIMISTIC:
+            retry_on_stale(self.db, lambda: self._take_loaded(sku, qty, lock=False))
+        else:
+            self._take_loaded(sku, qty, lock=True)
         self.db.add(InventoryReservation(order_id=order_id, sku=sku, qty=qty, status="RESERVED"))
         self.db.flush()
 
-    def release_inventory(self, order_id: int, sku: str, qty: int) -> None:
-        item = self.db.query(InventoryItem).filter(InventoryItem.sku == sku).first()
+    def _take_loaded(self, sku: str, qty: int, lock: bool) -> None:
+        item = self.db.get(InventoryItem, sku, populate_existing=True, with_for_update=lock)
+        if not item or item.on_hand < qty:
+            self._raise_unavailable(item, sku, qty)
+        item.on_hand -= qty
+        self.db.flush()
+
+    @staticmethod
+    def _raise_unavailable(item: InventoryItem | None, sku: str, qty: int) -> None:
         if not item:
-            return
-        item.on_hand += qty
-        reservation = self.db.query(InventoryReservation).filter(
-            InventoryReservation.order_id == order_id, InventoryReservation.sku == sku
-        ).first()
+            raise ValueError(f"Item {sku} not found in inventory")
+        raise ValueError(f"Insufficient inventory for {sku}. Available: {item.on_hand}, Requested: {qty}")
+
+    def release_inventory(self, order_id: int, sku: str, qty: int) -> None:
+        mode = concurrency_mode("inventory_items")
+        if mode == OPTIMISTIC:
+            retry_on_stale(self.db, lambda: self._release(order_id, sku, qty, mode))
+        else:
+            self._release(order_id, sku, qty, mode)
+
+    def _release(self, order_id: int, sku: str, qty: int, mode: str) -> None:
+        item = None
+        if mode != ATOMIC:
+            item = self.db.get(InventoryItem, sku, populate_existing=True, with_for_update=mode == LOCK)
+            if not item:
+                return
+        # Without the item lock, the reservation row lock keeps concurrent compensations of one order apart
+        reservation = self.db.execute(
+            _locked_reservation_by_order if mode == ATOMIC else _reservation_by_order,
+            {"order_id": order_id, "sku": sku},
+        ).scalar()
+        if reservation and reservation.status == "RELEASED":
+            return  # already compensated, e.g. by a retried compensation
+        if item is not None:
+            item.on_hand += qty
+        else:
+            returned = self.db.execute(_return_stock, {"item_sku": sku, "qty": qty}).first()
+            if returned is None:
+                return
+            apply_returned(self.db, InventoryItem, sku, returned)
+            publish_stock(self.db, sku, *returned)
         if reservation:
             reservation.status = "RELEASED"
         self.db.flush()
+
+    def release_many(self, order_ids: List[int]) -> Dict[str, int]:
+        """Release the reservations of many orders with one stock update per SKU; returns the quantity per SKU."""
+        # Locking the reservations keeps a concurrent compensation of the same order out
+        reservations = self.db.execute(
+            select(InventoryReservation.id, InventoryReservation.sku, InventoryReservation.qty)
+            .where(InventoryReservation.order_id.in_(order_ids), InventoryReservation.status == "RESERVED")
+            .order_by(InventoryReservation.id)
+            .with_for_update()
+        ).all()
+        released: Dict[str, int] = {}
+        for _, sku, qty in reservations:
+            released[sku] = released.get(sku, 0) + qty
+        if reservations:
+            self.db.execute(
+                update(InventoryReservation)
+                .where(InventoryReservation.id.in_([r.id for r in reservations]))
+                .values(status="RELEASED")
+            )
+        # Sorted, so concurrent batches lock the items in the same order
+        for sku in sorted(released):
+            returned = self.db.execute(_return_stock, {"item_sku": sku, "qty": released[sku]}).first()
+            if returned is not None:
+                apply_returned(self.db, InventoryItem, sku, returned)
+                publish_stock(self.db, sku, *returned)
+        return released
@@ -0,0 +1,28 @@
+import logging
+from typing import List
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from app.events import order_event, order_topic, publish_after_commit
+from app.models import Order
+
+logger = logging.getLogger(__name__)
+
+
+class OrdersService:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def confirm_order(self, order: Order) -> None:
+        order.status = "CONFIRMED"
+        publish_after_commit(self.db, order_topic(order.id), order_event(order.id, "CONFIRMED"))
+        self.db.flush()
+
+    def cancel_order(self, order: Order) -> None:
+        # The saga publishes CANCELLED once the order's compensations are done
+        order.status = "CANCELLED"
+        self.db.flush()
+
+    def cancel_many(self, order_ids: List[int]) -> None:
+        self.db.execute(update(Order).where(Order.id.in_(order_ids)).values(status="CANCELLED"))
+        for order_id in order_ids:
+            publish_after_commit(self.db, order_topic(order_id), order_event(order_id, "CANCELLED"))
@@ -0,0 +1,293 @@
+"""Horizontal sharding of users and their orders.
+
+Shard 0 is ``DATABASE_URL``; ``DATABASE_SHARDS`` adds more. A user lives on
+shard ``user_id % n`` together with everything their orders write: orders,
+payments, the balance ledger, saga steps and instances, reservations and
+promo applications. A saga therefore runs in one database exactly as it does
+unsharded, and every invariant in ``app/reconciliation.py`` holds per shard.
+
+The catalog is replicated rather than shared: every shard has every inventory
+item and promo code, holding its own share of the stock and of the uses
+(``replicate_catalog`` splits them evenly). The saga reserves from its shard's
+share, so no transaction spans two databases. The price is that a user's shard
+can run out of an item, or of a code's uses, while other shards still have
+some: the saga fails for want of stock or uses, and so does the pre-check in
+``POST /orders``, which reads the shard's share, although the order form shows
+the stock of all shards. ``CatalogRebalanceJob`` narrows that window: every
+``CATALOG_REBALANCE_INTERVAL`` seconds ``rebalance_catalog`` tops up any shard
+left with less than an even share from the shards with more. Each move takes
+from one shard and gives to the other in two transactions, and shifts both
+shards' reconciliation baselines with it. What a shard holds between moves is
+still all its users can get, and a last unit stays on whichever shard has it.
+
+Order ids identify their shard: ``ShardRouter.prepare`` makes shard ``i`` of
+``n`` hand out ids ``i + 1, i + 1 + n, ...``. PostgreSQL gets there through
+the orders sequence's increment; on SQLite, for tests, ids are assigned before
+the insert. Order pages, event topics and cached fragments keyed by order id
+need no shard in them.
+
+Background workers run once per shard. Reads across shards, such as the
+order listing, scatter the query to every shard and merge the results.
+"""
+import logging
+import os
+import threading
+from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+
+from sqlalchemy import event, func, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from app.db import SHARD_COUNT, get_shard_engine
+from app.models import InventoryItem, Order, PromoCode
+from app.reconciliation import shift_baseline
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# session.info key: (shard, shard count) of a session opened by ShardRouter
+SHARD_KEY = "shard"
+
+CATALOG_REBALANCE_INTERVAL = float(os.getenv("CATALOG_REBALANCE_INTERVAL", "30.0"))
+
+# What rebalance_catalog evens out: model, key, counter and reconciliation kind
+_SHARED_COUNTERS = (
+    (InventoryItem, InventoryItem.sku, InventoryItem.on_hand, "stock"),
+    (PromoCode, PromoCode.code, PromoCode.remaining_uses, "promo"),
+)
+
+
+def shard_of(db: Session) -> int:
+    """The shard a session works on; sessions not opened by a router are on shard 0."""
+    return db.info.get(SHARD_KEY, (0, 1))[0]
+
+
+class ShardRouter:
+    """Sessions for shards; ``engines`` default to the configured databases, created on first use."""
+
+    def __init__(self, engines: Optional[List[Engine]] = None):
+        self._engines = engines
+        self.count = len(engines) if engines is not None else SHARD_COUNT
+
+    def engine(self, shard: int) -> Engine:
+        return self._engines[shard] if self._engines is not None else get_shard_engine(shard)
+
+    def shard_for_user(self, user_id: int) -> int:
+        return user_id % self.count
+
+    def shard_for_order(self, order_id: int) -> int:
+        return (order_id - 1) % self.count
+
+    def session(self, shard: int) -> Session:
+        # Same settings as app/db.py's sessions
+        session = Session(bind=self.engine(shard), autoflush=False, expire_on_commit=False)
+        session.info[SHARD_KEY] = (shard, self.count)
+        return session
+
+    def session_factory(self, shard: int) -> Callable[[], Session]:
+        return lambda: self.session(shard)
+
+    def on_shard(self, shard: int, query: Callable[[Session], T], sessions: Optional[Dict[int, Session]] = None) -> T:
+        """Run ``query`` on a shard, in a session of its own unless ``sessions`` has one for it, such as the request's."""
+        if sessions and shard in sessions:
+            return query(sessions[shard])
+        db = self.session(shard)
+        try:
+            return query(db)
+        finally:
+            db.close()
+
+    def scatter(self, query: Callable[[Session], T], sessions: Optional[Dict[int, Session]] = None) -> List[T]:
+        """Run ``query`` on every shard in parallel; results in shard order."""
+        if self.count == 1:
+            return [self.on_shard(0, query, sessions)]
+        with ThreadPoolExecutor(max_workers=self.count, thread_name_prefix="shard-scatter") as pool:
+            return list(pool.map(lambda shard: self.on_shard(shard, query, sessions), range(self.count)))
+
+    def prepare(self) -> None:
+        """Make every shard hand out order ids that identify it; run before the shards take orders."""
+        if self.count == 1:
+            return
+        for shard in range(self.count):
+            with self.engine(shard).begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    _stride_order_ids(conn, shard, self.count)
+
+
+def _next_order_id(last_id: int, shard: int, count: int) -> int:
+    """The first id after ``last_id`` that belongs to ``shard``."""
+    next_id = last_id + 1
+    return next_id + (shard - (next_id - 1)) % count
+
+
+def _stride_order_ids(conn: Connection, shard: int, count: int) -> None:
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence('orders', 'id')")).scalar()
+    increment = conn.execute(
+        text("SELECT seqincrement FROM pg_sequence WHERE seqrelid = CAST(:sequence AS regclass)"),
+        {"sequence": sequence},
+    ).scalar()
+    if increment == count:
+        return  # already prepared; restarting it could hand out an id twice
+    last_id = conn.execute(
+        text(f"SELECT GREATEST((SELECT COALESCE(MAX(id), 0) FROM orders), (SELECT last_value FROM {sequence}))")
+    ).scalar()
+    next_id = _next_order_id(last_id, shard, count)
+    conn.execute(text(f"ALTER SEQUENCE {sequence} INCREMENT BY {count}"))
+    conn.execute(text("SELECT setval(:sequence, :next_id, false)"), {"sequence": sequence, "next_id": next_id})
+    logger.info(f"Shard {shard} hands out order ids from {next_id} in steps of {count}")
+
+
+@event.listens_for(Session, "before_flush")
+def _assign_order_ids(session: Session, flush_context, instances) -> None:
+    shard = session.info.get(SHARD_KEY)
+    if shard is None or shard[1] == 1 or session.get_bind().dialect.name == "postgresql":
+        return
+    new = [order for order in session.new if isinstance(order, Order) and order.id is None]
+    if not new:
+        return
+    # SQLite writers are serialized, so nothing inserts between this read and the flush
+    last_id = session.execute(select(func.max(Order.id))).scalar() or 0
+    for order in new:
+        order.id = last_id = _next_order_id(last_id, *shard)
+
+
+def split_evenly(total: int, parts: int) -> List[int]:
+    share, extra = divmod(total, parts)
+    return [share + (1 if i < extra else 0) for i in range(parts)]
+
+
+def replicate_catalog(router: ShardRouter, items: Iterable[InventoryItem], promos: Iterable[PromoCode]) -> None:
+    """Add every item and promo code to every shard, splitting the stock and the uses between them."""
+    items, promos = list(items), list(promos)
+    stock = {item.sku: split_evenly(item.on_hand, router.count) for item in items}
+    uses = {promo.code: split_evenly(promo.remaining_uses, router.count) for promo in promos}
+    for shard in range(router.count):
+        db = router.session(shard)
+        try:
+            db.add_all(
+                InventoryItem(sku=item.sku, name=item.name, price=item.price, on_hand=stock[item.sku][shard])
+                for item in items
+            )
+            db.add_all(
+                PromoCode(code=promo.code, remaining_uses=uses[promo.code][shard], discount_amount=promo.discount_amount)
+                for promo in promos
+            )
+            db.commit()
+        finally:
+            db.close()
+
+
+def rebalance_catalog(router: ShardRouter) -> Dict[str, int]:
+    """Top up shards holding less than an even share of an item's stock or a code's uses; returns what moved."""
+    moved: Dict[str, int] = {}
+    if router.count == 1:
+        return moved
+    for model, key, counter, kind in _SHARED_COUNTERS:
+        counts = router.scatter(lambda db: dict(db.execute(select(key, counter)).all()))
+        for entity in sorted(counts[0]):
+            held = [shard_counts.get(entity, 0) for shard_counts in counts]
+            share = sum(held) // router.count
+            wanting = [(shard, share - count) for shard, count in enumerate(held) if count < share]
+            # Donors never drop below the share themselves, so a balanced catalog stays put
+            spare = sorted(((count - share, shard) for shard, count in enumerate(held) if count > share), reverse=True)
+            for shard, want in wanting:
+                while want > 0 and spare:
+                    available, donor = spare.pop(0)
+                    wanted = min(want, available)
+                    taken = _move(router, model, counter.key, kind, entity, donor, shard, wanted, share)
+                    want -= taken
+                    if taken:
+                        moved[entity] = moved.get(entity, 0) + taken
+                    # A donor that gave less than asked had no more to spare
+                    if taken == wanted < available:
+                        spare.insert(0, (available - taken, donor))
+    if moved:
+        logger.info(f"Rebalanced the catalog over {router.count} shards: {moved}")
+    return moved
+
+
+def _move(router: ShardRouter, model, name: str, kind: str, entity: str, donor: int, recipient: int, amount: int,
+          share: int) -> int:
+    taken = router.on_shard(donor, lambda db: _shift(db, model, name, kind, entity, -amount, floor=share))
+    if taken:
+        try:
+            router.on_shard(recipient, lambda db: _shift(db, model, name, kind, entity, taken))
+        except Exception:
+            # Given back, or the units would be lost to both shards
+            router.on_shard(donor, lambda db: _shift(db, model, name, kind, entity, taken))
+            raise
+    return taken
+
+
+def _shift(db: Session, model, name: str, kind: str, entity: str, delta: int, floor: Optional[int] = None) -> int:
+    """Add ``delta`` to the row's counter, taking no more than leaves ``floor``; returns the amount moved."""
+    row = db.get(model, entity, with_for_update=True, populate_existing=True)
+    if row is None:
+        return 0
+    current = getattr(row, name)
+    if floor is not None:
+        delta = -min(-delta, max(current - floor, 0))
+    if delta:
+        setattr(row, name, current + delta)
+        shift_baseline(db, kind, entity, delta)
+        db.commit()
+    return abs(delta)
+
+
+class CatalogRebalanceJob:
+    """Runs ``rebalance_catalog`` every ``CATALOG_REBALANCE_INTERVAL`` seconds."""
+
+    def __init__(self, router: ShardRouter, interval: float = CATALOG_REBALANCE_INTERVAL):
+        self.router = router
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_forever(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                rebalance_catalog(self.router)
+            except Exception as e:
+                logger.error(f"Catalog rebalance failed: {e}")
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="catalog-rebalance", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def list_orders(router: ShardRouter, limit: int = 100, user_id: Optional[int] = None, status: Optional[str] = None,
+                sessions: Optional[Dict[int, Session]] = None) -> List[Order]:
+    """The newest orders: each shard returns its newest ``limit``, merged by creation time."""
+    def newest(db: Session) -> List[Order]:
+        stmt = select(Order).order_by(Order.created_at.desc(), Order.id.desc()).limit(limit)
+        if user_id is not None:
+            stmt = stmt.where(Order.user_id == user_id)
+        if status is not None:
+            stmt = stmt.where(Order.status == status)
+        return list(db.execute(stmt).scalars())
+
+    if user_id is not None:
+        return router.on_shard(router.shard_for_user(user_id), newest, sessions)
+    orders = [order for shard_orders in router.scatter(newest, sessions) for order in shard_orders]
+    orders.sort(key=_creation, reverse=True)
+    return orders[:limit]
+
+
+def _creation(order: Order) -> tuple:
+    created_at = order.created_at
+    if not created_at.tzinfo:
+        created_at = created_at.replace(tzinfo=timezone.utc)  # SQLite drops the offset
+    return created_at, order.id
+
+
+shards = ShardRouter()
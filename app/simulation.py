@@ -0,0 +1,422 @@
+"""Saga simulation against an in-memory state store.
+
+``SagaSimulation`` runs the real ``OrderSaga`` and saga steps, but with
+``SimulatedSession`` instead of a SQLAlchemy session and in-memory versions of
+the step services. The session keeps the step journal and undoes service
+changes on rollback. Each step can have a latency and failure rate for its
+forward action and for its compensation (``StepProfile``). Latency only
+advances a simulated clock, so nothing sleeps. The report projects throughput
+for a number of concurrent workers and shows how much compensation work a
+given failure profile causes. A ``FaultRegistry`` can be passed as well to
+inject faults at specific step phases; a saga that hits a ``crash`` fault is
+abandoned as it stands, like one whose worker died. With ``saga_timeout``
+each saga runs under a ``Deadline`` on the simulated clock.
+
+Usage:
+    python -m app.simulation [sagas] [workers] [profile.json] [seed]
+
+``profile.json`` maps step names to profiles, e.g.
+``{"ChargeUserBalance": {"latency_ms": 8, "failure_rate": 0.02,
+"compensation_failure_rate": 0.001}}``.
+"""
+import json
+import logging
+import random
+import sys
+import time
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.deadlines import Deadline
+from app.faults import FaultRegistry, InjectedCrash
+from app.models import CompensationRetry, Order, SagaInstance, SagaStep as SagaStepModel
+from app.saga import OrderSaga, SagaContext, SagaServices
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedFailure(Exception):
+    pass
+
+
+class StepProfile:
+    def __init__(self, latency_ms: float = 0.0, failure_rate: float = 0.0,
+                 compensation_latency_ms: float = 0.0, compensation_failure_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.compensation_latency_ms = compensation_latency_ms
+        self.compensation_failure_rate = compensation_failure_rate
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StepProfile":
+        return cls(**data)
+
+
+def load_profile(path: str) -> Dict[str, StepProfile]:
+    with open(path) as f:
+        return {step_name: StepProfile.from_dict(data) for step_name, data in json.load(f).items()}
+
+
+class SimulatedClock:
+    """Simulated time in seconds, advanced by injected step latencies."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class InMemoryStore:
+    def __init__(self, users: Dict[int, Decimal], stock: Dict[str, int], promo_uses: Dict[str, int]):
+        self.balances = dict(users)
+        self.stock = dict(stock)
+        self.promo_uses = dict(promo_uses)
+        self.orders: Dict[int, Order] = {}
+        self.reservations: Dict[Tuple[int, str], str] = {}
+        self.applications: Dict[Tuple[int, str], str] = {}
+        self.payments: Dict[Tuple[int, int], List] = {}
+        self.journal: List[SagaStepModel] = []
+        self.compensation_retries: List[CompensationRetry] = []
+        self.sagas: Dict[int, SagaInstance] = {}
+
+    def persist(self, obj) -> None:
+        if isinstance(obj, SagaStepModel):
+            self.journal.append(obj)
+        elif isinstance(obj, CompensationRetry):
+            self.compensation_retries.append(obj)
+        elif isinstance(obj, SagaInstance):
+            self.sagas[obj.order_id] = obj
+        elif isinstance(obj, Order):
+            self.orders[obj.id] = obj
+
+
+class _Bind:
+    class dialect:
+        name = "simulation"
+
+
+class SimulatedSession:
+    """The part of the Session API the saga uses, on top of an ``InMemoryStore``.
+
+    Objects added are persisted on ``commit``. In-memory services register undo
+    callbacks, which ``rollback`` runs in reverse order.
+    """
+
+    def __init__(self, store: InMemoryStore):
+        self.store = store
+        self.info: dict = {}
+        self._pending: list = []
+        self._undo: List[Callable[[], None]] = []
+
+    def add(self, obj) -> None:
+        self._pending.append(obj)
+
+    def on_rollback(self, undo: Callable[[], None]) -> None:
+        self._undo.append(undo)
+
+    def flush(self) -> None:
+        pass
+
+    def commit(self) -> None:
+        for obj in self._pending:
+            self.store.persist(obj)
+        self._pending.clear()
+        self._undo.clear()
+        self.info.clear()  # events are not delivered in simulation
+
+    def rollback(self) -> None:
+        for undo in reversed(self._undo):
+            undo()
+        self._pending.clear()
+        self._undo.clear()
+        self.info.clear()
+
+    def get(self, model, key, **kwargs):
+        if model is Order:
+            return self.store.orders.get(key)
+        if model is SagaInstance:
+            return self.store.sagas.get(key)
+        # The saga itself reads only these; the services are replaced by in-memory ones
+        raise NotImplementedError(
+            f"The simulation keeps no {model.__name__} rows; SimulatedSession.get supports Order and SagaInstance"
+        )
+
+    def refresh(self, obj) -> None:
+        pass
+
+    def get_bind(self):
+        return _Bind
+
+    def close(self) -> None:
+        pass
+
+
+class _SimulatedService:
+    def __init__(self, session: SimulatedSession, profile: Dict[str, StepProfile],
+                 clock: SimulatedClock, rng: random.Random):
+        self.session = session
+        self.store = session.store
+        self.profile = profile
+        self.clock = clock
+        self.rng = rng
+
+    def _simulate(self, step_name: str, compensation: bool = False) -> None:
+        step = self.profile.get(step_name)
+        if step is None:
+            return
+        if compensation:
+            latency_ms, failure_rate = step.compensation_latency_ms, step.compensation_failure_rate
+        else:
+            latency_ms, failure_rate = step.latency_ms, step.failure_rate
+        if latency_ms:
+            # Exponentially distributed around the configured mean
+            self.clock.advance(self.rng.expovariate(1000.0 / latency_ms))
+        if failure_rate and self.rng.random() < failure_rate:
+            action = "compensation of" if compensation else "step"
+            raise SimulatedFailure(f"Simulated failure in {action} {step_name}")
+
+    def _set(self, mapping: dict, key, value) -> None:
+        missing = key not in mapping
+        previous = mapping.get(key)
+        mapping[key] = value
+        if missing:
+            self.session.on_rollback(lambda: mapping.pop(key, None))
+        else:
+            self.session.on_rollback(lambda: mapping.__setitem__(key, previous))
+
+
+class InMemoryDiscountsService(_SimulatedService):
+    def reserve_promo_use(self, order_id: int, promo_code: str) -> None:
+        self._simulate("ReservePromoUse")
+        uses = self.store.promo_uses.get(promo_code)
+        if uses is None:
+            raise ValueError(f"Promo code {promo_code} not found")
+        if uses <= 0:
+            raise ValueError(f"Promo code {promo_code} has no remaining uses")
+        self._set(self.store.promo_uses, promo_code, uses - 1)
+        self._set(self.store.applications, (order_id, promo_code), "APPLIED")
+
+    def release_promo_use(self, order_id: int, promo_code: str) -> None:
+        self._simulate("ReservePromoUse", compensation=True)
+        if promo_code not in self.store.promo_uses:
+            return
+        status = self.store.applications.get((order_id, promo_code))
+        if status == "CANCELLED":
+            return
+        self._set(self.store.promo_uses, promo_code, self.store.promo_uses[promo_code] + 1)
+        if status:
+            self._set(self.store.applications, (order_id, promo_code), "CANCELLED")
+
+
+class InMemoryInventoryService(_SimulatedService):
+    def reserve_inventory(self, order_id: int, sku: str, qty: int) -> None:
+        self._simulate("ReserveInventory")
+        on_hand = self.store.stock.get(sku)
+        if on_hand is None:
+            raise ValueError(f"Item {sku} not found in inventory")
+        if on_hand < qty:
+            raise ValueError(f"Insufficient inventory for {sku}. Available: {on_hand}, Requested: {qty}")
+        self._set(self.store.stock, sku, on_hand - qty)
+        self._set(self.store.reservations, (order_id, sku), "RESERVED")
+
+    def release_inventory(self, order_id: int, sku: str, qty: int) -> None:
+        self._simulate("ReserveInventory", compensation=True)
+        if sku not in self.store.stock:
+            return
+        status = self.store.reservations.get((order_id, sku))
+        if status == "RELEASED":
+            return
+        self._set(self.store.stock, sku, self.store.stock[sku] + qty)
+        if status:
+            self._set(self.store.reservations, (order_id, sku), "RELEASED")
+
+
+class InMemoryBillingService(_SimulatedService):
+    def charge_user_balance(self, order_id: int, user_id: int, amount: Decimal) -> None:
+        self._simulate("ChargeUserBalance")
+        balance = self.store.balances.get(user_id)
+        if balance is None:
+            raise ValueError(f"User {user_id} not found")
+        if balance < amount:
+            raise ValueError(f"Insufficient balance for user {user_id}. Balance: {balance}, Required: {amount}")
+        self._set(self.store.balances, user_id, balance - amount)
+        self._set(self.store.payments, (order_id, user_id), [amount, "CHARGED"])
+
+    def refund_payment(self, order_id: int, user_id: int, amount: Decimal) -> None:
+        self._simulate("ChargeUserBalance", compensation=True)
+        payment = self.store.payments.get((order_id, user_id))
+        if not payment or payment[1] == "REFUNDED":
+            return
+        self._set(self.store.balances, user_id, self.store.balances[user_id] + amount)
+        self._set(self.store.payments, (order_id, user_id), [payment[0], "REFUNDED"])
+
+
+class InMemoryOrdersService(_SimulatedService):
+    def confirm_order(self, order: Order) -> None:
+        self._simulate("FinalizeOrder")
+        previous = order.status
+        order.status = "CONFIRMED"
+        self.session.on_rollback(lambda: setattr(order, "status", previous))
+
+
+class SimulationReport:
+    def __init__(self, sagas: int, confirmed: int, latencies: List[float], journal_counts: Dict[Tuple[str, str], int],
+                 compensation_retries: int, wall_seconds: float, crashed: int = 0):
+        self.sagas = sagas
+        self.confirmed = confirmed
+        self.crashed = crashed
+        self.failed = sagas - confirmed - crashed
+        self.latencies = sorted(latencies)
+        self.journal_counts = journal_counts
+        self.compensations = sum(
+            count for (step_name, status), count in journal_counts.items()
+            if step_name.startswith("Compensate_") and status == "COMPLETED"
+        )
+        self.compensation_retries = compensation_retries
+        self.wall_seconds = wall_seconds
+
+    def percentile(self, quantile: float) -> float:
+        if not self.latencies:
+            return 0.0
+        return self.latencies[min(int(quantile * len(self.latencies)), len(self.latencies) - 1)]
+
+    @property
+    def mean_latency(self) -> float:
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+
+    def projected_throughput(self, workers: int) -> Optional[float]:
+        """Sagas per second for ``workers`` sagas in flight, if the store is not the bottleneck."""
+        return workers / self.mean_latency if self.mean_latency else None
+
+    def format(self, workers: int) -> str:
+        projected = self.projected_throughput(workers)
+        lines = [
+            f"sagas:                  {self.sagas} ({self.confirmed} confirmed, {self.failed} failed,"
+            f" {self.crashed} crashed)",
+            f"saga latency:           mean {self.mean_latency * 1000:.1f} ms, p50 {self.percentile(0.5) * 1000:.1f} ms,"
+            f" p95 {self.percentile(0.95) * 1000:.1f} ms, p99 {self.percentile(0.99) * 1000:.1f} ms",
+            "projected throughput:   "
+            + (f"{projected:.0f} sagas/s with {workers} workers" if projected else "n/a (no latency configured)"),
+            f"compensations:          {self.compensations} ({self.compensations / max(self.sagas, 1) * 1000:.1f} per 1000 sagas)",
+            f"queued for retry:       {self.compensation_retries}",
+            f"simulator speed:        {self.sagas / max(self.wall_seconds, 1e-9) * 60:.0f} sagas/min",
+        ]
+        return "\n".join(lines)
+
+
+class SagaSimulation:
+    """Runs ``OrderSaga`` over an in-memory store with per-step latency and failure injection."""
+
+    def __init__(
+        self,
+        profile: Optional[Dict[str, StepProfile]] = None,
+        users: Optional[Dict[int, Decimal]] = None,
+        items: Optional[Dict[str, Tuple[Decimal, int]]] = None,
+        promos: Optional[Dict[str, Tuple[Decimal, int]]] = None,
+        seed: Optional[int] = None,
+        keep_journal: bool = False,
+        faults: Optional[FaultRegistry] = None,
+        saga_timeout: Optional[float] = None,
+    ):
+        users = users or {1: Decimal("1000000.00")}
+        items = items or {"SIM": (Decimal("10.00"), 1_000_000)}
+        promos = promos or {}
+        self.prices = {sku: price for sku, (price, _) in items.items()}
+        self.discounts = {code: discount for code, (discount, _) in promos.items()}
+        self.store = InMemoryStore(
+            users, {sku: on_hand for sku, (_, on_hand) in items.items()},
+            {code: uses for code, (_, uses) in promos.items()},
+        )
+        # Without it, journal rows are only counted, so long runs do not grow memory
+        self.keep_journal = keep_journal
+        self.session = SimulatedSession(self.store)
+        self.clock = SimulatedClock()
+        self.rng = random.Random(seed)
+        self.faults = faults
+        self.saga_timeout = saga_timeout
+        self.crashed_orders: List[int] = []
+        if faults is not None:
+            faults.sleep = self.clock.advance
+        service_args = (self.session, profile or {}, self.clock, self.rng)
+        self.services = SagaServices(
+            InMemoryDiscountsService(*service_args), InMemoryInventoryService(*service_args),
+            InMemoryBillingService(*service_args), InMemoryOrdersService(*service_args),
+        )
+        self._next_order_id = 1
+        self._user_ids = list(users)
+        self._skus = list(items)
+        self._promo_codes = list(promos)
+
+    def create_order(self, user_id: int, sku: str, qty: int = 1, promo_code: Optional[str] = None) -> Order:
+        base_amount = self.prices[sku] * qty
+        discount_amount = self.discounts.get(promo_code, Decimal("0")) if promo_code else Decimal("0")
+        order = Order(
+            id=self._next_order_id, user_id=user_id, sku=sku, qty=qty, promo_code=promo_code,
+            base_amount=base_amount, discount_amount=discount_amount, final_amount=base_amount - discount_amount,
+            status="PENDING",
+        )
+        self._next_order_id += 1
+        self.store.orders[order.id] = order
+        return order
+
+    def random_order(self) -> Order:
+        promo_code = self.rng.choice(self._promo_codes) if self._promo_codes and self.rng.random() < 0.5 else None
+        return self.create_order(self.rng.choice(self._user_ids), self.rng.choice(self._skus), promo_code=promo_code)
+
+    def run_saga(self, order: Order) -> Tuple[Optional[bool], float]:
+        """Run one saga; the outcome is ``None`` if it crashed."""
+        started = self.clock.now
+        deadline = Deadline(self.saga_timeout, clock=lambda: self.clock.now) if self.saga_timeout else None
+        context = SagaContext(self.session, order, services=self.services, faults=self.faults, deadline=deadline)
+        try:
+            confirmed = OrderSaga(self.session).execute(order.id, context=context)
+        except InjectedCrash:
+            # Uncommitted work dies with the worker
+            self.session.rollback()
+            self.crashed_orders.append(order.id)
+            confirmed = None
+        return confirmed, self.clock.now - started
+
+    def run(self, sagas: int, order_factory: Optional[Callable[[], Order]] = None) -> SimulationReport:
+        order_factory = order_factory or self.random_order
+        journal = self.store.journal
+        latencies = []
+        confirmed = crashed = 0
+        counts: Dict[Tuple[str, str], int] = {}
+        retries_before = len(self.store.compensation_retries)
+        wall_started = time.perf_counter()
+        for _ in range(sagas):
+            mark = len(journal)
+            ok, latency = self.run_saga(order_factory())
+            if ok is None:
+                crashed += 1
+            else:
+                confirmed += ok
+            latencies.append(latency)
+            # Counted once the saga is over: journal rows change status after they are written
+            for step in journal[mark:]:
+                counts[(step.step_name, step.status)] = counts.get((step.step_name, step.status), 0) + 1
+            if not self.keep_journal:
+                del journal[mark:]
+        wall_seconds = time.perf_counter() - wall_started
+        return SimulationReport(
+            sagas, confirmed, latencies, counts,
+            len(self.store.compensation_retries) - retries_before, wall_seconds, crashed,
+        )
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    sagas = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    profile = load_profile(sys.argv[3]) if len(sys.argv) > 3 else {}
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    simulation = SagaSimulation(
+        profile,
+        users={user_id: Decimal("1000000000.00") for user_id in range(1, 101)},
+        items={f"SKU{i}": (Decimal("10.00"), 10 ** 9) for i in range(100)},
+        promos={f"PROMO{i}": (Decimal("1.00"), 10 ** 9) for i in range(10)},
+        seed=seed,
+    )
+    print(simulation.run(sagas).format(workers))
@@ -0,0 +1,129 @@
+"""In-memory read model of available stock.
+
+``StockView`` keeps every worker's copy of ``inventory_items``: name, price
+and ``on_hand`` per SKU and shard. The order form, ``GET /stock`` and the
+pre-check in ``POST /orders`` read it instead of the table. The check that
+counts stays in the saga's ``ReserveInventory`` step, so a copy that lags
+behind at worst lets an order through to fail there, or turns one away that
+would have found stock. Orders are priced from the row: only stock changes
+publish events, so names and prices in the view are as old as its last load.
+
+Every committed stock change publishes a ``stock`` event carrying the row's
+new ``on_hand`` and ``version``: ORM changes from a flush hook, the atomic
+mode's ``UPDATE`` statements from ``InventoryService``. The view applies an
+event only if its version is newer than the one it holds, so events arriving
+out of order or during a reload never move it back. With
+``SAGA_EVENTS_NOTIFY=1`` the events go through ``pg_notify`` to every worker,
+and to any other service listening on the channel. Changes that publish
+nothing, such as SQL run by hand, are picked up by the reload every
+``STOCK_VIEW_REFRESH_INTERVAL`` seconds.
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from app.events import ALL_TOPICS, EventBus, publish_after_commit, stock_event, stock_topic
+from app.models import InventoryItem
+from app.sharding import shard_of
+
+STOCK_VIEW_REFRESH_INTERVAL = float(os.getenv("STOCK_VIEW_REFRESH_INTERVAL", "60.0"))
+
+
+class StockView:
+    def __init__(self, refresh_interval: float = STOCK_VIEW_REFRESH_INTERVAL, clock: Callable[[], float] = time.monotonic):
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        # shard -> sku -> (version, on_hand)
+        self._stock: Dict[int, Dict[str, Tuple[int, int]]] = {}
+        # sku -> (name, price); the same on every shard
+        self._catalog: Dict[str, tuple] = {}
+        self._refresh_at: Dict[int, float] = {}
+
+    def stale_shards(self, count: int) -> List[int]:
+        now = self.clock()
+        with self._lock:
+            return [shard for shard in range(count) if self._refresh_at.get(shard, 0.0) <= now]
+
+    def load(self, db: Session) -> None:
+        """Read the shard's stock; versions the view already holds newer stay."""
+        shard = shard_of(db)
+        rows = db.execute(
+            select(InventoryItem.sku, InventoryItem.name, InventoryItem.price, InventoryItem.on_hand, InventoryItem.version)
+        ).all()
+        with self._lock:
+            current = self._stock.get(shard, {})
+            stock = {}
+            for sku, name, price, on_hand, version in rows:
+                self._catalog[sku] = (name, price)
+                held = current.get(sku)
+                stock[sku] = held if held is not None and held[0] > version else (version, on_hand)
+            self._stock[shard] = stock
+            self._refresh_at[shard] = self.clock() + self.refresh_interval
+
+    def item(self, db: Session, sku: str) -> Optional[InventoryItem]:
+        """The item with its stock on the session's shard, or ``None`` when there is no such SKU."""
+        shard = shard_of(db)
+        if self.clock() >= self._refresh_at.get(shard, 0.0):
+            self.load(db)
+        with self._lock:
+            held = self._stock.get(shard, {}).get(sku)
+            if held is None:
+                return None
+            name, price = self._catalog[sku]
+            return InventoryItem(sku=sku, name=name, price=price, on_hand=held[1])
+
+    def items(self) -> List[InventoryItem]:
+        """Every item with its stock summed over the loaded shards, by SKU."""
+        with self._lock:
+            on_hand: Dict[str, int] = {}
+            for stock in self._stock.values():
+                for sku, (_, quantity) in stock.items():
+                    on_hand[sku] = on_hand.get(sku, 0) + quantity
+            return [
+                InventoryItem(sku=sku, name=self._catalog[sku][0], price=self._catalog[sku][1], on_hand=on_hand[sku])
+                for sku in sorted(on_hand)
+            ]
+
+    def apply(self, sku: str, shard: int, on_hand: int, version: int) -> None:
+        with self._lock:
+            stock = self._stock.get(shard)
+            if stock is None:
+                return  # not loaded yet; the load will read it
+            held = stock.get(sku)
+            if held is None:
+                self._refresh_at[shard] = 0.0  # a new item: its name and price come with the next load
+            elif version > held[0]:
+                stock[sku] = (version, on_hand)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stock.clear()
+            self._catalog.clear()
+            self._refresh_at.clear()
+
+    def on_event(self, payload: dict) -> None:
+        if payload.get("type") == "stock":
+            self.apply(payload["sku"], payload["shard"], payload["on_hand"], payload["version"])
+
+    def install(self, event_bus: EventBus) -> None:
+        event_bus.add_listener(ALL_TOPICS, self.on_event)
+
+
+stock_view = StockView()
+
+
+def publish_stock(db: Session, sku: str, on_hand: int, version: int) -> None:
+    publish_after_commit(db, stock_topic(sku), stock_event(sku, shard_of(db), on_hand, version))
+
+
+@event.listens_for(Session, "after_flush")
+def _publish_stock_changes(session: Session, flush_context) -> None:
+    # After the flush, so the version is the one the row now has
+    for item in list(session.new) + list(session.dirty):
+        if isinstance(item, InventoryItem) and (item in session.new or inspect(item).attrs.on_hand.history.has_changes()):
+            publish_stock(session, item.sku, item.on_hand, item.version)
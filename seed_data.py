@@ -1,38 +1,55 @@
 """Скрипт для добавления тестовых данных в базу данных."""
 from decimal import Decimal
-from app.db import SessionLocal, engine
+from sqlalchemy import text
 from app.models import Base, User, InventoryItem, PromoCode
+from app.sharding import replicate_catalog, shards
+
+def _clear(db):
+    """Очистить таблицы, если в них уже есть данные."""
+    # Проверяем, есть ли уже данные (в шарде может не оказаться пользователей, но каталог есть всегда)
+    if db.query(User).count() > 0 or db.query(InventoryItem).count() > 0:
+        print("Данные уже существуют. Очищаю таблицы...")
+        # Очищаем таблицы в правильном порядке (из-за внешних ключей)
+        db.execute(text("DELETE FROM cancellation_jobs"))
+        db.execute(text("DELETE FROM compensation_retries"))
+        db.execute(text("DELETE FROM saga_step_rollups"))
+        db.execute(text("DELETE FROM rollup_cursors"))
+        db.execute(text("DELETE FROM reconciliation_baselines"))
+        db.execute(text("DELETE FROM saga_instances"))
+        db.execute(text("DELETE FROM saga_steps"))
+        db.execute(text("DELETE FROM saga_steps_archive"))
+        db.execute(text("DELETE FROM promo_applications"))
+        db.execute(text("DELETE FROM promo_leases"))
+        db.execute(text("DELETE FROM inventory_reservations"))
+        db.execute(text("DELETE FROM payments"))
+        db.execute(text("DELETE FROM balance_ledger"))
+        db.execute(text("DELETE FROM balance_snapshots"))
+        db.execute(text("DELETE FROM orders"))
+        db.execute(text("DELETE FROM promo_codes"))
+        db.execute(text("DELETE FROM inventory_items"))
+        db.execute(text("DELETE FROM users"))
+        db.commit()
+        print("Таблицы очищены")
+
 
 def seed_data():
-    """Добавить тестовые данные в БД."""
-    # Создаём таблицы если их нет
-    Base.metadata.create_all(bind=engine)
-    
-    db = SessionLocal()
+    """Добавить тестовые данные в БД (во все шарды, см. app/sharding.py)."""
+    for shard in range(shards.count):
+        # Создаём таблицы если их нет
+        Base.metadata.create_all(bind=shards.engine(shard))
+        shards.on_shard(shard, _clear)
+
+    sessions = [shards.session(shard) for shard in range(shards.count)]
     
     try:
-        # Проверяем, есть ли уже данные
-        if db.query(User).count() > 0:
-            print("Данные уже существуют. Очищаю таблицы...")
-            # Очищаем таблицы в правильном порядке (из-за внешних ключей)
-            db.execute("DELETE FROM saga_steps")
-            db.execute("DELETE FROM promo_applications")
-            db.execute("DELETE FROM inventory_reservations")
-            db.execute("DELETE FROM payments")
-            db.execute("DELETE FROM orders")
-            db.execute("DELETE FROM promo_codes")
-            db.execute("DELETE FROM inventory_items")
-            db.execute("DELETE FROM users")
-            db.commit()
-            print("Таблицы очищены")
-        
         # Создаём пользователей
         users = [
             User(id=1, name="Иван Иванов", balance=Decimal("100000.00")),
             User(id=2, name="Петр Петров", balance=Decimal("5000.00")),
             User(id=3, name="Анна Смирнова", balance=Decimal("500000.00")),
         ]
-        db.add_all(users)
+        for user in users:
+            sessions[shards.shard_for_user(user.id)].add(user)
         print("Добавлено пользователей: 3")
         
         # Создаём товары
@@ -43,7 +60,6 @@ def seed_data():
             InventoryItem(sku="PHONE-IPHONE", name="iPhone 15 Pro", price=Decimal("120000.00"), on_hand=0),  # Нет в наличии
             InventoryItem(sku="KEYBOARD", name="Механическая клавиатура", price=Decimal("8000.00"), on_hand=15),
         ]
-        db.add_all(items)
         print("Добавлено товаров: 5")
         
         # Создаём промокоды
@@ -53,10 +69,12 @@ def seed_data():
             PromoCode(code="ONETIME", remaining_uses=1, discount_amount=Decimal("5000.00")),
             PromoCode(code="EXPIRED", remaining_uses=0, discount_amount=Decimal("2000.00")),  # Истек
         ]
-        db.add_all(promos)
         print("Добавлено промокодов: 4")
         
-        db.commit()
+        # Каждый шард получает весь каталог и свою долю остатков и использований промокодов
+        replicate_catalog(shards, items, promos)
+        for db in sessions:
+            db.commit()
         
         print("\n" + "="*50)
         print("Тестовые данные успешно добавлены")
@@ -80,11 +98,13 @@ def seed_data():
         print("Откройте: http://localhost:8000")
         
     except Exception as e:
-        db.rollback()
+        for db in sessions:
+            db.rollback()
         print(f"Ошибка: {e}")
         raise
     finally:
-        db.close()
+        for db in sessions:
+            db.close()
 
 if __name__ == "__main__":
     seed_data()
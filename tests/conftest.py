@@ -1,48 +1,164 @@
-"""Pytest configuration and fixtures."""
+"""Pytest configuration and fixtures.
+
+The database backend is chosen once per test session:
+
+* ``TEST_DATABASE_URL`` - an existing PostgreSQL server (a database per
+  pytest-xdist worker is created next to the given one);
+* otherwise a PostgreSQL testcontainer when Docker is available;
+* otherwise an in-memory SQLite database.
+
+The schema is created once per session. Every test runs inside an outer
+transaction that is rolled back afterwards; the code under test commits
+SAVEPOINTs inside it.
+"""
+import logging
+import os
+from contextlib import contextmanager
 from decimal import Decimal
 
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from testcontainers.postgres import PostgresContainer
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from app.db import get_db
+from app.fragments import fragments
+from app.main import app
+from app.promo_filter import promo_filter
+from app.stock_view import stock_view
+from app.models import Base, User, InventoryItem, Order, PromoCode
+
+logger = logging.getLogger(__name__)
+
 
-from app.models import Base, User, InventoryItem, PromoCode
+def _docker_available() -> bool:
+    try:
+        import docker
+        docker.from_env().ping()
+        return True
+    except Exception:
+        return False
+
+
+def _worker_database_url(base_url: str, worker_id: str) -> str:
+    """Create (if needed) and return a database dedicated to an xdist worker."""
+    if worker_id == "master":
+        return base_url
+    url = make_url(base_url)
+    name = f"{url.database}_{worker_id}"
+    admin = create_engine(url, isolation_level="AUTOCOMMIT")
+    try:
+        with admin.connect() as conn:
+            exists = conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": name}).scalar()
+            if not exists:
+                conn.execute(text(f'CREATE DATABASE "{name}"'))
+    finally:
+        admin.dispose()
+    return url.set(database=name).render_as_string(hide_password=False)
 
 
 @pytest.fixture(scope="session")
-def postgres_container():
-    """Start PostgreSQL container for tests."""
-    with PostgresContainer("postgres:16") as postgres:
-        yield postgres
+def worker_id() -> str:
+    """pytest-xdist worker name, or "master" when running in a single process."""
+    return os.getenv("PYTEST_XDIST_WORKER", "master")
 
 
 @pytest.fixture(scope="session")
-def database_url(postgres_container):
-    """Get database URL from container."""
-    return postgres_container.get_connection_url()
+def database_url(worker_id):
+    """Get database URL for this test session."""
+    if os.getenv("TEST_DATABASE_URL"):
+        yield _worker_database_url(os.environ["TEST_DATABASE_URL"], worker_id)
+    elif _docker_available():
+        from testcontainers.postgres import PostgresContainer
+
+        # Each xdist worker is a separate process and gets its own container
+        with PostgresContainer("postgres:16") as postgres:
+            yield postgres.get_connection_url()
+    else:
+        logger.warning("Docker is not available, running tests against in-memory SQLite")
+        yield "sqlite://"
 
 
 @pytest.fixture(scope="session")
 def engine(database_url):
-    """Create SQLAlchemy engine."""
-    return create_engine(database_url)
+    """Create SQLAlchemy engine and the schema, once per session."""
+    if database_url.startswith("sqlite"):
+        engine = create_engine(database_url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
 
+        # Let SQLAlchemy emit BEGIN itself so SAVEPOINTs work with pysqlite
+        @event.listens_for(engine, "connect")
+        def _connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def _begin(conn):
+            conn.exec_driver_sql("BEGIN")
+    else:
+        engine = create_engine(database_url)
 
-@pytest.fixture
-def db_session(engine):
-    """Create a new database session for a test."""
-    # Полностью пересоздаём схему перед каждым тестом
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
-    
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    session = SessionLocal()
-    
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def make_database(database_url, tmp_path):
+    """Factory of empty databases with the schema, for tests whose sessions must commit for real.
+
+    ``make_database(name)`` returns an engine; on PostgreSQL the database is
+    created next to the session's one, on SQLite it is a file, so several
+    connections can use it.
+    """
+    engines = []
+
+    def make(name: str):
+        if database_url.startswith("sqlite"):
+            engine = create_engine(f"sqlite:///{tmp_path / name}.db", connect_args={"check_same_thread": False})
+        else:
+            url = make_url(database_url)
+            database = f"{url.database}_{name}"
+            admin = create_engine(url, isolation_level="AUTOCOMMIT")
+            try:
+                with admin.connect() as conn:
+                    if not conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": database}).scalar():
+                        conn.execute(text(f'CREATE DATABASE "{database}"'))
+            finally:
+                admin.dispose()
+            engine = create_engine(url.set(database=database))
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        engine.dispose()
+
+
+@pytest.fixture
+def db_session(engine):
+    """Create a session whose work is rolled back after the test."""
+    connection = engine.connect()
+    transaction = connection.begin()
+    session = Session(
+        bind=connection,
+        autoflush=False,
+        expire_on_commit=False,
+        join_transaction_mode="create_savepoint",
+    )
     try:
         yield session
-        session.commit()
     finally:
         session.close()
+        transaction.rollback()
+        connection.close()
+        # Rolled back rows must not live on as rendered fragments, promo marks or stock
+        fragments.clear()
+        promo_filter.clear()
+        stock_view.clear()
 
 
 @pytest.fixture
@@ -72,3 +188,63 @@ def setup_test_data(db_session):
         "items": [item1, item2, item3],
         "promos": [promo1, promo2, promo3]
     }
+
+
+@pytest.fixture
+def client(db_session):
+    """Test client whose requests use the test's session."""
+    app.dependency_overrides[get_db] = lambda: db_session
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def capture_statements(engine):
+    """``with capture_statements() as statements`` collects the SQL run on the test engine, or on a given one."""
+
+    @contextmanager
+    def capture(bind=None):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statement = " ".join(statement.split())
+            # Savepoints come from the transactional test fixture, not the application
+            if not statement.startswith(("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")):
+                statements.append(statement)
+
+        target = bind if bind is not None else engine
+        event.listen(target, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(target, "before_cursor_execute", before_cursor_execute)
+
+    return capture
+
+
+@pytest.fixture
+def make_order(db_session):
+    """Factory of committed ``PENDING`` orders, priced like ``POST /orders``.
+
+    ``amount`` sets the price outright, without a discount; ``db`` adds the
+    order through another session, such as a shard's.
+    """
+
+    def make(user_id=1, sku="ITEM001", qty=1, promo_code=None, amount=None, db=None) -> Order:
+        db = db or db_session
+        if amount is not None:
+            base_amount, discount_amount = amount, Decimal("0.00")
+        else:
+            base_amount = db.get(InventoryItem, sku).price * qty
+            discount_amount = db.get(PromoCode, promo_code).discount_amount if promo_code else Decimal("0.00")
+        order = Order(
+            user_id=user_id, promo_code=promo_code, sku=sku, qty=qty, base_amount=base_amount,
+            discount_amount=discount_amount, final_amount=base_amount - discount_amount, status="PENDING",
+        )
+        db.add(order)
+        db.commit()
+        return order
+
+    return make
@@ -0,0 +1,63 @@
+"""Tests for admission control on the saga path."""
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.admission import AdmissionController, AdmissionRejected
+
+
+def test_queue_limits_and_fairness():
+    """Test that requests over the limit queue, then fast-fail, and one user cannot take every slot."""
+    async def scenario():
+        controller = AdmissionController(
+            initial_limit=2, min_limit=1, max_limit=4, queue_size=1, queue_timeout=0.05, per_user_limit=2,
+        )
+        await controller.acquire(1)
+        await controller.acquire(2)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(1)  # user 1 still has a slot left but the queue wait times out
+        assert rejected.value.status_code == 503 and rejected.value.retry_after >= 1
+
+        waiting = asyncio.ensure_future(controller.acquire(3))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected, match="queue is full"):
+            await controller.acquire(4)
+        controller.release(1, latency=0.01)
+        await waiting
+        assert controller.stats()["in_flight"] == 2 and controller.queued == 0
+
+        controller.per_user_limit = 1
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(2)
+        assert rejected.value.status_code == 429
+
+    asyncio.run(scenario())
+
+
+def test_limit_adapts_to_latency():
+    """Test that slow sagas shrink the limit and fast ones grow it back."""
+    controller = AdmissionController(initial_limit=10, min_limit=2, max_limit=12, target_latency=0.5)
+    controller.in_flight = 20
+    for _ in range(20):
+        controller.release(1, latency=2.0)
+    assert controller.limit == 2
+
+    controller.in_flight = 100
+    for _ in range(100):
+        controller.release(1, latency=0.1)
+    assert 10 < controller.limit <= 12
+
+
+def test_create_order_returns_503_with_retry_after(monkeypatch):
+    """Test that an overloaded controller rejects orders before the saga runs."""
+    controller = AdmissionController(initial_limit=1, min_limit=1, max_limit=1, queue_size=0)
+    controller.in_flight = 1
+    monkeypatch.setattr(main, "admission", controller)
+
+    response = TestClient(main.app).post("/orders", data={"user_id": 1, "sku": "ITEM001", "qty": 1})
+
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert controller.stats()["rejected"] == 1
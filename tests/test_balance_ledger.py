@@ -0,0 +1,59 @@
+"""Tests for the append-only balance ledger."""
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+from app.models import User, BalanceLedgerEntry, BalanceSnapshot
+from app.services.billing import BillingService
+
+
+def test_charges_and_refunds_are_ledger_inserts(db_session, setup_test_data, make_order):
+    """Test that charging and refunding append entries instead of updating users."""
+    billing = BillingService(db_session)
+    first = make_order()
+    second = make_order(amount=Decimal("250.00"))
+
+    billing.charge_user_balance(first.id, 1, Decimal("100.00"))
+    billing.charge_user_balance(second.id, 1, Decimal("250.00"))
+    billing.refund_payment(first.id, 1, Decimal("100.00"))
+    billing.refund_payment(first.id, 1, Decimal("100.00"))  # idempotent
+    db_session.commit()
+
+    user = db_session.get(User, 1)
+    db_session.refresh(user)
+    assert user.balance == Decimal("1000.00")  # snapshot untouched
+    assert billing.get_balance(1) == Decimal("750.00")
+    assert billing.get_balances() == {1: Decimal("750.00"), 2: Decimal("50.00")}
+
+    kinds = [e.kind for e in db_session.query(BalanceLedgerEntry).order_by(BalanceLedgerEntry.id)]
+    assert kinds == ["CHARGE", "CHARGE", "REFUND"]
+
+    with pytest.raises(ValueError, match="Insufficient balance"):
+        billing.charge_user_balance(second.id, 1, Decimal("750.01"))
+
+
+def test_compaction_and_balance_at(db_session, setup_test_data, make_order):
+    """Test that compaction writes snapshots without changing balances."""
+    billing = BillingService(db_session)
+    order = make_order()
+    before_charge = datetime.now(timezone.utc)
+    billing.charge_user_balance(order.id, 1, Decimal("100.00"))
+    db_session.commit()
+
+    assert billing.compact_balances() == 1
+    assert billing.compact_balances() == 0
+    user = db_session.get(User, 1)
+    assert user.balance == Decimal("900.00")
+    assert billing.get_balance(1) == Decimal("900.00")
+    snapshot = db_session.query(BalanceSnapshot).filter(BalanceSnapshot.user_id == 1).one()
+    assert snapshot.balance == Decimal("900.00")
+
+    billing.refund_payment(order.id, 1, Decimal("100.00"))
+    db_session.commit()
+    after_refund = datetime.now(timezone.utc)
+
+    assert billing.get_balance(1) == Decimal("1000.00")
+    assert billing.get_balance_at(1, before_charge) == Decimal("1000.00")
+    assert billing.get_balance_at(1, snapshot.created_at) == Decimal("900.00")
+    assert billing.get_balance_at(1, after_refund) == Decimal("1000.00")
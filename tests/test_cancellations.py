@@ -0,0 +1,170 @@
+"""Tests for cancelling confirmed orders, one at a time and in bulk."""
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from app.cancellations import BulkCancellationWorker
+from app.events import bus, order_topic
+from app.models import BalanceLedgerEntry, CancellationJob, InventoryItem, PromoCode, SagaStep, User
+from app.reconciliation import InvariantChecker
+from app.saga import OrderSaga
+from app.services.billing import BillingService
+
+
+def _confirmed(db_session, order):
+    assert OrderSaga(db_session).execute(order.id) is True
+    return order
+
+
+def _state(db_session):
+    """Balances, stock and promo uses, read fresh."""
+    return (
+        BillingService(db_session).get_balances(),
+        {i.sku: i.on_hand for i in db_session.execute(select(InventoryItem)).scalars()},
+        {p.code: p.remaining_uses for p in db_session.execute(select(PromoCode)).scalars()},
+    )
+
+
+def _refresh(db_session, *objects):
+    for obj in objects:
+        db_session.refresh(obj)
+
+
+def test_cancel_runs_the_compensations(db_session, setup_test_data, make_order):
+    """Test that cancelling a confirmed order gives back stock, money and the promo use, once."""
+    before = _state(db_session)
+    order = _confirmed(db_session, make_order(qty=2, promo_code="DISCOUNT10"))
+    checker = InvariantChecker()
+    assert checker.check(db_session, full=True).ok
+
+    assert OrderSaga(db_session).cancel(order.id) is True
+    _refresh(db_session, order)
+    assert order.status == "CANCELLED"
+    assert _state(db_session) == before
+    steps = db_session.execute(
+        select(SagaStep.step_name).where(SagaStep.order_id == order.id).order_by(SagaStep.id)
+    ).scalars().all()
+    assert steps[-3:] == ["Compensate_ChargeUserBalance", "Compensate_ReserveInventory", "Compensate_ReservePromoUse"]
+
+    assert OrderSaga(db_session).cancel(order.id) is False
+    assert _state(db_session) == before
+    assert checker.check(db_session).ok
+
+
+
+def test_cancelled_is_published_after_the_compensations(db_session, setup_test_data, make_order):
+    """Test that single and bulk cancellations publish CANCELLED last, so order streams see every compensation."""
+    single, bulk = _confirmed(db_session, make_order()), _confirmed(db_session, make_order())
+    job = CancellationJob(sku="ITEM001", status="RUNNING", last_order_id=single.id, cancelled=0, refunded=0)
+    db_session.add(job)
+    db_session.commit()
+    events = {single.id: [], bulk.id: []}
+    listeners = {order.id: events[order.id].append for order in (single, bulk)}
+    for order_id, listener in listeners.items():
+        bus.add_listener(order_topic(order_id), listener)
+    try:
+        assert OrderSaga(db_session).cancel(single.id) is True
+        assert BulkCancellationWorker(lambda: db_session).run_once(db_session) == 1
+    finally:
+        for order_id, listener in listeners.items():
+            bus.remove_listener(order_topic(order_id), listener)
+
+    for order_id, published in events.items():
+        assert [e.get("step_name") for e in published if e["status"] == "COMPLETED"] == [
+            "Compensate_ChargeUserBalance", "Compensate_ReserveInventory"
+        ]
+        assert published[-1] == {"type": "order", "order_id": order_id, "status": "CANCELLED"}
+
+def test_bulk_cancellation_is_set_based_and_resumable(db_session, setup_test_data, make_order, capture_statements):
+    """Test that batches restore stock per SKU and refund per user, and a new worker picks up at the cursor."""
+    db_session.add(User(id=3, name="Анна Смирнова", balance=Decimal("1000.00")))
+    db_session.commit()
+    before = _state(db_session)
+    matching = [
+        _confirmed(db_session, make_order(user_id=1, promo_code="DISCOUNT10")),
+        _confirmed(db_session, make_order(user_id=3, qty=2)),
+        _confirmed(db_session, make_order(user_id=1, promo_code="DISCOUNT10")),
+        _confirmed(db_session, make_order(user_id=3)),
+        _confirmed(db_session, make_order(user_id=1)),
+    ]
+    other = _confirmed(db_session, make_order(user_id=1, sku="ITEM002"))
+    checker = InvariantChecker()
+    assert checker.check(db_session, full=True).ok
+
+    job = CancellationJob(sku="ITEM001", status="RUNNING", last_order_id=0, cancelled=0, refunded=0)
+    db_session.add(job)
+    db_session.commit()
+
+    with capture_statements() as statements:
+        assert BulkCancellationWorker(lambda: db_session, batch_size=3).run_once(db_session) == 3
+    assert sum(s.startswith("UPDATE inventory_items") for s in statements) == 1
+    assert sum(s.startswith("UPDATE promo_codes") for s in statements) == 1
+    refunds = db_session.execute(
+        select(BalanceLedgerEntry.user_id, BalanceLedgerEntry.amount)
+        .where(BalanceLedgerEntry.kind == "REFUND").order_by(BalanceLedgerEntry.user_id)
+    ).all()
+    assert [(user_id, str(amount)) for user_id, amount in refunds] == [(1, "180.00"), (3, "200.00")]
+    assert (job.last_order_id, job.cancelled, str(job.refunded)) == (matching[2].id, 3, "380.00")
+
+    # A restarted worker continues after the last committed batch
+    worker = BulkCancellationWorker(lambda: db_session, batch_size=3)
+    assert worker.run_once(db_session) == 2
+    assert worker.run_once(db_session) == 0
+    _refresh(db_session, job, other, *matching)
+    assert (job.status, job.cancelled, str(job.refunded)) == ("DONE", 5, "580.00")
+    assert [o.status for o in matching] == ["CANCELLED"] * 5 and other.status == "CONFIRMED"
+    assert OrderSaga(db_session).cancel(matching[0].id) is False
+
+    balances, stock, uses = _state(db_session)
+    assert balances == {**before[0], 1: before[0][1] - other.final_amount}
+    assert stock == {**before[1], "ITEM002": before[1]["ITEM002"] - 1}
+    assert uses == before[2]
+    assert checker.check(db_session).ok
+    assert checker.check(db_session, full=True).ok
+
+
+def test_bulk_cancellation_keeps_loaded_rows_current(db_session, setup_test_data, make_order):
+    """Test that the worker's session sees the returned stock and uses on the item and promo it has loaded."""
+    for _ in range(2):
+        _confirmed(db_session, make_order(qty=2, promo_code="DISCOUNT10"))
+    item = db_session.get(InventoryItem, "ITEM001")
+    promo = db_session.get(PromoCode, "DISCOUNT10")
+    assert (item.on_hand, promo.remaining_uses) == (6, 3)
+    job = CancellationJob(sku="ITEM001", status="RUNNING", last_order_id=0, cancelled=0, refunded=0)
+    db_session.add(job)
+    db_session.commit()
+
+    assert BulkCancellationWorker(lambda: db_session).process_batch(db_session, job) == 2
+    assert (item.on_hand, promo.remaining_uses) == (10, 5)
+    assert item.version == db_session.execute(select(InventoryItem.version).where(InventoryItem.sku == "ITEM001")).scalar()
+
+
+def test_failed_job_resumes_through_the_api(client, db_session, setup_test_data, make_order, monkeypatch):
+    """Test that a failing batch leaves nothing behind and the resumed job finishes."""
+    orders = [_confirmed(db_session, make_order(promo_code="DISCOUNT10")) for _ in range(2)]
+    assert client.post("/admin/cancellations").status_code == 400
+    created = client.post("/admin/cancellations", params={"promo_code": "DISCOUNT10"}).json()
+    assert (created["status"], created["remaining"]) == ("RUNNING", 2)
+
+    def unavailable(self, order_ids):
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(BillingService, "refund_many", unavailable)
+    assert BulkCancellationWorker(lambda: db_session).run_once(db_session) == 0
+    failed = client.get(f"/admin/cancellations/{created['id']}").json()
+    assert (failed["status"], failed["last_error"], failed["cancelled"], failed["remaining"]) == (
+        "FAILED", "database went away", 0, 2
+    )
+    _refresh(db_session, *orders)
+    assert [o.status for o in orders] == ["CONFIRMED"] * 2
+    assert db_session.get(PromoCode, "DISCOUNT10", populate_existing=True).remaining_uses == 3
+
+    monkeypatch.undo()
+    assert client.post(f"/admin/cancellations/{created['id']}/resume").json()["status"] == "RUNNING"
+    worker = BulkCancellationWorker(lambda: db_session)
+    assert worker.run_once(db_session) == 2
+    assert worker.run_once(db_session) == 0
+    done = client.get(f"/admin/cancellations/{created['id']}").json()
+    assert (done["status"], done["cancelled"], done["refunded"], done["remaining"]) == ("DONE", 2, "180.00", 0)
+    assert client.post(f"/admin/orders/{orders[0].id}/cancel").status_code == 409
+    assert db_session.get(PromoCode, "DISCOUNT10", populate_existing=True).remaining_uses == 5
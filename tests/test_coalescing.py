@@ -0,0 +1,144 @@
+"""Tests for coalescing the balance charges of one user's concurrent orders."""
+import threading
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.coalescing import BalanceCoalescer
+from app.models import BalanceLedgerEntry, InventoryItem, Payment, User
+from app.services.billing import BillingService
+
+
+def _ids(make_order, *amounts, db=None):
+    return [make_order(amount=amount, db=db).id for amount in amounts]
+
+
+def _wait_until(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("timed out")
+
+
+def _charge_concurrently(db_session, coalescer, charges, finish_leader):
+    """Charge from one thread per order, joining the batch in the given order; returns each thread's error."""
+    results = {}
+
+    def charge(index, order_id, amount):
+        try:
+            BillingService(db_session, coalescer).charge_user_balance(order_id, 1, amount)
+            results[index] = None
+        except ValueError as e:
+            results[index] = str(e)
+        if index == 0:
+            finish_leader()  # the leader's step commits or rolls back
+
+    threads = []
+    for index, (order_id, amount) in enumerate(charges):
+        thread = threading.Thread(target=charge, args=(index, order_id, amount))
+        thread.start()
+        threads.append(thread)
+        if index < len(charges) - 1:
+            _wait_until(lambda: coalescer.queued(1) == index + 1)
+    for thread in threads:
+        thread.join(10)
+    return [results[index] for index in range(len(charges))]
+
+
+def test_batch_is_charged_once_in_arrival_order(db_session, setup_test_data, make_order, capture_statements):
+    """Test that one balance read covers the batch and each order gets the result it would have got alone."""
+    amounts = [Decimal("400.00"), Decimal("700.00"), Decimal("300.00")]
+    order_ids = _ids(make_order, *amounts)
+    coalescer = BalanceCoalescer(window=5.0, max_batch=3)
+    with capture_statements() as statements:
+        results = _charge_concurrently(db_session, coalescer, list(zip(order_ids, amounts)), db_session.commit)
+
+    assert results[0] is None and results[2] is None
+    assert results[1].startswith("Insufficient balance for user 1. Balance: 600.00")
+    assert len([s for s in statements if s.startswith("SELECT") and "balance_ledger" in s]) == 1
+    charged = db_session.execute(
+        select(BalanceLedgerEntry.order_id).where(BalanceLedgerEntry.kind == "CHARGE").order_by(BalanceLedgerEntry.id)
+    ).scalars().all()
+    assert charged == [order_ids[0], order_ids[2]]
+    assert BillingService(db_session).get_balance(1) == Decimal("300.00")
+
+
+def test_rolled_back_batch_is_charged_one_by_one(db_session, setup_test_data, make_order):
+    """Test that when the leader's step rolls back, the others charge themselves, once."""
+    amounts = [Decimal("100.00"), Decimal("200.00")]
+    order_ids = _ids(make_order, *amounts)
+    coalescer = BalanceCoalescer(window=5.0, max_batch=2)
+
+    def roll_back():
+        db_session.rollback()
+
+    results = _charge_concurrently(db_session, coalescer, list(zip(order_ids, amounts)), roll_back)
+    assert results == [None, None]
+    db_session.commit()
+    payments = db_session.execute(select(Payment.order_id)).scalars().all()
+    assert payments == [order_ids[1]]
+
+    # A late fallback finds the payment and does not charge again
+    BillingService(db_session).charge_unless_charged(order_ids[1], 1, amounts[1])
+    db_session.commit()
+    assert BillingService(db_session).get_balance(1) == Decimal("800.00")
+
+
+@pytest.mark.parametrize("window", [0, 0.001])
+def test_single_charges_are_unchanged(db_session, setup_test_data, make_order, window):
+    """Test that with coalescing off, or alone in its window, a charge behaves as before."""
+    order_id, = _ids(make_order, Decimal("1500.00"))
+    with pytest.raises(ValueError, match="Insufficient balance"):
+        BillingService(db_session, BalanceCoalescer(window=window)).charge_user_balance(order_id, 1, Decimal("1500.00"))
+    db_session.rollback()
+    order_id, = _ids(make_order, Decimal("250.00"))
+    BillingService(db_session, BalanceCoalescer(window=window)).charge_user_balance(order_id, 1, Decimal("250.00"))
+    db_session.commit()
+    assert BillingService(db_session).get_balance(1) == Decimal("750.00")
+
+
+def test_follower_leaving_the_batch_is_charged_once(make_database, make_order):
+    """Test that a follower that times out charges itself and the leader's batch no longer holds it."""
+    engine = make_database("coalescing")
+    with Session(engine) as db:
+        db.add(User(id=1, name="Иван Иванов", balance=Decimal("1000.00")))
+        db.add(InventoryItem(sku="ITEM001", name="Ноутбук", price=Decimal("100.00"), on_hand=10))
+        db.commit()
+        order_ids = _ids(make_order, Decimal("100.00"), Decimal("100.00"), db=db)
+    coalescer = BalanceCoalescer(window=0.5, wait_timeout=0.1)
+    errors = []
+
+    def charge(order_id):
+        with Session(engine, expire_on_commit=False) as db:
+            try:
+                BillingService(db, coalescer).charge_user_balance(order_id, 1, Decimal("100.00"))
+                db.commit()
+            except Exception as e:
+                errors.append(e)
+
+    leader = threading.Thread(target=charge, args=(order_ids[0],))
+    leader.start()
+    _wait_until(lambda: coalescer.queued(1) == 1)
+    charge(order_ids[1])  # waits past its timeout while the leader still collects
+    leader.join(10)
+
+    assert errors == []
+    with Session(engine) as db:
+        assert sorted(db.execute(select(Payment.order_id)).scalars()) == order_ids
+        assert BillingService(db).get_balance(1) == Decimal("800.00")
+
+
+def test_batch_skips_orders_already_paid(db_session, setup_test_data, make_order):
+    """Test that charging a batch leaves out an order that charged itself meanwhile."""
+    order_ids = _ids(make_order, Decimal("100.00"), Decimal("200.00"))
+    BillingService(db_session).charge_unless_charged(order_ids[0], 1, Decimal("100.00"))
+    db_session.commit()
+
+    errors = BillingService(db_session).charge_many(1, [(order_ids[0], Decimal("100.00")), (order_ids[1], Decimal("200.00"))])
+    db_session.commit()
+    assert errors == [None, None]
+    assert db_session.execute(select(Payment.order_id).order_by(Payment.order_id)).scalars().all() == order_ids
+    assert BillingService(db_session).get_balance(1) == Decimal("700.00")
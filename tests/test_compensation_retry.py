@@ -0,0 +1,86 @@
+"""Tests for the compensation retry queue."""
+from datetime import datetime, timezone, timedelta
+
+from app.compensation_retry import CompensationRetryWorker
+from app.models import InventoryItem, CompensationRetry, SagaStep
+from app.saga import OrderSaga
+from app.services.inventory import InventoryService
+
+
+def _fail_release(monkeypatch):
+    def broken_release(self, order_id, sku, qty):
+        raise RuntimeError("inventory service unavailable")
+    monkeypatch.setattr(InventoryService, "release_inventory", broken_release)
+
+
+def test_failed_compensation_is_queued_and_retried(db_session, setup_test_data, make_order, monkeypatch):
+    """Test that a failed compensation is stored and later completed by the worker."""
+    order = make_order(qty=2)
+
+    with monkeypatch.context() as m:
+        _fail_release(m)
+        success = OrderSaga(db_session).execute(order.id, fail_at_step="FinalizeOrder")
+    assert success is False
+
+    item = db_session.query(InventoryItem).filter(InventoryItem.sku == "ITEM001").first()
+    assert item.on_hand == 8  # Not released yet
+
+    retry = db_session.query(CompensationRetry).filter(CompensationRetry.order_id == order.id).one()
+    assert retry.status == "PENDING"
+    assert retry.step_name == "ReserveInventory"
+    assert "inventory service unavailable" in retry.last_error
+
+    worker = CompensationRetryWorker(lambda: db_session)
+    assert worker.process_batch(db_session) == 1
+
+    db_session.refresh(item)
+    db_session.refresh(retry)
+    assert retry.status == "SUCCEEDED"
+    assert item.on_hand == 10
+
+    step_statuses = [
+        s.status for s in db_session.query(SagaStep).filter(
+            SagaStep.order_id == order.id, SagaStep.step_name == "Compensate_ReserveInventory"
+        )
+    ]
+    assert sorted(step_statuses) == ["COMPLETED", "FAILED"]
+
+    # Replaying an already succeeded compensation must not release the stock twice
+    worker.replay(db_session, retry.id)
+    db_session.refresh(item)
+    assert item.on_hand == 10
+
+
+def test_compensation_retry_backoff_and_dead_letter(db_session, setup_test_data, make_order, monkeypatch):
+    """Test exponential backoff and moving to the dead-letter state."""
+    order = make_order(qty=2)
+    _fail_release(monkeypatch)
+    OrderSaga(db_session).execute(order.id, fail_at_step="FinalizeOrder")
+
+    worker = CompensationRetryWorker(lambda: db_session, max_attempts=3)
+    retry = db_session.query(CompensationRetry).filter(CompensationRetry.order_id == order.id).one()
+
+    now = datetime.now(timezone.utc)
+    assert worker.process_batch(db_session, now=now) == 1
+    assert retry.status == "PENDING"
+    first_delay = retry.next_attempt_at - now
+
+    # Not due yet
+    assert worker.process_batch(db_session, now=now) == 0
+
+    now = retry.next_attempt_at
+    assert worker.process_batch(db_session, now=now) == 1
+    assert retry.next_attempt_at - now == first_delay * 2
+
+    now = retry.next_attempt_at
+    assert worker.process_batch(db_session, now=now) == 1
+    assert retry.status == "DEAD"
+    assert retry.attempts == 3
+    assert worker.process_batch(db_session, now=now + timedelta(days=1)) == 0
+
+    # Operator replay after the underlying problem is fixed
+    monkeypatch.undo()
+    worker.replay(db_session, retry.id)
+    assert retry.status == "SUCCEEDED"
+    item = db_session.query(InventoryItem).filter(InventoryItem.sku == "ITEM001").first()
+    assert item.on_hand == 10
@@ -0,0 +1,74 @@
+"""Tests for the lock, atomic and optimistic concurrency modes."""
+from decimal import Decimal
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app import concurrency
+from app.concurrency import CONCURRENCY_MODES, retry_on_stale
+from app.models import InventoryItem, PromoCode
+from app.saga import OrderSaga
+from app.services.billing import BillingService
+
+
+@pytest.mark.parametrize("mode", ["lock", "atomic", "optimistic"])
+def test_saga_and_compensation_in_every_mode(monkeypatch, db_session, setup_test_data, make_order, mode):
+    """Test that reservations and compensations keep stock, promo uses and balances consistent."""
+    monkeypatch.setitem(CONCURRENCY_MODES, "inventory_items", mode)
+    monkeypatch.setitem(CONCURRENCY_MODES, "promo_codes", mode)
+    monkeypatch.setitem(CONCURRENCY_MODES, "users", "lock" if mode == "atomic" else mode)
+
+    # Loaded in the sagas' session beforehand; every step must keep these copies current
+    item = db_session.get(InventoryItem, "ITEM001")
+    promo = db_session.get(PromoCode, "DISCOUNT10")
+
+    assert OrderSaga(db_session).execute(make_order(promo_code="DISCOUNT10").id) is True
+    assert (item.on_hand, promo.remaining_uses) == (9, 4)
+    assert OrderSaga(db_session).execute(make_order(user_id=2, promo_code="DISCOUNT10").id) is False  # cannot afford it
+    assert (item.on_hand, promo.remaining_uses) == (9, 4)
+    assert OrderSaga(db_session).execute(make_order(qty=20, promo_code="DISCOUNT10").id) is False  # out of stock
+
+    assert item.on_hand == 9
+    assert promo.remaining_uses == 4
+    assert item.version > 1 and promo.version > 1
+    assert BillingService(db_session).get_balance(1) == Decimal("910.00")
+
+
+def test_optimistic_mode_retries_stale_rows(make_database):
+    """Test that a version bump committed by another session is detected and the operation retried."""
+    engine = make_database("optimistic")
+    with Session(engine) as db:
+        db.add(InventoryItem(sku="ITEM001", name="Ноутбук", price=Decimal("100.00"), on_hand=10))
+        db.commit()
+    attempts = []
+
+    with Session(engine, expire_on_commit=False) as db:
+        item = db.get(InventoryItem, "ITEM001")
+        # Our read's transaction ends first; on SQLite it would otherwise keep the other writer from committing
+        db.commit()
+        # Another writer commits between our read and our flush
+        with Session(engine) as other:
+            other.get(InventoryItem, "ITEM001").on_hand -= 1
+            other.commit()
+
+        def take_one():
+            # The copy we read; the savepoint rollback expires it, so the retry reloads it
+            attempts.append(item.version)
+            item.on_hand -= 1
+            db.flush()
+
+        retries = concurrency.stale_retry_count()
+        retry_on_stale(db, take_one)
+        db.commit()
+
+    assert attempts == [1, 2]  # the retry read the other writer's version
+    assert concurrency.stale_retry_count() == retries + 1
+    with Session(engine) as db:
+        assert db.get(InventoryItem, "ITEM001").on_hand == 8
+
+
+def test_users_have_no_atomic_mode(monkeypatch, db_session, setup_test_data):
+    """Test that the ledger-backed balance rejects the atomic mode."""
+    monkeypatch.setitem(CONCURRENCY_MODES, "users", "atomic")
+    with pytest.raises(ValueError, match="Unsupported concurrency mode"):
+        BillingService(db_session).charge_user_balance(1, 1, Decimal("1.00"))
@@ -0,0 +1,96 @@
+"""Tests for saga deadlines, cancellation and per-step timeouts."""
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+
+from app import deadlines
+from app.deadlines import Deadline
+from app.faults import FaultRegistry
+from app.models import InventoryItem, SagaStep
+from app.saga import OrderSaga, SagaContext
+from app.services.billing import BillingService
+from app.simulation import SagaSimulation, StepProfile
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _journal(db_session, order):
+    steps = db_session.query(SagaStep).filter(SagaStep.order_id == order.id).order_by(SagaStep.id).all()
+    return [(s.step_name, s.status, s.error) for s in steps]
+
+
+def test_step_past_the_deadline_is_rolled_back_and_compensated(db_session, setup_test_data, make_order):
+    """Test that a step finishing after the deadline does not commit and earlier steps are compensated."""
+    clock = FakeClock()
+    deadline = Deadline(3.0, clock=clock)
+    order = make_order()
+
+    def slow(seconds):
+        clock.now += seconds
+
+    faults = FaultRegistry.from_spec("ChargeUserBalance:after_execute:delay:1:5000", sleep=slow)
+    context = SagaContext(db_session, order, faults=faults, deadline=deadline)
+    assert OrderSaga(db_session).execute(order.id, context=context) is False
+
+    assert order.status == "FAILED"
+    assert BillingService(db_session).get_balance(1) == Decimal("1000.00")
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 10
+    assert _journal(db_session, order) == [
+        ("ReserveInventory", "COMPLETED", None),
+        ("ChargeUserBalance", "FAILED", "Saga deadline of 3s exceeded at step ChargeUserBalance"),
+        ("Compensate_ReserveInventory", "COMPLETED", None),
+    ]
+
+
+def test_cancelled_saga_stops_at_the_next_boundary(db_session, setup_test_data, make_order):
+    """Test that cancelling from another thread fails the running step before it commits."""
+    deadline = Deadline(60.0)
+    order = make_order()
+    faults = FaultRegistry.from_spec("ReserveInventory:after_execute:delay:1:1", sleep=lambda _: deadline.cancel())
+
+    context = SagaContext(db_session, order, faults=faults, deadline=deadline)
+    assert OrderSaga(db_session).execute(order.id, context=context) is False
+
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 10
+    assert _journal(db_session, order) == [("ReserveInventory", "FAILED", "Saga cancelled at step ReserveInventory")]
+
+
+def test_postgres_timeouts_are_set_per_step(db_session, setup_test_data, make_order, monkeypatch):
+    """Test that each step transaction gets its own statement and lock timeouts."""
+    if db_session.get_bind().dialect.name != "postgresql":
+        pytest.skip("statement_timeout and lock_timeout are PostgreSQL settings")
+    monkeypatch.setattr(deadlines, "STEP_TIMEOUTS", {"ReserveInventory": 1.5, "ChargeUserBalance": 0.2})
+    seen = {}
+
+    def probe(_):
+        seen["statement"] = db_session.execute(text("SHOW statement_timeout")).scalar()
+        seen["lock"] = db_session.execute(text("SHOW lock_timeout")).scalar()
+        db_session.execute(text("SELECT pg_sleep(1)"))  # a statement stuck past its step timeout
+
+    order = make_order()
+    faults = FaultRegistry.from_spec("ChargeUserBalance:before_execute:delay:1:1", sleep=probe)
+    context = SagaContext(db_session, order, faults=faults, deadline=Deadline(60.0))
+    assert OrderSaga(db_session).execute(order.id, context=context) is False
+
+    assert seen == {"statement": "200ms", "lock": "200ms"}
+    journal = _journal(db_session, order)
+    assert journal[1][:2] == ("ChargeUserBalance", "FAILED") and "statement timeout" in journal[1][2]
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 10
+
+
+def test_simulated_deadline_bounds_saga_latency():
+    """Test that simulated sagas over their deadline fail instead of running long."""
+    profile = {"ChargeUserBalance": StepProfile(latency_ms=50)}
+    unbounded = SagaSimulation(profile, seed=7).run(1000)
+    bounded = SagaSimulation(profile, seed=7, saga_timeout=0.1).run(1000)
+
+    assert unbounded.failed == 0
+    assert 0 < bounded.failed < 1000
+    assert bounded.journal_counts[("Compensate_ReserveInventory", "COMPLETED")] == bounded.failed
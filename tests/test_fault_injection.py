@@ -0,0 +1,175 @@
+"""Tests for fault injection at saga step phases."""
+import random
+from decimal import Decimal
+
+import pytest
+
+from app import faults as faults_module
+from app.faults import KINDS, PHASES, FaultRegistry, FaultRule, InjectedCrash
+from app.models import CompensationRetry, InventoryItem, SagaStep
+from app.saga import OrderSaga, SagaContext, build_steps
+from app.services.billing import BillingService
+from app.simulation import SagaSimulation
+
+STEP_NAMES = ("ReservePromoUse", "ReserveInventory", "ChargeUserBalance", "FinalizeOrder")
+
+
+def run_with_faults(db_session, order, spec):
+    context = SagaContext(db_session, order, faults=FaultRegistry.from_spec(spec))
+    return OrderSaga(db_session).execute(order.id, context=context)
+
+
+def journal(db_session, order_id):
+    steps = db_session.query(SagaStep).filter(SagaStep.order_id == order_id).order_by(SagaStep.id).all()
+    return [(step.step_name, step.status) for step in steps]
+
+
+def test_failure_after_commit_is_compensated(db_session, setup_test_data, make_order):
+    """Test that a step failing after its commit is compensated like a completed step."""
+    order = make_order()
+
+    assert run_with_faults(db_session, order, "ReserveInventory:after_commit") is False
+
+    assert order.status == "FAILED"
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 10
+    assert journal(db_session, order.id) == [
+        ("ReserveInventory", "COMPLETED"), ("Compensate_ReserveInventory", "COMPLETED"),
+    ]
+
+
+@pytest.mark.parametrize("phase", ["before_execute", "after_execute", "before_commit"])
+def test_failure_before_commit_rolls_the_step_back(db_session, setup_test_data, make_order, phase):
+    """Test that a fault before the commit leaves no trace of the step's changes."""
+    order = make_order()
+
+    assert run_with_faults(db_session, order, f"ChargeUserBalance:{phase}") is False
+
+    assert BillingService(db_session).get_balance(1) == Decimal("1000.00")
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 10
+    assert journal(db_session, order.id)[-2:] == [
+        ("ChargeUserBalance", "FAILED"), ("Compensate_ReserveInventory", "COMPLETED"),
+    ]
+
+
+def test_failed_compensation_is_queued_for_retry(db_session, setup_test_data, make_order):
+    """Test that a fault during compensation leaves the reservation to the retry worker."""
+    order = make_order()
+
+    assert run_with_faults(db_session, order, "FinalizeOrder:before_execute,ReserveInventory:compensate:timeout") is False
+
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 9
+    retry = db_session.query(CompensationRetry).filter(CompensationRetry.order_id == order.id).one()
+    assert retry.step_name == "ReserveInventory" and "timeout" in retry.last_error
+
+
+def test_crash_escapes_the_saga(db_session, setup_test_data, make_order):
+    """Test that a crash is not handled as a step failure."""
+    order = make_order()
+
+    with pytest.raises(InjectedCrash):
+        run_with_faults(db_session, order, "ChargeUserBalance:before_commit:crash")
+    db_session.rollback()
+
+    assert order.status == "PENDING"
+    assert journal(db_session, order.id) == [("ReserveInventory", "COMPLETED"), ("ChargeUserBalance", "STARTED")]
+
+
+def test_fault_configuration(db_session, setup_test_data, make_order):
+    """Test spec parsing, probabilities, and that steps get no registry when injection is off."""
+    registry = FaultRegistry.from_spec("*:before_execute:delay:1:250, ReserveInventory:compensate", sleep=lambda s: None)
+    registry.inject("ChargeUserBalance", "before_execute")
+    assert registry.injected == {("ChargeUserBalance", "before_execute", "delay"): 1}
+
+    never = FaultRegistry([FaultRule("ReserveInventory", "before_execute", probability=0.0)], seed=1)
+    for _ in range(100):
+        never.inject("ReserveInventory", "before_execute")
+
+    for spec in ("ReserveInventory", "ReserveInventory:during", "ReserveInventory:compensate:explode"):
+        with pytest.raises(ValueError):
+            FaultRegistry.from_spec(spec)
+
+    order = make_order()
+    assert SagaContext(db_session, order).faults is None
+    assert all(step.faults is None for step in build_steps(SagaContext(db_session, order)))
+
+
+def test_faults_from_request_header(client, db_session, setup_test_data, monkeypatch):
+    """Test that the X-Saga-Faults header is honoured only when enabled."""
+    data = {"user_id": 1, "sku": "ITEM001", "qty": 1}
+    headers = {"X-Saga-Faults": "ChargeUserBalance:after_execute"}
+
+    assert "CONFIRMED" in client.post("/orders", data=data, headers=headers).text
+
+    monkeypatch.setattr(faults_module, "FAULT_HEADERS_ENABLED", True)
+    response = client.post("/orders", data=data, headers=headers)
+    assert "FAILED" in response.text and "Injected error in ChargeUserBalance" in response.text
+    assert BillingService(db_session).get_balance(1) == Decimal("900.00")
+
+    response = client.post("/orders", data=data, headers={"X-Saga-Faults": "ChargeUserBalance"})
+    assert response.status_code == 400
+
+
+def random_faults(rng):
+    rules = [
+        FaultRule(rng.choice(STEP_NAMES), rng.choice(PHASES), rng.choice(KINDS),
+                  probability=rng.uniform(0.02, 0.3), delay_ms=rng.choice([0, 5, 50]))
+        for _ in range(rng.randint(1, 5))
+    ]
+    return FaultRegistry(rules, seed=rng.randrange(2 ** 32))
+
+
+def assert_invariants(simulation, users, stock, promo_uses):
+    store = simulation.store
+    retries = {(retry.order_id, retry.step_name) for retry in store.compensation_retries}
+    crashed = set(simulation.crashed_orders)
+
+    reserved = {sku: 0 for sku in stock}
+    for (order_id, sku), status in store.reservations.items():
+        if status == "RESERVED":
+            reserved[sku] += store.orders[order_id].qty
+    for sku, initial in stock.items():
+        assert store.stock[sku] + reserved[sku] == initial
+    charged = sum(amount for amount, status in store.payments.values() if status == "CHARGED")
+    assert sum(store.balances.values()) + charged == sum(users.values())
+    applied = {code: 0 for code in promo_uses}
+    for (order_id, code), status in store.applications.items():
+        if status == "APPLIED":
+            applied[code] += 1
+    for code, initial in promo_uses.items():
+        assert store.promo_uses[code] + applied[code] == initial
+
+    for order in store.orders.values():
+        if order.id in crashed:
+            continue  # left for crash recovery
+        held = {
+            "ReserveInventory": store.reservations.get((order.id, order.sku)) == "RESERVED",
+            "ChargeUserBalance": (store.payments.get((order.id, order.user_id)) or [None, None])[1] == "CHARGED",
+            "ReservePromoUse": store.applications.get((order.id, order.promo_code)) == "APPLIED",
+        }
+        if order.status == "CONFIRMED":
+            assert held["ReserveInventory"] and held["ChargeUserBalance"]
+            assert held["ReservePromoUse"] == bool(order.promo_code)
+        else:
+            assert order.status == "FAILED"
+            # Anything still held by a failed order is waiting in the retry queue
+            for step_name, is_held in held.items():
+                assert not is_held or (order.id, step_name) in retries
+
+
+def test_invariants_hold_under_random_faults():
+    """Test conservation of stock, money and promo uses across thousands of sagas with random faults."""
+    users = {1: Decimal("5000.00"), 2: Decimal("40.00"), 3: Decimal("1000000.00")}
+    stock = {"A": 300, "B": 20}
+    promo_uses = {"P": 100, "Q": 5}
+    for seed in range(20):
+        rng = random.Random(seed)
+        simulation = SagaSimulation(
+            users=users,
+            items={"A": (Decimal("10.00"), stock["A"]), "B": (Decimal("7.50"), stock["B"])},
+            promos={"P": (Decimal("1.00"), promo_uses["P"]), "Q": (Decimal("2.00"), promo_uses["Q"])},
+            seed=seed,
+            faults=random_faults(rng),
+        )
+        report = simulation.run(200)
+        assert report.confirmed + report.failed + report.crashed == 200
+        assert_invariants(simulation, users, stock, promo_uses)
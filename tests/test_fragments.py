@@ -0,0 +1,48 @@
+"""Tests for the pre-rendered fragment cache."""
+from app.events import bus, order_topic, step_event
+from app.fragments import FragmentCache, ITEM_OPTIONS, fragments, order_key
+from app.models import InventoryItem
+from app.saga import OrderSaga
+
+
+def test_finished_order_page_is_rendered_once(client, db_session, setup_test_data, make_order, capture_statements):
+    """Test that a finished order is served from its fragment until a step event arrives."""
+    order = make_order()
+    OrderSaga(db_session).execute(order.id, "FinalizeOrder")
+
+    first = client.get(f"/orders/{order.id}")
+    with capture_statements() as statements:
+        second = client.get(f"/orders/{order.id}")
+    assert second.text == first.text
+    assert "Compensate_ReserveInventory" in first.text
+    assert statements == []
+
+    # A retried compensation appends a step to the FAILED order
+    bus.publish(order_topic(order.id), step_event(order.id, "Compensate_ChargeUserBalance", "COMPLETED"))
+    assert fragments.get(order_key(order.id)) is None
+
+
+def test_option_lists_follow_stock_changes(client, db_session, setup_test_data):
+    """Test that the cached option lists are rebuilt after a completed step."""
+    assert "остаток: 10" in client.get("/").text
+
+    db_session.get(InventoryItem, "ITEM001").on_hand = 7
+    db_session.commit()
+    assert "остаток: 10" in client.get("/").text  # no event yet: still cached
+
+    bus.publish(order_topic(1), step_event(1, "ReserveInventory", "COMPLETED"))
+    assert "остаток: 7" in client.get("/").text
+
+
+def test_invalidation_during_render_is_not_overwritten():
+    """Test that HTML rendered before an invalidation is not stored."""
+    cache = FragmentCache()
+
+    def render():
+        cache.invalidate(ITEM_OPTIONS)  # the catalog changes while we render
+        return "<option>stale</option>"
+
+    assert cache.get_or_render(ITEM_OPTIONS, render) == "<option>stale</option>"
+    assert cache.get(ITEM_OPTIONS) is None
+    assert cache.get_or_render(ITEM_OPTIONS, lambda: "<option>fresh</option>") == "<option>fresh</option>"
+    assert cache.get(ITEM_OPTIONS) == "<option>fresh</option>"
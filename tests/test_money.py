@@ -0,0 +1,76 @@
+"""Property tests: minor-unit Money gives the same results as the Decimal path."""
+import random
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Numeric, Table, func, insert, select
+
+from app.money import MinorUnits, Money
+
+SEEDS = range(20)
+MAX_MINOR = 10 ** 11  # Numeric(15, 2) holds up to 10^13 - 1 major units; leave room for qty and sums
+
+
+def _amount(rng, low=0):
+    minor = rng.randint(low, MAX_MINOR)
+    return Decimal(minor).scaleb(-2), Money(minor)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_order_amounts_match_decimal(seed):
+    """Test that pricing, discounting and charging an order agree with Decimal arithmetic and formatting."""
+    rng = random.Random(seed)
+    for _ in range(500):
+        (price, price_m), qty = _amount(rng), rng.randint(1, 100)
+        (discount, discount_m), (balance, balance_m) = _amount(rng), _amount(rng)
+
+        base, base_m = price * qty, price_m * qty
+        final, final_m = base - discount, base_m - discount_m
+        assert str(base_m) == str(base) and str(final_m) == str(final)
+        assert (discount_m > 0) == (discount > 0)
+        assert (balance_m < final_m) == (balance < final)
+        assert str(balance_m + -final_m) == str(balance + -final)
+        assert Money.from_decimal(final) == final_m and final_m.to_decimal() == final
+        assert hash(final_m) == hash(final)  # equal amounts are one dict key
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_ledger_sums_match_decimal(seed):
+    """Test that summing signed ledger entries agrees with Decimal, including mixed Decimal operands."""
+    rng = random.Random(seed)
+    entries = [_amount(rng) for _ in range(200)]
+    signs = [rng.choice((1, -1)) for _ in entries]
+
+    total = sum(sign * amount for sign, (amount, _) in zip(signs, entries))
+    total_m = sum((money if sign > 0 else -money) for sign, (_, money) in zip(signs, entries))
+    assert str(total_m) == str(total)
+    assert str(entries[0][0] - total_m) == str(entries[0][0] - total)  # a Decimal not reloaded yet
+
+
+def test_money_round_trips_through_the_database(db_session):
+    """Test that BIGINT minor units store, sum and compare like Numeric(15, 2)."""
+    rng = random.Random(0)
+    table = Table(
+        "money_round_trip", MetaData(),
+        Column("id", Integer, primary_key=True), Column("amount", Numeric(15, 2)), Column("minor", MinorUnits()),
+        prefixes=["TEMPORARY"],
+    )
+    connection = db_session.connection()
+    table.create(connection)
+    rows = []
+    for i in range(300):
+        amount, money = _amount(rng)
+        sign = rng.choice((1, -1))
+        # Minor units accept the Decimal as well, as seed data and forms pass it
+        rows.append({"id": i, "amount": amount * sign, "minor": (amount if i % 2 else money) * sign})
+    connection.execute(insert(table), rows)
+
+    for amount, minor in connection.execute(select(table.c.amount, table.c.minor)):
+        assert isinstance(minor, Money) and str(minor) == str(amount)
+    total, total_m = connection.execute(
+        select(func.coalesce(func.sum(table.c.amount), 0), func.coalesce(func.sum(table.c.minor), 0))
+    ).one()
+    assert str(total_m) == str(total)
+    threshold = rows[7]["amount"]
+    assert connection.execute(select(func.count()).where(table.c.minor > threshold)).scalar() == \
+        connection.execute(select(func.count()).where(table.c.amount > threshold)).scalar()
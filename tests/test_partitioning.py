@@ -0,0 +1,38 @@
+"""Tests for saga_steps partition helpers and archived step lookup."""
+from datetime import date, datetime, timezone, timedelta
+from decimal import Decimal
+
+from app.models import Order, SagaStep, SagaStepArchive
+from app.partitioning import partition_name, partition_bounds, archive_horizon, get_saga_steps
+
+
+def test_partition_naming_and_bounds():
+    """Test monthly partition names and bounds, including the year boundary."""
+    assert partition_name(date(2026, 12, 1)) == "saga_steps_p202612"
+    assert partition_bounds(date(2026, 12, 1)) == (date(2026, 12, 1), date(2027, 1, 1))
+    assert archive_horizon(retention_months=3, today=date(2026, 2, 17)) == datetime(2025, 11, 1, tzinfo=timezone.utc)
+
+
+def test_get_saga_steps_reads_hot_and_archived_rows(db_session, setup_test_data):
+    """Test that order steps are found across hot and archived storage."""
+    old = datetime.now(timezone.utc) - timedelta(days=3650)
+    order = Order(
+        user_id=1, sku="ITEM001", qty=1,
+        base_amount=Decimal("100.00"), discount_amount=Decimal("0.00"), final_amount=Decimal("100.00"),
+        status="CONFIRMED", created_at=old,
+    )
+    db_session.add(order)
+    db_session.commit()
+
+    db_session.add(SagaStepArchive(
+        id=1000, order_id=order.id, step_name="ReserveInventory", status="COMPLETED",
+        started_at=old, finished_at=old,
+    ))
+    db_session.add(SagaStep(
+        order_id=order.id, step_name="FinalizeOrder", status="COMPLETED",
+        started_at=old + timedelta(days=400), finished_at=old + timedelta(days=400),
+    ))
+    db_session.commit()
+
+    steps = get_saga_steps(db_session, order)
+    assert [s.step_name for s in steps] == ["ReserveInventory", "FinalizeOrder"]
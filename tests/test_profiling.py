@@ -0,0 +1,47 @@
+"""Tests for profiling single order requests on demand."""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.profiling import Profiler, _before_cursor_execute, profiler
+
+
+def test_profiled_request_is_browsable(client, db_session, setup_test_data, monkeypatch):
+    """Test that a request with the header leaves its SQL, steps and profile in the buffer, others leave nothing."""
+    monkeypatch.setattr(profiler, "headers_enabled", True)
+    profiler.clear()
+    try:
+        data = {"user_id": 1, "sku": "ITEM001", "qty": 1, "promo_code": "DISCOUNT10"}
+        assert "CONFIRMED" in client.post("/orders", data=data).text
+        assert client.get("/admin/profiles").json() == []
+
+        assert "CONFIRMED" in client.post("/orders", data=data, headers={"X-Saga-Profile": "1"}).text
+        assert not event.contains(Engine, "before_cursor_execute", _before_cursor_execute)
+        [summary] = client.get("/admin/profiles").json()
+        assert summary["order_id"] is not None and summary["sql_count"] > 0
+
+        profile = client.get(f"/admin/profiles/{summary['id']}").json()
+        assert [step["step"] for step in profile["steps"]] == [
+            "ReservePromoUse", "ReserveInventory", "ChargeUserBalance", "FinalizeOrder"
+        ]
+        assert all(step["status"] == "COMPLETED" and step["duration_ms"] >= 0 for step in profile["steps"])
+        # Statements of both the request's thread and the saga's thread
+        statements = [sql["statement"] for sql in profile["sql"]]
+        assert any(s.startswith("INSERT INTO orders") for s in statements)
+        assert any(s.startswith("UPDATE inventory_items") for s in statements)
+        assert "execute" in profile["profile"]
+        assert client.get("/admin/profiles/0").status_code == 404
+    finally:
+        profiler.clear()
+
+
+def test_sampling_and_the_ring_buffer():
+    """Test that the sample rate picks requests and the buffer keeps only the newest profiles."""
+    assert Profiler(sample_rate=1.0, headers_enabled=False).wanted({})
+    assert not Profiler(sample_rate=0, headers_enabled=False).wanted({"X-Saga-Profile": "1"})
+
+    buffer = Profiler(buffer_size=2)
+    for label in ("first", "second", "third"):
+        with buffer.capture(label):
+            pass
+    assert [profile.label for profile in buffer.list()] == ["third", "second"]
+    assert buffer.get(1) is None and buffer.get(3).duration >= 0
@@ -0,0 +1,131 @@
+"""Tests for the negative cache and Bloom filter of promo codes."""
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+import pytest
+
+from app.concurrency import CONCURRENCY_MODES
+from app.events import ALL_TOPICS, bus
+from app.models import PromoCode
+from app.promo_filter import EXHAUSTED, UNKNOWN, BloomFilter, PromoCodeFilter, PromoFilterRebuildJob
+from app.saga import OrderSaga, SagaContext, SagaServices
+from app.services.billing import BillingService
+from app.services.discounts import DiscountsService, PromoCodeUnavailable
+from app.services.inventory import InventoryService
+from app.services.orders import OrdersService
+
+
+@contextmanager
+def installed(code_filter):
+    bus.add_listener(ALL_TOPICS, code_filter.on_event)
+    try:
+        yield code_filter
+    finally:
+        bus.remove_listener(ALL_TOPICS, code_filter.on_event)
+
+
+def _rejection(db_session, code_filter, code):
+    try:
+        DiscountsService(db_session, code_filter=code_filter).check_promo(code)
+    except PromoCodeUnavailable as e:
+        return e.reason
+    return None
+
+
+def test_bloom_filter_has_no_false_negatives():
+    """Test that every added key is found and few others are."""
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f"CODE{i}")
+
+    assert all(f"CODE{i}" in bloom for i in range(1000))
+    assert sum(f"BOGUS{i}" in bloom for i in range(10000)) < 300
+
+
+def test_unknown_and_exhausted_codes_are_rejected_from_memory(db_session, setup_test_data, capture_statements):
+    """Test that after the filter is built, bogus and exhausted codes cost no queries."""
+    code_filter = PromoCodeFilter()
+    code_filter.rebuild(db_session)  # at startup
+    assert _rejection(db_session, code_filter, "DISCOUNT10") is None
+    assert _rejection(db_session, code_filter, "EXPIRED") == EXHAUSTED
+
+    with capture_statements() as statements:
+        rejections = [_rejection(db_session, code_filter, f"BOT{i}") for i in range(200)]
+        assert _rejection(db_session, code_filter, "EXPIRED") == EXHAUSTED
+    assert statements == []
+    assert set(rejections) == {UNKNOWN}
+
+
+def test_new_and_topped_up_codes_are_accepted(db_session, setup_test_data):
+    """Test that creating a code or giving an exhausted one uses drops the rejection."""
+    with installed(PromoCodeFilter()) as code_filter:
+        code_filter.rebuild(db_session)
+        assert _rejection(db_session, code_filter, "SPRING") == UNKNOWN
+        assert _rejection(db_session, code_filter, "EXPIRED") == EXHAUSTED
+
+        db_session.add(PromoCode(code="SPRING", remaining_uses=3, discount_amount=Decimal("5.00")))
+        db_session.get(PromoCode, "EXPIRED").remaining_uses = 2
+        db_session.commit()
+
+        assert _rejection(db_session, code_filter, "SPRING") is None
+        assert _rejection(db_session, code_filter, "EXPIRED") is None
+
+
+@pytest.mark.parametrize("mode", ["lock", "atomic", "optimistic", "lease"])
+def test_compensation_gives_the_last_use_back(monkeypatch, db_session, setup_test_data, make_order, mode):
+    """Test that a code exhausted by a saga is usable again once the saga compensates."""
+    monkeypatch.setitem(CONCURRENCY_MODES, "promo_codes", mode)
+    with installed(PromoCodeFilter()) as code_filter:
+        order = make_order(user_id=2, promo_code="ONETIME")
+        seen = []
+
+        def check_exhausted(order_id, user_id, amount):
+            seen.append(_rejection(db_session, code_filter, "ONETIME"))
+            raise ValueError("Insufficient balance")
+
+        billing = BillingService(db_session)
+        monkeypatch.setattr(billing, "charge_user_balance", check_exhausted)
+        services = SagaServices(
+            DiscountsService(db_session, code_filter=code_filter), InventoryService(db_session), billing,
+            OrdersService(db_session),
+        )
+        context = SagaContext(db_session, order, services=services)
+        assert OrderSaga(db_session).execute(order.id, context=context) is False
+
+        assert seen == [None if mode == "lease" else EXHAUSTED]  # leased uses may remain elsewhere
+        assert _rejection(db_session, code_filter, "ONETIME") is None
+
+
+def test_atomic_reservation_of_the_last_use_marks_the_code(monkeypatch, db_session, setup_test_data, make_order, capture_statements):
+    """Test that the conditional UPDATE taking the last use marks the code exhausted on commit."""
+    monkeypatch.setitem(CONCURRENCY_MODES, "promo_codes", "atomic")
+    code_filter = PromoCodeFilter()
+    order = make_order(user_id=2, promo_code="ONETIME")
+    DiscountsService(db_session, code_filter=code_filter).reserve_promo_use(order.id, "ONETIME")
+    assert code_filter.rejection(db_session, "ONETIME") is None  # not before the commit
+    db_session.commit()
+
+    with capture_statements() as statements:
+        assert _rejection(db_session, code_filter, "ONETIME") == EXHAUSTED
+    assert statements == []
+
+
+def test_requests_never_rebuild_the_filter(db_session, setup_test_data, capture_statements):
+    """Test that checks before the first build go to the table and the job, not a request, rebuilds."""
+    code_filter = PromoCodeFilter()
+    with capture_statements() as statements:
+        assert _rejection(db_session, code_filter, "BOT1") == UNKNOWN
+    assert statements and all("WHERE" in s for s in statements)  # a lookup, not the scan of every code
+
+    job = PromoFilterRebuildJob(lambda: db_session, code_filter, interval=0.01)
+    job.start()
+    try:
+        for _ in range(500):
+            if code_filter.rejection(db_session, "BOT2") == UNKNOWN:
+                break
+            threading.Event().wait(0.01)
+    finally:
+        job.stop(timeout=5)
+    assert code_filter.rejection(db_session, "BOT2") == UNKNOWN
+    assert code_filter.rejection(db_session, "DISCOUNT10") is None
@@ -0,0 +1,74 @@
+"""Tests for promo use leasing."""
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+
+from app.concurrency import CONCURRENCY_MODES
+from app.models import PromoApplication, PromoCode, PromoLease
+from app.promo_leases import PromoLeasePool
+from app.reconciliation import InvariantChecker
+from app.saga import OrderSaga, SagaContext, SagaServices
+from app.services.billing import BillingService
+from app.services.discounts import DiscountsService
+from app.services.inventory import InventoryService
+from app.services.orders import OrdersService
+
+
+def _run(db_session, pool, order):
+    """Run the order's saga on a worker holding ``pool``."""
+    services = SagaServices(
+        DiscountsService(db_session, pool), InventoryService(db_session), BillingService(db_session),
+        OrdersService(db_session),
+    )
+    return OrderSaga(db_session).execute(order.id, context=SagaContext(db_session, order, services=services))
+
+
+def _promo(db_session):
+    return db_session.get(PromoCode, "DISCOUNT10", populate_existing=True)
+
+
+def test_leases_never_exceed_promo_limit(monkeypatch, db_session, setup_test_data, make_order, capture_statements):
+    """Test that two workers leasing blocks hand out exactly the uses the code has."""
+    monkeypatch.setitem(CONCURRENCY_MODES, "promo_codes", "lease")
+    first, second = PromoLeasePool(size=3, owner="first"), PromoLeasePool(size=3, owner="second")
+    orders = [make_order(promo_code="DISCOUNT10") for _ in range(8)]
+
+    with capture_statements() as statements:
+        results = [_run(db_session, pool, order) for pool, order in zip([first, second] * 4, orders)]
+
+    assert results == [True] * 5 + [False] * 3
+    assert sum(s.startswith("UPDATE promo_codes") for s in statements) == 2  # one per block, not one per order
+    applied = db_session.scalar(
+        select(func.count()).where(PromoApplication.code == "DISCOUNT10", PromoApplication.status == "APPLIED")
+    )
+    assert (applied, _promo(db_session).remaining_uses) == (5, 0)
+    assert InvariantChecker().check(db_session, full=True).ok
+
+
+def test_unissued_uses_return_on_release_and_expiry(monkeypatch, db_session, setup_test_data, make_order):
+    """Test that expired and released leases give back exactly the uses they did not issue."""
+    monkeypatch.setitem(CONCURRENCY_MODES, "promo_codes", "lease")
+    first, second = PromoLeasePool(size=3, owner="first"), PromoLeasePool(size=3, owner="second")
+    checker = InvariantChecker()
+
+    assert _run(db_session, first, make_order(promo_code="DISCOUNT10")) is True
+    assert _run(db_session, first, make_order(user_id=2, promo_code="DISCOUNT10")) is False  # cannot afford it, the use goes back to the row
+    assert _promo(db_session).remaining_uses == 3
+    assert checker.check(db_session, full=True).ok
+
+    # The first worker's lease has expired: the next lease settles it, returning its one unissued use
+    later = datetime.now(timezone.utc) + timedelta(minutes=5)
+    second.take(db_session, "DISCOUNT10", now=later)  # a use whose step then rolls back
+    db_session.commit()
+    assert _promo(db_session).remaining_uses == 1
+    first.take(db_session, "DISCOUNT10", now=later)  # takes the last use left on the row
+    db_session.commit()
+    assert first.available("DISCOUNT10") == 0 and second.available("DISCOUNT10") == 2
+    assert checker.check(db_session, full=True).ok
+
+    assert second.release(db_session) == 3
+    assert first.release(db_session) == 1
+    assert _promo(db_session).remaining_uses == 4
+    assert db_session.scalar(select(func.count()).select_from(PromoLease)) == 0
+    assert db_session.scalar(select(func.count()).where(PromoApplication.lease_id.is_not(None))) == 0
+    assert checker.check(db_session, full=True).ok
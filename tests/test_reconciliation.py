@@ -0,0 +1,94 @@
+"""Tests for the stock, money and promo reconciliation."""
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from app.models import InventoryItem, Order, Payment, PromoCode, RollupCursor, SagaStep
+from app.money import MONEY_MINOR_UNITS
+from app.reconciliation import CURSOR_NAME, InvariantChecker, reset_baselines
+from app.saga import OrderSaga
+
+
+def _run_saga(db_session, order, fail_at_step=None):
+    OrderSaga(db_session).execute(order.id, fail_at_step)
+    return order
+
+
+def _later():
+    return datetime.now(timezone.utc) + timedelta(minutes=1)
+
+
+def test_sagas_keep_every_total_balanced(db_session, setup_test_data, make_order):
+    """Test that confirmed, failed and compensated sagas pass the full and incremental checks."""
+    checker = InvariantChecker()
+    _run_saga(db_session, make_order(promo_code="DISCOUNT10"))
+    _run_saga(db_session, make_order(user_id=2, promo_code="DISCOUNT10"))  # fails at ChargeUserBalance
+    _run_saga(db_session, make_order(sku="ITEM002"), "FinalizeOrder")
+
+    first = checker.check(db_session, now=_later())
+    assert first.full and first.ok
+    assert first.checked == {"stock": 3, "money": 2, "promo": 3, "ledger": 2}
+    assert first.baselined == {"stock": 3, "money": 2, "promo": 3}
+
+    _run_saga(db_session, make_order(sku="ITEM002", promo_code="ONETIME"))
+    second = checker.check(db_session, now=_later())
+    assert not second.full and second.ok
+    # Only the SKU, user and promo code of the new order are looked at
+    assert second.checked == {"stock": 1, "money": 1, "promo": 1, "ledger": 1}
+    assert second.baselined == {"stock": 0, "money": 0, "promo": 0}
+
+    assert checker.check(db_session, now=_later()).checked == {}
+
+
+def test_discrepancies_are_reported_per_entity(db_session, setup_test_data, make_order):
+    """Test that lost stock, an unbacked payment and a leaked promo use are reported."""
+    checker = InvariantChecker()
+    _run_saga(db_session, make_order(promo_code="DISCOUNT10"))
+    checker.check(db_session, now=_later())
+
+    db_session.get(InventoryItem, "ITEM001").on_hand -= 2
+    unpaid = Order(
+        user_id=1, sku="ITEM001", qty=1, base_amount=Decimal("5.00"), discount_amount=Decimal("0.00"),
+        final_amount=Decimal("5.00"), status="FAILED"
+    )
+    db_session.add(unpaid)
+    db_session.flush()
+    db_session.add(Payment(order_id=unpaid.id, user_id=1, amount=Decimal("5.00"), status="CHARGED"))
+    db_session.get(PromoCode, "ONETIME").remaining_uses += 1  # untouched by any saga since the last check
+    db_session.commit()
+    _run_saga(db_session, make_order())
+
+    report = checker.check(db_session, now=_later())
+    found = {(d.kind, d.entity): d for d in report.discrepancies}
+    unbacked = Decimal(500) if MONEY_MINOR_UNITS else Decimal("5.00")  # money totals are in storage units
+    assert set(found) == {("stock", "ITEM001"), ("money", "1"), ("ledger", "1")}
+    assert found[("stock", "ITEM001")].difference == -2
+    assert found[("money", "1")].difference == unbacked
+    assert found[("ledger", "1")].expected == 0 and found[("ledger", "1")].actual == unbacked
+
+    full = checker.check(db_session, full=True, now=_later())
+    assert ("promo", "ONETIME") in {(d.kind, d.entity) for d in full.discrepancies}
+
+    # A restock is legitimate: record the new total
+    assert reset_baselines(db_session, "promo", ["ONETIME"]) == 1
+    full = checker.check(db_session, full=True, now=_later())
+    assert full.baselined["promo"] == 1
+    assert ("promo", "ONETIME") not in {(d.kind, d.entity) for d in full.discrepancies}
+
+
+def test_cursor_waits_for_running_steps(db_session, setup_test_data, make_order):
+    """Test that the checkpoint stops before a step that is still running."""
+    checker = InvariantChecker()
+    _run_saga(db_session, make_order())
+    order = _run_saga(db_session, make_order(sku="ITEM002"))
+    running = SagaStep(order_id=order.id, step_name="ReserveInventory", status="STARTED",
+                       started_at=datetime.now(timezone.utc))
+    db_session.add(running)
+    db_session.commit()
+
+    report = checker.check(db_session, now=_later())
+    assert report.last_id == running.id - 1
+    assert db_session.get(RollupCursor, CURSOR_NAME).last_id == running.id - 1
+
+    # Long abandoned steps no longer hold the cursor back
+    report = checker.check(db_session, now=datetime.now(timezone.utc) + timedelta(hours=1))
+    assert report.last_id == running.id
@@ -0,0 +1,59 @@
+"""Tests for the saga step rollups and the /stats API."""
+from datetime import datetime, timedelta, timezone
+
+from app.models import RollupCursor, SagaStep
+from app.rollups import SagaStepRollupJob, get_stats
+from app.saga import OrderSaga
+
+
+def _by(stats, key):
+    return {s[key]: s for s in stats}
+
+
+def test_rollups_fold_finished_steps_once(db_session, setup_test_data, make_order):
+    """Test that finished steps are folded exactly once and grouped by step and promo."""
+    job = SagaStepRollupJob(lambda: db_session)
+    OrderSaga(db_session).execute(make_order().id)
+    # user 2 cannot afford the order, so ChargeUserBalance really fails
+    OrderSaga(db_session).execute(make_order(user_id=2, promo_code="DISCOUNT10").id)
+
+    later = datetime.now(timezone.utc) + timedelta(minutes=1)
+    assert job.process_batch(db_session, now=later) == 8
+    assert job.process_batch(db_session, now=later) == 0
+
+    since = later - timedelta(hours=1)
+    steps = _by(get_stats(db_session, since, later), "step_name")
+    assert steps["ReserveInventory"]["runs"] == 2
+    assert steps["ReserveInventory"]["compensations"] == 1
+    assert steps["ChargeUserBalance"]["failed"] == 1
+    assert steps["ChargeUserBalance"]["failure_rate"] == 0.5
+    assert steps["ReservePromoUse"]["compensation_rate"] == 1.0
+    assert steps["FinalizeOrder"]["p50_ms"] is not None
+
+    promos = _by(get_stats(db_session, since, later, group_by="promo_code"), "promo_code")
+    assert promos[""]["runs"] == 3 and promos[""]["failed"] == 0
+    assert promos["DISCOUNT10"]["failed"] == 1
+
+
+def test_cursor_waits_for_running_steps(client, db_session, setup_test_data, make_order):
+    """Test that the high-water mark stops at a step that has not finished yet."""
+    job = SagaStepRollupJob(lambda: db_session, abandon_after=600)
+    order = make_order()
+    started_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+    running = SagaStep(order_id=order.id, step_name="ReserveInventory", status="STARTED", started_at=started_at)
+    db_session.add(running)
+    db_session.commit()
+
+    assert job.process_batch(db_session) == 0
+    assert db_session.get(RollupCursor, "saga_steps").last_id < running.id
+
+    running.status = "COMPLETED"
+    running.finished_at = started_at + timedelta(milliseconds=30)
+    db_session.commit()
+    assert job.process_batch(db_session) == 1
+
+    response = client.get("/stats", params={"sku": "ITEM001"})
+    assert response.status_code == 200
+    [stats] = response.json()["stats"]
+    assert stats["runs"] == 1 and stats["p50_ms"] == 30
+    assert client.get("/stats", params={"group_by": "user"}).status_code == 400
@@ -4,8 +4,9 @@ from decimal import Decimal
 
 import pytest
 
-from app.models import Order, User, InventoryItem, PromoCode, SagaStep
+from app.models import Order, InventoryItem, PromoCode, SagaStep
 from app.saga import OrderSaga
+from app.services.billing import BillingService
 
 # Configure logging for tests
 logging.basicConfig(
@@ -46,8 +47,7 @@ def test_successful_order_without_promo(db_session, setup_test_data):
     assert item.on_hand == 8  # 10 - 2
     
     # Check balance
-    user = db_session.query(User).filter(User.id == 1).first()
-    assert user.balance == Decimal("800.00")  # 1000 - 200
+    assert BillingService(db_session).get_balance(1) == Decimal("800.00")  # 1000 - 200
     
     # Check saga steps
     steps = db_session.query(SagaStep).filter(SagaStep.order_id == order.id).all()
@@ -96,8 +96,7 @@ def test_successful_order_with_promo(db_session, setup_test_data):
     assert item.on_hand == 9  # 10 - 1
     
     # Check balance (discount applied)
-    user = db_session.query(User).filter(User.id == 1).first()
-    assert user.balance == Decimal("910.00")  # 1000 - 90
+    assert BillingService(db_session).get_balance(1) == Decimal("910.00")  # 1000 - 90
     
     logging.info("✓ Order with promo completed successfully")
 
@@ -134,8 +133,7 @@ def test_fail_on_insufficient_promo_uses(db_session, setup_test_data):
     assert item.on_hand == 10  # Unchanged
     
     # Check that balance was NOT charged
-    user = db_session.query(User).filter(User.id == 1).first()
-    assert user.balance == Decimal("1000.00")  # Unchanged
+    assert BillingService(db_session).get_balance(1) == Decimal("1000.00")  # Unchanged
     
     # Check saga steps
     steps = db_session.query(SagaStep).filter(SagaStep.order_id == order.id).all()
@@ -185,8 +183,7 @@ def test_fail_on_insufficient_inventory(db_session, setup_test_data):
     assert item.on_hand == 10  # Unchanged
     
     # Check balance unchanged
-    user = db_session.query(User).filter(User.id == 1).first()
-    assert user.balance == Decimal("1000.00")  # Unchanged
+    assert BillingService(db_session).get_balance(1) == Decimal("1000.00")  # Unchanged
     
     # Check compensation step
     steps = db_session.query(SagaStep).filter(SagaStep.order_id == order.id).all()
@@ -238,8 +235,7 @@ def test_fail_on_insufficient_balance(db_session, setup_test_data):
     assert item.on_hand == initial_inventory  # Restored
     
     # Check balance unchanged
-    user = db_session.query(User).filter(User.id == 2).first()
-    assert user.balance == Decimal("50.00")  # Unchanged
+    assert BillingService(db_session).get_balance(2) == Decimal("50.00")  # Unchanged
     
     # Check compensation steps
     steps = db_session.query(SagaStep).filter(SagaStep.order_id == order.id).all()
@@ -274,8 +270,7 @@ def test_artificial_failure_at_finalize(db_session, setup_test_data):
     item = db_session.query(InventoryItem).filter(InventoryItem.sku == "ITEM001").first()
     initial_inventory = item.on_hand
     
-    user = db_session.query(User).filter(User.id == 1).first()
-    initial_balance = user.balance
+    initial_balance = BillingService(db_session).get_balance(1)
     
     # Execute saga with artificial failure at FinalizeOrder
     saga = OrderSaga(db_session)
@@ -291,7 +286,7 @@ def test_artificial_failure_at_finalize(db_session, setup_test_data):
     
     assert item.on_hand == initial_inventory  # Restored
     
-    assert user.balance == initial_balance  # Restored
+    assert BillingService(db_session).get_balance(1) == initial_balance  # Restored
     
     # Check compensation steps - should have 3 compensations
     steps = db_session.query(SagaStep).filter(SagaStep.order_id == order.id).all()
@@ -0,0 +1,85 @@
+"""Tests for saga progress events and the SSE stream."""
+import asyncio
+import json
+
+from app.events import bus, order_topic
+from app.main import order_events
+from app.saga import OrderSaga
+
+
+def _collect_events(order_id, run):
+    async def main():
+        with bus.subscribe(order_topic(order_id)) as subscription:
+            result = await asyncio.to_thread(run)
+            await asyncio.sleep(0)  # let call_soon_threadsafe callbacks run
+            events = []
+            while not subscription.queue.empty():
+                events.append(subscription.queue.get_nowait())
+            return result, events
+    return asyncio.run(main())
+
+
+def test_step_transitions_are_published_after_commit(db_session, setup_test_data, make_order):
+    """Test that every committed step transition reaches subscribers in order."""
+    order = make_order()
+
+    success, events = _collect_events(order.id, lambda: OrderSaga(db_session).execute(order.id))
+
+    assert success is True
+    assert [(e["type"], e.get("step_name"), e["status"]) for e in events] == [
+        ("step", "ReserveInventory", "STARTED"),
+        ("step", "ReserveInventory", "COMPLETED"),
+        ("step", "ChargeUserBalance", "STARTED"),
+        ("step", "ChargeUserBalance", "COMPLETED"),
+        ("step", "FinalizeOrder", "STARTED"),
+        ("order", None, "CONFIRMED"),
+        ("step", "FinalizeOrder", "COMPLETED"),
+    ]
+
+
+def test_rolled_back_events_are_not_published(db_session, setup_test_data, make_order):
+    """Test that a failing step publishes FAILED but not the rolled back transition."""
+    order = make_order()
+
+    success, events = _collect_events(order.id, lambda: OrderSaga(db_session).execute(order.id, "FinalizeOrder"))
+
+    assert success is False
+    statuses = [(e.get("step_name"), e["status"]) for e in events]
+    assert (None, "CONFIRMED") not in statuses
+    assert (None, "FAILED") in statuses
+    assert ("Compensate_ReserveInventory", "COMPLETED") in statuses
+
+
+def test_order_events_stream_for_finished_order(client, db_session, setup_test_data, make_order):
+    """Test that the SSE endpoint replays the current state and closes for final orders."""
+    order = make_order()
+    OrderSaga(db_session).execute(order.id)
+
+    with client.stream("GET", f"/orders/{order.id}/events") as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        data = [json.loads(line[len("data: "):]) for line in response.iter_lines() if line.startswith("data: ")]
+
+    assert [d["step_name"] for d in data if d["type"] == "step"] == ["ReserveInventory", "ChargeUserBalance", "FinalizeOrder"]
+    assert data[-1] == {"type": "order", "order_id": order.id, "status": "CONFIRMED"}
+
+
+def test_order_events_stream_ends_after_compensations(db_session, setup_test_data, make_order):
+    """Test that a stream following a failing order gets its compensations before the final FAILED."""
+    order = make_order()
+
+    async def main():
+        response = await order_events(order.id, db_session)
+        chunks = [await anext(response.body_iterator)]  # the snapshot is read; now the order fails
+        assert await asyncio.to_thread(OrderSaga(db_session).execute, order.id, "FinalizeOrder") is False
+        chunks += [chunk async for chunk in response.body_iterator]
+        lines = "".join(chunks).splitlines()
+        return [json.loads(line[len("data: "):]) for line in lines if line.startswith("data: ")]
+
+    data = asyncio.run(main())
+    assert data[0] == {"type": "order", "order_id": order.id, "status": "PENDING"}
+    assert [(d.get("step_name"), d["status"]) for d in data[-3:]] == [
+        ("Compensate_ChargeUserBalance", "COMPLETED"),
+        ("Compensate_ReserveInventory", "COMPLETED"),
+        (None, "FAILED"),
+    ]
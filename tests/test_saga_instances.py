@@ -0,0 +1,95 @@
+"""Tests for the saga_instances state machine and stuck saga recovery."""
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from app import saga_instances
+from app.faults import FaultRegistry, InjectedCrash
+from app.models import InventoryItem, SagaInstance, SagaStep
+from app.saga import OrderSaga, SagaContext
+from app.saga_instances import find_stuck
+from app.saga_recovery import SagaRecoveryJob
+from app.services.billing import BillingService
+
+
+def _positions(db_session, order):
+    """Run the saga, recording the instance row at every step and compensation."""
+    seen = []
+
+    def record(_):
+        instance = db_session.get(SagaInstance, order.id)
+        seen.append((instance.phase, instance.step_index, instance.step_name))
+
+    faults = FaultRegistry.from_spec("*:before_execute:delay:1:1,*:compensate:delay:1:1", sleep=record)
+    OrderSaga(db_session).execute(order.id, context=SagaContext(db_session, order, faults=faults))
+    return seen, db_session.get(SagaInstance, order.id)
+
+
+def test_instance_follows_steps_and_compensations(db_session, setup_test_data, make_order):
+    """Test that the instance row tracks the current step forward and while compensating."""
+    seen, instance = _positions(db_session, make_order(promo_code="DISCOUNT10"))
+    assert seen == [
+        ("FORWARD", 0, "ReservePromoUse"), ("FORWARD", 1, "ReserveInventory"),
+        ("FORWARD", 2, "ChargeUserBalance"), ("FORWARD", 3, "FinalizeOrder"),
+    ]
+    assert (instance.phase, instance.step_index, instance.step_name, instance.deadline) == ("DONE", 4, None, None)
+
+    # user 2 cannot afford the order
+    seen, instance = _positions(db_session, make_order(user_id=2, promo_code="DISCOUNT10"))
+    assert seen[-2:] == [("COMPENSATING", 1, "ReserveInventory"), ("COMPENSATING", 0, "ReservePromoUse")]
+    assert (instance.phase, instance.step_index, instance.attempts) == ("DONE", 0, 1)
+    assert find_stuck(db_session, datetime.now(timezone.utc) + timedelta(days=1)) == []
+
+
+def test_crashed_saga_is_recovered_from_its_instance(client, db_session, setup_test_data, make_order, monkeypatch):
+    """Test that a saga left behind by a crash is found past its deadline and compensated."""
+    monkeypatch.setattr(saga_instances, "SAGA_DEADLINE", 60)
+    order = make_order()
+    faults = FaultRegistry.from_spec("ChargeUserBalance:after_execute:crash")
+    with pytest.raises(InjectedCrash):
+        OrderSaga(db_session).execute(order.id, context=SagaContext(db_session, order, faults=faults))
+    db_session.rollback()
+
+    instance = db_session.get(SagaInstance, order.id)
+    assert (instance.phase, instance.step_index, instance.step_name) == ("FORWARD", 1, "ChargeUserBalance")
+    assert find_stuck(db_session) == []
+    assert "Текущий шаг:</strong> ChargeUserBalance" in client.get(f"/orders/{order.id}").text
+
+    later = datetime.now(timezone.utc) + timedelta(minutes=2)
+    assert find_stuck(db_session, later) == [instance]
+    assert SagaRecoveryJob(lambda: db_session).process_batch(db_session, now=later) == 1
+
+    assert order.status == "FAILED"
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 10
+    assert BillingService(db_session).get_balance(1) == Decimal("1000.00")
+    assert (instance.phase, instance.attempts, instance.deadline) == ("DONE", 2, None)
+    steps = db_session.query(SagaStep).filter(SagaStep.order_id == order.id).order_by(SagaStep.id).all()
+    assert [(s.step_name, s.status) for s in steps] == [
+        ("ReserveInventory", "COMPLETED"), ("ChargeUserBalance", "FAILED"), ("Compensate_ReserveInventory", "COMPLETED"),
+    ]
+    assert find_stuck(db_session, later) == []
+
+
+def test_crash_while_compensating_resumes_at_the_pending_compensation(db_session, setup_test_data, make_order):
+    """Test that recovery only runs the compensations that had not finished."""
+    order = make_order()
+    faults = FaultRegistry.from_spec("FinalizeOrder:before_execute,ReserveInventory:compensate:crash")
+    with pytest.raises(InjectedCrash):
+        OrderSaga(db_session).execute(order.id, context=SagaContext(db_session, order, faults=faults))
+    db_session.rollback()
+
+    instance = db_session.get(SagaInstance, order.id)
+    assert (instance.phase, instance.step_name) == ("COMPENSATING", "ReserveInventory")
+    assert BillingService(db_session).get_balance(1) == Decimal("1000.00")
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 9
+
+    OrderSaga(db_session).recover(instance)
+
+    assert instance.phase == "DONE"
+    assert db_session.get(InventoryItem, "ITEM001").on_hand == 10
+    assert BillingService(db_session).get_balance(1) == Decimal("1000.00")
+    compensations = db_session.query(SagaStep).filter(
+        SagaStep.order_id == order.id, SagaStep.step_name.like("Compensate_%")
+    ).all()
+    assert sorted(s.step_name for s in compensations) == ["Compensate_ChargeUserBalance", "Compensate_ReserveInventory"]
@@ -0,0 +1,31 @@
+"""Tests for the number of SQL statements issued per order."""
+from app.promo_filter import promo_filter
+from app.stock_view import stock_view
+
+
+def _selects_from(statements, table):
+    return [s for s in statements if s.startswith("SELECT") and f"FROM {table} " in s + " "]
+
+
+def test_order_with_promo_query_count(client, db_session, setup_test_data, capture_statements, engine):
+    """Test that one POST /orders loads the order and promo rows only where needed."""
+    db_session.expunge_all()  # start from an empty identity map, like a new request
+    promo_filter.rebuild(db_session)  # built at startup, then once per rebuild interval
+    stock_view.load(db_session)  # loaded at startup, then kept current by stock events
+
+    with capture_statements() as statements:
+        response = client.post("/orders", data={"user_id": 1, "sku": "ITEM001", "qty": 1, "promo_code": "DISCOUNT10"})
+    assert response.status_code == 200
+    assert "CONFIRMED" in response.text
+
+    # The order is inserted once and never re-read
+    assert _selects_from(statements, "orders") == []
+    # Validation in create_order, then the re-read before reserving a use
+    assert len(_selects_from(statements, "promo_codes")) == 2
+    # The price in create_order, then the reservation
+    assert len(_selects_from(statements, "inventory_items")) == 2
+    # User validation and the ledger balance check
+    assert len(_selects_from(statements, "users")) == 2
+    # 3 lookups + order insert, saga instance insert, 4 steps x (insert + update + instance update)
+    # + step work, steps for the page; the balance advisory lock and the per-step timeouts are PostgreSQL only
+    assert len(statements) == (33 if engine.dialect.name == "postgresql" else 28)
@@ -0,0 +1,153 @@
+"""Tests for routing users and orders to shards, against two databases of the session's backend."""
+from decimal import Decimal
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.db import get_db
+from app.fragments import fragments
+from app.models import InventoryItem, Order, PromoCode, User
+from app.promo_filter import PromoCodeFilter
+from app.reconciliation import InvariantChecker
+from app.saga import OrderSaga
+from app.services.discounts import DiscountsService, PromoCodeUnavailable
+from app.sharding import ShardRouter, list_orders, rebalance_catalog, replicate_catalog
+from app.stock_view import stock_view
+
+SHARDS = 2
+
+
+@pytest.fixture
+def router(make_database):
+    """Two empty shards with the catalog split between them and users 1-4."""
+    engines = [make_database(f"shard{shard}") for shard in range(SHARDS)]
+    router = ShardRouter(engines)
+    router.prepare()
+    replicate_catalog(
+        router,
+        [InventoryItem(sku="ITEM001", name="Ноутбук", price=Decimal("100.00"), on_hand=5)],
+        [PromoCode(code="DISCOUNT10", remaining_uses=5, discount_amount=Decimal("10.00"))],
+    )
+    for user_id in range(1, 5):
+        db = router.session(router.shard_for_user(user_id))
+        db.add(User(id=user_id, name=f"Пользователь {user_id}", balance=Decimal("1000.00")))
+        db.commit()
+        db.close()
+    return router
+
+
+def _place(router, make_order, user_id, promo_code=None):
+    db = router.session(router.shard_for_user(user_id))
+    try:
+        order = make_order(user_id=user_id, promo_code=promo_code, db=db)
+        OrderSaga(db).execute(order.id)
+        return order.id, order.status
+    finally:
+        db.close()
+
+
+def _on_hand(router):
+    return router.scatter(lambda db: db.get(InventoryItem, "ITEM001").on_hand)
+
+
+def _uses(router):
+    return router.scatter(lambda db: db.get(PromoCode, "DISCOUNT10").remaining_uses)
+
+
+def test_sagas_run_on_their_users_shard(router, make_order):
+    """Test that each order lives on its user's shard, under an id that routes back to it."""
+    assert _on_hand(router) == [3, 2]
+    placed = [_place(router, make_order, user_id, promo_code="DISCOUNT10") for user_id in (1, 2, 3, 4, 1)]
+
+    ids = [order_id for order_id, _ in placed]
+    assert len(set(ids)) == len(ids)
+    assert [router.shard_for_order(order_id) for order_id in ids] == [1, 0, 1, 0, 1]
+    for order_id, _ in placed:
+        found = router.scatter(lambda db: db.get(Order, order_id) is not None)
+        assert found == [shard == router.shard_for_order(order_id) for shard in range(SHARDS)]
+
+    # Shard 1 has 2 of the 5 units; its third order finds none left, although shard 0 still has one
+    assert [status for _, status in placed] == ["CONFIRMED"] * 4 + ["FAILED"]
+    assert _on_hand(router) == [1, 0]
+    assert _uses(router) == [1, 0]
+    assert all(router.scatter(lambda db: InvariantChecker().check(db, full=True).ok))
+
+    router.prepare()  # restarting workers prepare again; ids keep to their shard
+    assert router.shard_for_order(_place(router, make_order, 2)[0]) == 0
+
+
+def test_listing_scatters_to_every_shard(router, make_order):
+    """Test that the order listing merges the newest orders of every shard."""
+    ids = [_place(router, make_order, user_id)[0] for user_id in (1, 2, 3, 4)]
+
+    assert [o.id for o in list_orders(router)] == ids[::-1]
+    assert [o.id for o in list_orders(router, limit=3)] == ids[:0:-1]
+    assert [o.id for o in list_orders(router, user_id=3)] == [ids[2]]
+    assert list_orders(router, status="FAILED") == []
+
+
+def test_requests_use_their_users_shard(router, monkeypatch):
+    """Test that placing and showing orders routes each request to its shard."""
+    monkeypatch.setattr(main, "shards", router)
+    shard0 = router.session(0)
+    main.app.dependency_overrides[get_db] = lambda: shard0
+    try:
+        client = TestClient(main.app)
+        for user_id in (1, 2):
+            assert client.post("/orders", data={"user_id": user_id, "sku": "ITEM001", "qty": 1}).status_code == 200
+        listed = client.get("/admin/orders").json()
+        assert sorted((o["user_id"], router.shard_for_order(o["id"])) for o in listed) == [(1, 1), (2, 0)]
+        for order in listed:
+            assert "CONFIRMED" in client.get(f"/orders/{order['id']}").text
+        assert "остаток: 3" in client.get("/").text  # the stock of both shards
+        assert client.get("/admin/sagas/stuck", params={"shard": SHARDS}).status_code == 404
+    finally:
+        main.app.dependency_overrides.clear()
+        shard0.close()
+        fragments.clear()
+        stock_view.clear()
+
+
+def test_a_users_shard_runs_out_before_the_others(router, make_order, monkeypatch):
+    """Test that a user's orders are turned away once their shard is out, while other shards still have some."""
+    for _ in range(2):
+        assert _place(router, make_order, 1, promo_code="DISCOUNT10")[1] == "CONFIRMED"
+    assert (_on_hand(router), _uses(router)) == ([3, 0], [3, 0])
+
+    monkeypatch.setattr(main, "shards", router)
+    shard0 = router.session(0)
+    main.app.dependency_overrides[get_db] = lambda: shard0
+    try:
+        client = TestClient(main.app)
+        assert "остаток: 3" in client.get("/").text  # the stock of both shards
+        response = client.post("/orders", data={"user_id": 1, "sku": "ITEM001", "qty": 1})
+        assert response.status_code == 400 and "в наличии 0" in response.text  # the stock of user 1's shard
+        assert "CONFIRMED" in client.post("/orders", data={"user_id": 2, "sku": "ITEM001", "qty": 1}).text
+    finally:
+        main.app.dependency_overrides.clear()
+        shard0.close()
+        fragments.clear()
+        stock_view.clear()
+
+    code_filter = PromoCodeFilter(mark_exhausted=False)  # as with several shards
+    with pytest.raises(PromoCodeUnavailable, match="no remaining uses"):
+        router.on_shard(1, lambda db: DiscountsService(db, code_filter=code_filter).check_promo("DISCOUNT10"))
+    assert router.on_shard(0, lambda db: DiscountsService(db, code_filter=code_filter).check_promo("DISCOUNT10"))
+
+
+def test_rebalancing_tops_up_a_drained_shard(router, make_order):
+    """Test that a drained shard gets a share back from the others, with each shard's totals still reconciling."""
+    for _ in range(2):
+        _place(router, make_order, 1, promo_code="DISCOUNT10")
+    checker = InvariantChecker()
+    assert all(router.scatter(lambda db: checker.check(db, full=True).ok))  # records the baselines
+
+    assert rebalance_catalog(router) == {"ITEM001": 1, "DISCOUNT10": 1}
+    assert (_on_hand(router), _uses(router)) == ([2, 1], [2, 1])
+    assert all(router.scatter(lambda db: checker.check(db, full=True).ok))
+    assert rebalance_catalog(router) == {}  # no shard is below its share
+
+    assert _place(router, make_order, 1, promo_code="DISCOUNT10")[1] == "CONFIRMED"
+    assert (_on_hand(router), _uses(router)) == ([2, 0], [2, 0])
+    assert all(router.scatter(lambda db: checker.check(db).ok))
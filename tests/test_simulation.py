@@ -0,0 +1,79 @@
+"""Tests for the in-memory saga simulation."""
+from decimal import Decimal
+
+import pytest
+
+from app.models import InventoryItem
+from app.simulation import SagaSimulation, StepProfile
+
+
+def make_simulation(**kwargs):
+    profile = {
+        "ReservePromoUse": StepProfile(latency_ms=2, failure_rate=0.05, compensation_failure_rate=0.1),
+        "ReserveInventory": StepProfile(latency_ms=5, failure_rate=0.05, compensation_failure_rate=0.1),
+        "ChargeUserBalance": StepProfile(latency_ms=8, failure_rate=0.1),
+        "FinalizeOrder": StepProfile(latency_ms=1, failure_rate=0.05),
+    }
+    return SagaSimulation(
+        profile,
+        users={1: Decimal("100000.00"), 2: Decimal("15.00")},
+        items={"A": (Decimal("10.00"), 10_000), "B": (Decimal("7.50"), 50)},
+        promos={"P": (Decimal("1.00"), 10_000)},
+        seed=42,
+        **kwargs,
+    )
+
+
+def test_simulation_conserves_balances_stock_and_promo_uses():
+    """Test that failures and compensations never create or lose money, stock or promo uses."""
+    simulation = make_simulation()
+    report = simulation.run(2000)
+    store = simulation.store
+
+    assert report.sagas == 2000 and 0 < report.failed < 2000
+    assert report.compensations > 0 and report.compensation_retries > 0
+
+    reserved = {"A": 0, "B": 0}
+    for order_id, sku in store.reservations:
+        if store.reservations[(order_id, sku)] == "RESERVED":
+            reserved[sku] += store.orders[order_id].qty
+    assert store.stock["A"] + reserved["A"] == 10_000
+    assert store.stock["B"] + reserved["B"] == 50
+
+    charged = sum(amount for amount, status in store.payments.values() if status == "CHARGED")
+    assert sum(store.balances.values()) + charged == Decimal("100015.00")
+    applied = sum(1 for status in store.applications.values() if status == "APPLIED")
+    assert store.promo_uses["P"] + applied == 10_000
+
+    # Every confirmed order holds its reservation and payment; queued retries are the only leftovers
+    confirmed = [order for order in store.orders.values() if order.status == "CONFIRMED"]
+    assert len(confirmed) == report.confirmed
+    for order in confirmed:
+        assert store.reservations[(order.id, order.sku)] == "RESERVED"
+        assert store.payments[(order.id, order.user_id)][1] == "CHARGED"
+    assert sum(reserved.values()) >= report.confirmed
+
+
+def test_simulation_report():
+    """Test the journal counts, simulated latency and the throughput projection."""
+    simulation = make_simulation(keep_journal=True)
+    report = simulation.run(500)
+
+    assert len(simulation.store.journal) == sum(report.journal_counts.values())
+    assert report.journal_counts[("FinalizeOrder", "COMPLETED")] == report.confirmed
+    assert 0 < report.percentile(0.5) <= report.percentile(0.99)
+    assert report.projected_throughput(10) == 10 / report.mean_latency
+    assert "sagas/min" in report.format(10)
+
+    simulation = SagaSimulation(seed=1)
+    no_latency = simulation.run(100)
+    assert no_latency.confirmed == 100 and no_latency.projected_throughput(10) is None
+    assert no_latency.journal_counts[("FinalizeOrder", "COMPLETED")] == 100
+    assert not simulation.store.journal  # counted, then trimmed
+
+
+def test_simulated_session_names_the_rows_it_keeps():
+    """Test that reading a model the simulation does not keep says which ones it does."""
+    session = make_simulation().session
+    with pytest.raises(NotImplementedError, match="no InventoryItem rows; .* supports Order and SagaInstance"):
+        session.get(InventoryItem, "A")
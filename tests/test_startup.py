@@ -0,0 +1,52 @@
+"""Tests for import-time cost and lazy initialization of app.main."""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from app import db
+
+ROOT = Path(__file__).resolve().parent.parent
+# Cumulative `python -X importtime` budget for `import app.main`, most of it FastAPI itself
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+
+_PROBE = """
+import sys
+import app.main
+from app import db
+print(db._engine is None, app.main.get_templates.cache_info().currsize, "psycopg2" in sys.modules)
+"""
+
+
+def _import_app_main():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _PROBE],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, total, name = line.split("|")
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total) / 1000
+    return result.stdout.split(), cumulative
+
+
+def test_importing_app_main_is_lazy_and_within_budget():
+    """Test that importing app.main neither connects nor builds templates, within the time budget."""
+    (engine_is_lazy, templates_built, driver_loaded), cumulative = _import_app_main()
+
+    assert engine_is_lazy == "True"
+    assert templates_built == "0"
+    assert driver_loaded == "False"
+    assert cumulative["app.main"] < IMPORT_TIME_BUDGET_MS, f"import app.main took {cumulative['app.main']:.0f} ms"
+
+
+def test_prewarm_pool_opens_connections(monkeypatch, engine):
+    """Test that prewarming checks connections out and returns them to the pool."""
+    monkeypatch.setattr(db, "_engine", engine)
+    assert db.prewarm_pool(2) == 2
+    if engine.dialect.name == "postgresql":
+        assert engine.pool.checkedout() == 0
+        assert engine.pool.checkedin() >= 2
@@ -0,0 +1,98 @@
+"""Tests for the in-memory read model of available stock."""
+from contextlib import contextmanager
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import select
+
+from app.concurrency import CONCURRENCY_MODES
+from app.events import ALL_TOPICS, bus
+from app.fragments import fragments
+from app.models import InventoryItem, Order
+from app.saga import OrderSaga
+from app.services.billing import BillingService
+from app.stock_view import StockView, stock_view
+
+
+@contextmanager
+def installed(view):
+    bus.add_listener(ALL_TOPICS, view.on_event)
+    try:
+        yield view
+    finally:
+        bus.remove_listener(ALL_TOPICS, view.on_event)
+
+
+@pytest.mark.parametrize("mode", ["lock", "atomic", "optimistic"])
+def test_view_follows_reservations_and_releases(monkeypatch, db_session, setup_test_data, make_order, mode):
+    """Test that the view tracks reserved, compensated and cancelled stock without reloading."""
+    monkeypatch.setitem(CONCURRENCY_MODES, "inventory_items", mode)
+    with installed(StockView()) as view:
+        view.load(db_session)
+        monkeypatch.setattr(view, "load", None)  # any reload would fail
+
+        def available():
+            assert view.item(db_session, "ITEM001").on_hand == db_session.get(
+                InventoryItem, "ITEM001", populate_existing=True
+            ).on_hand
+            return view.item(db_session, "ITEM001").on_hand
+
+        confirmed = make_order(qty=2).id
+        assert OrderSaga(db_session).execute(confirmed) is True
+        assert available() == 8
+        assert OrderSaga(db_session).execute(make_order(qty=3).id, "ChargeUserBalance") is False
+        assert available() == 8
+        assert OrderSaga(db_session).cancel(confirmed) is True
+        assert available() == 10
+
+
+def test_order_form_and_precheck_read_no_stock(client, db_session, setup_test_data, capture_statements):
+    """Test that the form, the pre-check and GET /stock answer from the view once it is loaded."""
+    assert "остаток: 5" in client.get("/").text
+    fragments.clear()
+
+    with capture_statements() as statements:
+        assert "остаток: 5" in client.get("/").text
+        response = client.post("/orders", data={"user_id": 1, "sku": "ITEM002", "qty": 6})
+        assert response.status_code == 400 and "Недостаточно товара ITEM002: в наличии 5" in response.text
+        assert client.post("/orders", data={"user_id": 1, "sku": "NOPE", "qty": 1}).status_code == 404
+        stock = client.get("/stock").json()
+    assert not [s for s in statements if "inventory_items" in s]
+    assert {item["sku"]: item["on_hand"] for item in stock} == {"ITEM001": 10, "ITEM002": 5, "ITEM003": 0}
+
+    # The saga still makes the real check
+    assert "CONFIRMED" in client.post("/orders", data={"user_id": 1, "sku": "ITEM002", "qty": 5}).text
+    assert {item["sku"]: item["on_hand"] for item in client.get("/stock").json()}["ITEM002"] == 0
+
+
+def test_stale_events_never_move_the_view_back(db_session, setup_test_data):
+    """Test that older versions are ignored, reloads keep newer ones and new items trigger a reload."""
+    now = [0.0]
+    view = StockView(refresh_interval=60.0, clock=lambda: now[0])
+    view.load(db_session)
+    version = db_session.get(InventoryItem, "ITEM001").version
+
+    view.apply("ITEM001", 0, 4, version + 2)
+    view.apply("ITEM001", 0, 7, version + 1)  # delivered late
+    assert view.item(db_session, "ITEM001").on_hand == 4
+    view.load(db_session)  # read before the changes committed
+    assert view.item(db_session, "ITEM001").on_hand == 4
+
+    db_session.add(InventoryItem(sku="ITEM004", name="Монитор", price=Decimal("300.00"), on_hand=2))
+    db_session.commit()
+    view.apply("ITEM004", 0, 2, 1)
+    assert view.stale_shards(1) == [0]
+    assert view.item(db_session, "ITEM004").on_hand == 2
+    assert view.stale_shards(1) == []
+
+
+def test_orders_are_priced_from_the_row(client, db_session, setup_test_data):
+    """Test that a price changed after the view loaded is the one the order is charged."""
+    stock_view.load(db_session)
+    db_session.get(InventoryItem, "ITEM001").price = Decimal("120.00")
+    db_session.commit()
+
+    assert "CONFIRMED" in client.post("/orders", data={"user_id": 1, "sku": "ITEM001", "qty": 2}).text
+    order = db_session.execute(select(Order)).scalars().one()
+    assert (order.base_amount, order.final_amount) == (Decimal("240.00"), Decimal("240.00"))
+    assert BillingService(db_session).get_balance(1) == Decimal("760.00")